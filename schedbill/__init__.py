@@ -1,18 +1,43 @@
-from flask import Flask, current_app, g
+from flask import Flask, current_app, g, appcontext_pushed
 import logging
 from . import config
 from . import errors
 from . import views
 from . import log
-from db import get_db
-from scheduler import get_scheduler
+from db import get_db, ensure_indexes, load_profiler
+from encoding import load_json_encoder
+from models import User, EMail, Invoice, BillingRun
+from scheduler import get_scheduler, get_dispatcher, get_jobs_facade
+from controllers import InvoiceController
+from sharding import get_sharding
+from intents import get_intent_recorder, get_intent_consumer
+from cache import get_user_cache
+from spreading import get_load_spreader
 
+# Names of the scheduling objects (and caches) shared by every application context through flask.g
+SCHEDULING_GLOBALS = ('scheduler', 'dispatcher', 'sharding', 'intents', 'jobs', 'user_cache', 'load_spreader')
 
-def create_app(config_class=config.DevelopmentConfiguration):
-    """Boilerplate for the Flask application"""
+
+def bind_scheduling(app: Flask, **extra) -> None:
+    """Expose the scheduling objects set up by create_app in flask.g of every application context"""
+
+    for name, obj in app.extensions.get('schedbill', {}).items():
+        setattr(g, name, obj)
+
+
+def create_app(config_class=config.DevelopmentConfiguration, role: str = None):
+    """Boilerplate for the Flask application
+
+    :param config_class: the configuration class
+    :param role: 'all' to serve requests and run the scheduler, 'web' to serve requests and record schedule intents
+        for the scheduler daemon, 'scheduler' to run the scheduler only, 'worker' to record schedule intents only
+        (default to the APP_ROLE configuration)
+    :return: the Flask application
+    """
 
     app = Flask(__name__)
     app.config.from_object(config_class)
+    role = role or app.config.get('APP_ROLE', 'all')
     with app.app_context():
         log.init()
         logger = logging.getLogger()
@@ -21,13 +46,47 @@ def create_app(config_class=config.DevelopmentConfiguration):
         logger.debug('Errors handlers loaded')
         get_db()
         logger.debug('Database connected')
-        app_scheduler = get_scheduler()
-        # app_scheduler.start()
-        logger.debug('Scheduler initialized and started')
-        views.load()
-        logger.debug('Routes initialized')
+        load_json_encoder()
+        logger.debug('JSON encoder loaded')
+        if role in ('all', 'scheduler') and app.config.get('DB_ENSURE_INDEXES'):
+            ensure_indexes([User, EMail, Invoice, BillingRun])
+            logger.debug('Database indexes created')
+        if role in ('web', 'worker'):
+            get_intent_recorder()
+            logger.debug('Schedule intents recorder initialized')
+        else:
+            app_scheduler = get_scheduler()
+            # app_scheduler.start()
+            logger.debug('Scheduler initialized and started')
+            if app.config.get('SCHEDULER_PARTITIONS', 0) > 0:
+                get_sharding()
+                logger.debug('Sharded scheduling initialized and partitions claimed')
+            elif app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'dispatcher':
+                get_dispatcher()
+                logger.debug('Email dispatcher initialized and started')
+            if role == 'scheduler' or app.config.get('SCHEDULER_MAX_PROCESSES', 0) > 0:
+                # The process pool workers record the schedule intents of the jobs they run
+                get_intent_consumer()
+                logger.debug('Schedule intents consumer initialized and started')
+        get_jobs_facade()
+        logger.debug('Jobs facade initialized')
+        if role in ('all', 'scheduler'):
+            InvoiceController.schedule_billing_plan()
+            logger.debug('Billing runs daily planning scheduled')
+        get_user_cache(serve=role in ('all', 'scheduler'))
+        logger.debug('Users cache initialized')
+        get_load_spreader()
+        logger.debug('Notifications load spreader initialized')
+        app.extensions['schedbill'] = {name: getattr(g, name) for name in SCHEDULING_GLOBALS if name in g}
+        if role in ('all', 'web'):
+            views.load()
+            logger.debug('Routes initialized')
+            if app.config.get('DB_PROFILE'):
+                load_profiler()
+                logger.debug('Database commands profiler loaded')
+    appcontext_pushed.connect(bind_scheduling, app, weak=False)
     return app
 
 
 if __name__ == '__main__':
-    create_app(config.DevelopmentConfiguration)
\ No newline at end of file
+    create_app(config.DevelopmentConfiguration)
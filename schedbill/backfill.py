@@ -0,0 +1,33 @@
+"""Emails backfill (schedbill-backfill), marking the emails saved before the sentAt field existed as pending.
+
+The pending emails are looked up with sentAt = 0 (the dispatcher rebuild, the due emails, the pending_emails index):
+the emails without the field would never be sent. Run it once after deploying the field, it is harmless to run again.
+
+    python -m schedbill.backfill --config ProductionConfiguration
+"""
+import argparse
+import sys
+import config
+import db
+from controllers import EMailController
+
+
+def main(argv: list = None) -> int:
+    """Backfill the emails, then print the number of emails marked as pending
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-backfill', description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='DevelopmentConfiguration', help='configuration class of the database')
+    args = parser.parse_args(argv)
+
+    if db.connect_db(getattr(config, args.config)) is None:
+        return 1
+    print(f"{EMailController.backfill_sent_at()} emails marked as pending", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,198 @@
+"""Request paths benchmark (schedbill-benchmark), measuring the database and serialization cost of the API requests.
+
+- updates: the update of an email as the PUT requests did it, a modify() then a get() reading the document back (two
+  round trips), against modify_one(), a single find_one_and_update returning the document after the update.
+- reads: the read of an email as the GET requests do it, building a Document then encoding it to JSON, against the
+  raw read mode (API_RAW_READS) encoding the raw document found by find_raw().
+- encoding: the JSON encoding of an email, already read, as flask-mongoengine did it (converting the whole document
+  with json_util then encoding it with json), as Document.to_json() does it, and in a single pass with encoding.dumps()
+  (orjson if installed), as the JSON responses now are.
+- dates: the conversion of the sendAt of an email to a timestamp, as a numeric string (timestamps, floats), an ISO 8601
+  string or a free-form string, as it was done by dateutil, against the layered parsing of TimeCalc.arg_to_timestamp()
+  (ISO 8601 parsed directly, the strings repeated remembered). The strings are repeated every 100 calls.
+- columns: the conversion of a column of 1000 dates to timestamps, and of 1000 timestamps (spanning 10 days) to the
+  midnights starting their days in Europe/Paris, item by item against the TimeCalc batch methods (vectorized with
+  NumPy if installed).
+
+The emails are created in the database of the configuration, then deleted.
+
+    python -m schedbill.benchmark --config TestingConfiguration --emails 100 --calls 2000
+"""
+from bson import json_util
+from dateutil.parser import parse
+from functools import partial
+from typing import Callable
+import argparse
+import json
+import time
+import config
+import db
+import encoding
+from controllers import find_raw, modify_one
+from helpers import is_float
+from models import EMail
+from simulation import percentiles
+from timing import TimeCalc
+
+BENCHMARK_RECIPIENT = 'benchmark@example.com'
+
+
+def modify_then_get(oid: str, number: int) -> EMail:
+    """The former update path: the update, then a second round trip to read the updated document"""
+    EMail.objects(id=oid).modify(title=f"Update {number}")
+    return EMail.objects.get(id=oid)
+
+
+def modify_once(oid: str, number: int) -> EMail:
+    """The single round trip update path"""
+    return modify_one(EMail, oid, {'title': f"Update {number}"})
+
+
+def read_document(oid: str, number: int) -> bytes:
+    """The Document read path"""
+    return encoding.dumps(EMail.objects.get(id=oid))
+
+
+def read_raw(oid: str, number: int) -> bytes:
+    """The raw read path"""
+    return encoding.dumps(find_raw(EMail, oid))
+
+
+# The emails encoded by the encoding paths, by id
+_emails = {}
+
+
+def encode_json_util(oid: str, number: int) -> str:
+    """The former JSON encoding path, the encoder of flask-mongoengine"""
+    return json.dumps(json_util._json_convert(_emails[oid].to_mongo()))
+
+
+def encode_to_json(oid: str, number: int) -> str:
+    """The JSON encoding of the controllers logging"""
+    return _emails[oid].to_json()
+
+
+def encode_once(oid: str, number: int) -> bytes:
+    """The single pass JSON encoding path"""
+    return encoding.dumps(_emails[oid])
+
+
+def dateutil_arg_to_timestamp(date_arg) -> int:
+    """The former conversion of a date to a timestamp, dateutil parsing any string which is not a number"""
+    if isinstance(date_arg, str):
+        if str.isnumeric(date_arg):
+            return int(date_arg)
+        elif is_float(date_arg):
+            return int(float(date_arg))
+        return int(parse(date_arg).timestamp())
+    return int(date_arg)
+
+
+DATE_SAMPLES = {
+    'timestamps': lambda number: f"{1654099800 + number % 100}",
+    'floats': lambda number: f"{1654099800 + number % 100}.250",
+    'iso': lambda number: f"2022-06-01T16:{number % 100 // 2:02d}:{number % 2 * 30:02d}+02:00",
+    'free-form': lambda number: f"June {number % 100 // 10 + 1} 2022 {number % 10 + 1}pm"
+}
+
+
+def convert_date(convert: Callable, sample: Callable, oid: str, number: int) -> int:
+    """The conversion of a sample date to a timestamp"""
+    return convert(sample(number))
+
+
+COLUMN_SIZE = 1000
+COLUMNS = {
+    'dates': [DATE_SAMPLES['iso'](number) if number % 2 else 1654099800 + number for number in range(COLUMN_SIZE)],
+    'timestamps': [1654099800 + number * 864 for number in range(COLUMN_SIZE)]
+}
+
+
+def column_timestamps(oid: str, number: int) -> list:
+    """The conversion of the dates item by item"""
+    return [TimeCalc.arg_to_timestamp(date_arg) for date_arg in COLUMNS['dates']]
+
+
+def batch_timestamps(oid: str, number: int):
+    """The conversion of the dates in one pass"""
+    return TimeCalc.to_timestamps(COLUMNS['dates'])
+
+
+def column_midnights(oid: str, number: int) -> list:
+    """The midnights computed item by item"""
+    return [TimeCalc.midnight_timestamp(ts, 'Europe/Paris') for ts in COLUMNS['timestamps']]
+
+
+def batch_midnights(oid: str, number: int):
+    """The midnights computed in one pass"""
+    return TimeCalc.midnight_timestamps(COLUMNS['timestamps'], 'Europe/Paris')
+
+
+PATHS = {
+    'updates': (('modify+get', modify_then_get), ('modify_one', modify_once)),
+    'reads': (('document', read_document), ('raw', read_raw)),
+    'encoding': (('json_util', encode_json_util), ('to_json', encode_to_json), ('dumps', encode_once)),
+    'dates': tuple((f"{kind} {name}", partial(convert_date, convert, sample)) for kind, sample in DATE_SAMPLES.items()
+                   for name, convert in (('dateutil', dateutil_arg_to_timestamp), ('layered', TimeCalc.arg_to_timestamp))),
+    'columns': (('timestamps items', column_timestamps), ('timestamps batch', batch_timestamps),
+                ('midnights items', column_midnights), ('midnights batch', batch_midnights))
+}
+
+
+def time_calls(path: Callable, oids: list, calls: int) -> dict:
+    """Call a request path on the emails in turn, measuring the latency and the MongoDB commands of each call
+
+    :param path: the function handling an email, called with the email id and the call number
+    :param oids: the ids of the emails
+    :param calls: the number of calls
+    :return: the latency percentiles (in seconds) and the commands per call
+    """
+
+    latencies = []
+    commands = 0
+    for number in range(calls):
+        started_at = time.perf_counter()
+        with db.COMMAND_PROFILER.profile() as profile:
+            path(oids[number % len(oids)], number)
+        latencies.append(time.perf_counter() - started_at)
+        commands += profile.commands
+    return dict(percentiles(latencies), mean=sum(latencies) / len(latencies), commands=commands / calls)
+
+
+def main(argv: list = None) -> int:
+    """Benchmark the request paths on the database of a configuration, then print their latency per call
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-benchmark', description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='DevelopmentConfiguration', help='configuration class of the database')
+    parser.add_argument('--emails', type=int, default=100, help='number of emails the calls handle in turn')
+    parser.add_argument('--calls', type=int, default=1000, help='number of calls of each request path')
+    parser.add_argument('--paths', nargs='+', default=list(PATHS), choices=list(PATHS), help='request paths to compare')
+    args = parser.parse_args(argv)
+
+    conf = getattr(config, args.config)
+    if db.connect_db(conf) is None:
+        return 1
+    if not getattr(conf, 'DB_PROFILE', False):
+        print('DB_PROFILE is off: the commands per call are not counted')
+    emails = EMail.objects.insert(
+        [EMail(recipient=BENCHMARK_RECIPIENT, content='Benchmark', sentAt=0) for _ in range(args.emails)]
+    )
+    oids = [str(email.id) for email in emails]
+    _emails.update(zip(oids, emails))
+    try:
+        for name, path in (variant for paths in args.paths for variant in PATHS[paths]):
+            path(oids[0], 0)  # warm up
+            report = time_calls(path, oids, args.calls)
+            print(f"{name:<20} {report['commands']:.1f} commands/call  mean={report['mean'] * 1000:.3f}ms "
+                  + ' '.join(f"{key}={report[key] * 1000:.3f}ms" for key in ('p50', 'p90', 'p99', 'max')))
+    finally:
+        EMail.objects(recipient=BENCHMARK_RECIPIENT).delete()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
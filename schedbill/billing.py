@@ -0,0 +1,148 @@
+"""Calendar billing rules, planning the runs of the invoices billed on calendar dates rather than every N seconds.
+
+A rule is a string:
+
+- 'monthly:D': day D (1 to 31) of every month, the last day of the shorter months. 'monthly:last' is the last day.
+- 'quarterly:D': day D of January, April, July and October. 'quarterly:last' is the last day of these months.
+- 'business:N': the N-th business day (Monday to Friday) of every month. 'business:last' is the last one.
+- 'cron:M H DOM MON DOW': a crontab expression, as APScheduler reads it.
+
+The calendar rules run at midnight of the timezone of the invoice (UTC by default), the cron expressions at the
+times they give in this timezone.
+"""
+from apscheduler.triggers.cron import CronTrigger
+from calendar import monthrange
+from datetime import date, timedelta
+from functools import lru_cache
+from timing import TimeCalc, timezone_of
+
+QUARTERS = (1, 4, 7, 10)
+# Rules (with their timezone and number of runs) whose next runs are kept
+PLANNED_RUNS_SIZE = 4096
+
+# (rule, timezone, count) -> the timestamp the runs were computed after, and the runs
+_planned_runs = {}
+
+
+class CalendarRule:
+    """This class is a calendar billing rule, running on a day of some months"""
+
+    def __init__(self, months: tuple, day: int = None, business_day: int = None):
+        """
+        :param months: the months the rule runs in (1 to 12)
+        :param day: the day of the month (1 to 31, -1 for the last day), clamped to the last day of the month
+        :param business_day: the business day of the month (1 to 23, -1 for the last one), instead of the day
+        """
+        self.months = months
+        self.day = day
+        self.business_day = business_day
+
+    def day_of(self, year: int, month: int) -> date:
+        """Return the date the rule runs on in a month, None if it does not run in the month"""
+
+        if month not in self.months:
+            return None
+        last_day = monthrange(year, month)[1]
+        if self.business_day is None:
+            return date(year, month, last_day if self.day == -1 else min(self.day, last_day))
+        business_days = [day for day in range(1, last_day + 1) if date(year, month, day).weekday() < 5]
+        if self.business_day > len(business_days):
+            return None
+        return date(year, month, business_days[self.business_day if self.business_day == -1 else
+                                              self.business_day - 1])
+
+    def next_runs(self, tz: str, after: int, count: int) -> list:
+        """Return the timestamps of the next runs, at midnight of a timezone
+
+        :param tz: the timezone
+        :param after: the timestamp the runs are due after
+        :param count: the number of runs
+        :return: the timestamps of the runs, in ascending order
+        """
+
+        runs = []
+        local = TimeCalc.timestamp_to_datetime(after, tz)
+        year, month = local.year, local.month
+        while len(runs) < count:
+            day = self.day_of(year, month)
+            if day is not None:
+                run_at = TimeCalc.day_midnight(day, tz)
+                if run_at > after:
+                    runs.append(run_at)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return runs
+
+
+class CronRule:
+    """This class is a crontab billing rule"""
+
+    def __init__(self, expression: str):
+        """
+        :param expression: the crontab expression (minute, hour, day of month, month, day of week)
+        """
+        self.expression = expression
+        CronTrigger.from_crontab(expression)  # checks the expression
+
+    def next_runs(self, tz: str, after: int, count: int) -> list:
+        """Return the timestamps of the next runs, at the times of a timezone (see CalendarRule.next_runs())"""
+
+        trigger = CronTrigger.from_crontab(self.expression, timezone=timezone_of(tz))
+        runs = []
+        fire_time = TimeCalc.timestamp_to_datetime(after, tz) + timedelta(seconds=1)
+        previous = None
+        while len(runs) < count:
+            fire_time = trigger.get_next_fire_time(previous, fire_time)
+            if fire_time is None:
+                break
+            runs.append(int(fire_time.timestamp()))
+            previous = fire_time
+        return runs
+
+
+@lru_cache(maxsize=256)
+def parse_rule(rule: str):
+    """Read a billing rule
+
+    :param rule: the rule (see the module documentation)
+    :return: the CalendarRule or CronRule
+    """
+
+    kind, _, argument = rule.partition(':')
+    argument = argument.strip()
+    if kind == 'cron':
+        return CronRule(argument)
+    if kind not in ('monthly', 'quarterly', 'business'):
+        raise ValueError(f"Unknown billing rule '{rule}'")
+    if argument == 'last':
+        day = -1
+    elif argument.isdigit() and 1 <= int(argument) <= (23 if kind == 'business' else 31):
+        day = int(argument)
+    else:
+        raise ValueError(f"Invalid day in billing rule '{rule}'")
+    if kind == 'business':
+        return CalendarRule(tuple(range(1, 13)), business_day=day)
+    return CalendarRule(QUARTERS if kind == 'quarterly' else tuple(range(1, 13)), day=day)
+
+
+def next_runs(rule: str, tz: str, after: int, count: int) -> tuple:
+    """Return the timestamps of the next runs of a billing rule. The runs are computed once for all the invoices
+    sharing a rule and a timezone, until the first of them is due: the next runs are the same until then.
+
+    :param rule: the rule
+    :param tz: the timezone the rule runs in
+    :param after: the timestamp the runs are due after
+    :param count: the number of runs
+    :return: the timestamps of the runs, in ascending order
+    """
+
+    key = (rule, tz, count)
+    planned = _planned_runs.get(key)
+    if planned is not None:
+        since, runs = planned
+        if since <= after and (not runs or after < runs[0]):
+            return runs
+    runs = tuple(parse_rule(rule).next_runs(tz, after, count))
+    if len(_planned_runs) >= PLANNED_RUNS_SIZE:
+        _planned_runs.clear()
+    _planned_runs[key] = (after, runs)
+    return runs
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from flask import current_app, g
+from multiprocessing.managers import BaseManager, Server
+import logging
+import threading
+import time
+import metrics
+from models import User
+
+logger = logging.getLogger()
+
+
+class TTLCache:
+    """This class is a bounded cache, thread-safe, whose entries expire after a time to live.
+    Once full, the least recently used entry is evicted to store a new one."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, clock=time.monotonic):
+        """
+        :param maxsize: the maximum number of entries
+        :param ttl: the time (in seconds) an entry is valid for
+        :param clock: the function returning the current time (in seconds)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        """Return the value of a key, or the default if the key is not cached or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self._misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        """Cache the value of a key, evicting the least recently used entries beyond the maximum size"""
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def set_many(self, items: dict) -> None:
+        """Cache the values of several keys"""
+        for key, value in items.items():
+            self.set(key, value)
+
+    def delete(self, *keys) -> None:
+        """Forget keys, whether cached or not"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Return the number of entries, hits, misses and evictions of the cache"""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self._hits, 'misses': self._misses,
+                    'evictions': self._evictions}
+
+
+# The cache served to the other processes by this process, if any
+_served_cache = None
+
+
+class CacheManager(BaseManager):
+    """This class shares a cache of a process with other processes, which reach it through a proxy"""
+
+
+CacheManager.register('cache', callable=lambda: _served_cache)
+
+
+def serve_cache(cache: TTLCache, address: tuple, authkey: bytes) -> Server:
+    """Serve a cache to the other processes, from a thread of this process
+
+    :param cache: the cache to share
+    :param address: the (host, port) the cache is served on
+    :param authkey: the key the other processes authenticate with
+    :return: the server, which runs until the process exits
+    """
+
+    global _served_cache
+    _served_cache = cache
+    server = CacheManager(address=address, authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name='schedbill-cache', daemon=True).start()
+    logger.info(f"Cache served on {address[0]}:{address[1]}")
+    return server
+
+
+def connect_cache(address: tuple, authkey: bytes):
+    """Return a proxy to a cache served by another process (see serve_cache())
+
+    :param address: the (host, port) the cache is served on
+    :param authkey: the key to authenticate with
+    :return: the proxy, which has the methods of the served TTLCache
+    """
+
+    manager = CacheManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.cache()
+
+
+class DocumentCache:
+    """This class caches documents under their id and other unique keys, as their raw BSON (SON) content.
+    Each lookup returns a new document, which the caller can modify."""
+
+    def __init__(self, document_cls: type, store, keys: tuple = ()):
+        """
+        :param document_cls: the Document class
+        :param store: the TTLCache holding the documents, or a proxy to a TTLCache shared between processes
+        :param keys: the unique fields, besides the id, the documents are cached under
+        """
+        self.document_cls = document_cls
+        self.store = store
+        self.keys = keys
+        self._name = document_cls._meta['collection']
+
+    def get(self, key: str, value):
+        """Return the document whose key (the id or a unique field) has a value, None if not cached"""
+        son = self.get_raw(key, value)
+        return None if son is None else self.document_cls._from_son(son)
+
+    def get_raw(self, key: str, value) -> dict:
+        """Return the raw content of the document whose key (the id or a unique field) has a value, None if not cached"""
+        son = self.store.get((key, str(value)))
+        metrics.CACHE_LOOKUPS.inc(self._name, 'miss' if son is None else 'hit')
+        return son
+
+    def add(self, document) -> None:
+        """Cache a document under its id and its unique keys"""
+        self.add_raw(document.to_mongo().to_dict())
+
+    def add_raw(self, son: dict) -> None:
+        """Cache the raw content of a whole document under its id and its unique keys"""
+        fields = self.document_cls._fields
+        self.store.set_many({(key, str(son[fields[key].db_field])): son for key in ('id',) + self.keys
+                             if son.get(fields[key].db_field)})
+
+    def invalidate(self, *documents) -> None:
+        """Forget documents, under their id and their unique keys"""
+        self.store.delete(*[(key, str(document[key])) for document in documents for key in ('id',) + self.keys
+                            if document[key]])
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+
+def get_user_cache(serve: bool = False) -> DocumentCache:
+    """Register the cache of the users, by id and email address, in flask.g or returns it if already existing
+
+    With USER_CACHE_ADDRESS, the process running the scheduler serves its cache to the others (web workers, process
+    pool workers), so that the update of a user invalidates it for every process. Otherwise each process has its own.
+
+    :param serve: True to serve the cache on USER_CACHE_ADDRESS, False to connect to the cache served there
+    :return: the users cache
+    """
+
+    user_cache = getattr(g, 'user_cache', None)
+    if user_cache is None:
+        address = current_app.config.get('USER_CACHE_ADDRESS')
+        authkey = (current_app.config.get('USER_CACHE_AUTHKEY') or '').encode()
+        store = None
+        if address and not serve:
+            try:
+                store = connect_cache(address, authkey)
+            except (OSError, EOFError) as exc:
+                logger.error(f"Can not connect to the users cache on {address[0]}:{address[1]}, "
+                             f"the process keeps its own : {exc}")
+        if store is None:
+            store = TTLCache(current_app.config.get('USER_CACHE_SIZE'), current_app.config.get('USER_CACHE_TTL'))
+            if address and serve:
+                serve_cache(store, address, authkey)
+        user_cache = g.user_cache = DocumentCache(User, store, keys=('emailAddress',))
+    return user_cache
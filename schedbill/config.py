@@ -38,16 +38,62 @@ class Configuration:
         }
     }
     APP_TIMEZONE = pytz.timezone('Europe/Paris')
+    # 'all' = serve requests and run the scheduler. 'web' = serve requests and record schedule intents.
+    # 'scheduler' = run the scheduler and apply the recorded intents (see daemon.py).
+    # 'worker' = record schedule intents only, set up in the process pool workers.
+    APP_ROLE = 'all'
     DB_HOST = 'cluster0.xdxzo.mongodb.net'
     DB_USER = environ.get('DB_USER')
     DB_SECRET = environ.get('DB_PASSWORD')
     DB_NAME = 'intiaDevDB'
-    DB_URI_FORMAT = 'mongodb+srv://{user}:{secret}@{host}/{db}?retryWrites=true&w=majority'
+    DB_URI_FORMAT = 'mongodb+srv://{user}:{secret}@{host}/{db}?retryWrites=true'
+    DB_WRITE_CONCERN = 'majority'
+    # One client (and connection pool) per process, shared by the requests, the scheduler and its executors
+    DB_MAX_POOL_SIZE = 50  # connections per server, the checkouts beyond wait for a connection to be checked in
+    DB_MIN_POOL_SIZE = 5  # connections opened at startup and kept open
+    DB_COMPRESSORS = 'zlib'  # wire compression ('zstd' and 'snappy' need the zstandard and python-snappy packages)
+    DB_CONNECT_TIMEOUT_MS = 5000
+    DB_SERVER_SELECTION_TIMEOUT_MS = 10000
+    DB_PROFILE = True  # MongoDB commands of each request in its Server-Timing header, and of each job in the metrics
+    DB_SLOW_COMMAND_MS = 100  # MongoDB commands logged as slow from this duration (in milliseconds)
+    DB_ENSURE_INDEXES = True  # create the model indexes at startup of the roles running the scheduler
+    # Endpoints reading raw documents, sent as is to the JSON encoder without building mongoengine Documents (the
+    # fields missing in a stored document are then missing in the response, instead of set to their default).
+    # E.g. ('get_user', 'get_email', 'get_invoice'), which also accept a 'fields' projection in this mode.
+    API_RAW_READS = ()
+    API_PAGE_SIZE = 100  # items of a listing page, unless the request sets its limit
+    API_PAGE_MAX_SIZE = 1000  # maximum items of a listing page
+    API_EXPORT_BATCH_SIZE = 1000  # documents read from MongoDB at once by the exports, bounding their memory use
+    API_IMPORT_CHUNK_SIZE = 1000  # users validated then inserted at once by the imports, bounding their memory use
+    USER_CACHE_SIZE = 10000  # users cached by id and by email address, the least recently used beyond are evicted
+    USER_CACHE_TTL = 300  # seconds a cached user stays valid, bounding how stale a user updated elsewhere can be
+    # (host, port) the scheduler serves its users cache on to the other processes, which then share it (None = one
+    # cache per process). The processes authenticate with USER_CACHE_AUTHKEY.
+    USER_CACHE_ADDRESS = None
+    USER_CACHE_AUTHKEY = environ.get('USER_CACHE_AUTHKEY')
     SCHEDULER_MAX_THREADS = 20
+    SCHEDULER_MAX_PROCESSES = 0  # processes of the process pool executor (0 = no process pool)
+    # Executor running each type of job: 'default' (thread pool, for I/O bound jobs) or 'processpool' (CPU bound jobs)
+    SCHEDULER_JOB_EXECUTORS = {
+        'email': 'default',
+        'invoice': 'processpool'
+    }
     # False = missed executions can lead to multiple executions in a row later on. True = only one execution anyway.
     SCHEDULER_JOB_COALESCE = True
     SCHEDULER_MISFIRE_GRACE_TIME = None  # Run the late job no matter how late it is
     SCHEDULER_TIMEZONE = pytz.utc
+    # 'jobstore' = one APScheduler date job per email. 'bucket' = one APScheduler date job per due second.
+    # 'dispatcher' = in-memory EMailDispatcher rebuilt at startup.
+    SCHEDULER_EMAIL_DISPATCH = 'jobstore'
+    # Number of partitions the jobs are split into across the scheduler instances (0 = no sharding)
+    SCHEDULER_PARTITIONS = 0
+    SCHEDULER_LEASE_TTL = 30  # seconds a partition lease stays valid without renewal
+    SCHEDULER_SYNC_HORIZON = 3600  # seconds ahead of now a sharded email dispatcher loads the pending emails
+    SCHEDULER_INTENTS_INTERVAL = 1.0  # seconds between two polls of the schedule intents by the scheduler daemon
+    BILLING_RUNS_AHEAD = 12  # next runs of each invoice with a billing rule planned in the billing_runs collection
+    BILLING_PLAN_HOUR = 2  # hour (UTC) the runs of every invoice with a billing rule are planned daily (None = off)
+    NOTIFY_SPREAD_WINDOW = 0  # seconds the invoice notifications due on the same second are spread over (0 = off)
+    NOTIFY_SPREAD_RATE = 0  # target notifications per second within the window (0 = the per-invoice jitter only)
 
 
 class ProductionConfiguration(Configuration):
@@ -1,15 +1,232 @@
 from flask import current_app, g
-from mongoengine import ValidationError, DoesNotExist
+from mongoengine import ValidationError, DoesNotExist, FieldDoesNotExist, NotUniqueError
+from mongoengine.context_managers import no_dereference
+from mongoengine.queryset import transform
 from bson import ObjectId
 from bson.errors import InvalidId
-from models import User, EMail, Invoice
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from models import User, EMail, Invoice, BillingRun
+from cache import get_user_cache
+from spreading import get_load_spreader
+import encoding
 from timing import TimeCalc
+from scheduler import JobsFacade, get_jobs_facade, executor_for
+from datetime import datetime, timedelta
+from typing import Iterable
+import billing
+import base64
+import json
 import logging
-# from scheduler import get_scheduler
-# from scheduler import get_scheduler
+import secrets
 
 logger = logging.getLogger()
 
+# Id of the job planning the runs of every invoice with a billing rule
+BILLING_PLAN_JOB = 'billing-plan'
+
+
+def jobs() -> JobsFacade:
+    """Return the facade of what the jobs are scheduled with: the sharded scheduling if enabled, else the scheduler"""
+    return get_jobs_facade()
+
+
+def projection_of(document_cls: type, fields: list = None) -> dict:
+    """Return the pymongo projection of some fields of a document
+
+    :param document_cls: the Document class
+    :param fields: the fields (None = every field)
+    :return: the projection on the fields of the documents in the database, None for every field
+    """
+
+    if not fields:
+        return None
+    unknown = set(fields) - set(document_cls._fields)
+    if unknown:
+        raise FieldDoesNotExist(f"Unknown fields {', '.join(sorted(unknown))}")
+    return {document_cls._fields[name].db_field: True for name in fields}
+
+
+def modify_one(document_cls: type, oid: str, update: dict, fields: list = None):
+    """Update a document with a single find_one_and_update round trip, and return it as it is after the update
+
+    :param document_cls: the Document class
+    :param oid: the ObjectId of the document
+    :param update: the properties to update in the document
+    :param fields: the only fields to return (default to all)
+    :return: the document after the update, None if the document does not exist
+    """
+
+    if not update:
+        raise ValidationError('No property to update')
+    mongo_update = transform.update(document_cls, **update)
+    projection = projection_of(document_cls, fields)
+    try:
+        son = document_cls._get_collection().find_one_and_update(
+            {'_id': ObjectId(oid)}, mongo_update, projection=projection, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError as exc:
+        raise NotUniqueError(f"Tried to save duplicate unique keys ({exc})")
+    return None if son is None else document_cls._from_son(son)
+
+
+def modify_one_changes(document_cls: type, oid: str, update: dict, watched: list, fields: list = None) -> tuple:
+    """Update a document and return it as it is after the update, with the watched fields whose value changed
+
+    The update returns the watched fields as they are before it, then the document is read: a second round trip.
+
+    :param document_cls: the Document class
+    :param oid: the ObjectId of the document
+    :param update: the properties to update in the document
+    :param watched: the fields to compare before and after the update
+    :param fields: the only fields to return (default to all, the watched fields are always returned)
+    :return: the document after the update (None if the document does not exist) and the previous value of each
+        changed field
+    """
+
+    if not update:
+        raise ValidationError('No property to update')
+    mongo_update = transform.update(document_cls, **update)
+    collection = document_cls._get_collection()
+    try:
+        before = collection.find_one_and_update(
+            {'_id': ObjectId(oid)}, mongo_update, projection=projection_of(document_cls, watched),
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError as exc:
+        raise NotUniqueError(f"Tried to save duplicate unique keys ({exc})")
+    son = None if before is None else collection.find_one(
+        {'_id': ObjectId(oid)}, projection_of(document_cls, fields and list({*fields, *watched}))
+    )
+    if son is None:
+        return None, {}
+    document = document_cls._from_son(son)
+    previous = {name: before.get(document_cls._fields[name].db_field) for name in watched}
+    return document, {name: value for name, value in previous.items() if value != getattr(document, name)}
+
+
+def job_interval(job) -> int:
+    """Return the seconds between two runs of an interval job, None for another job
+
+    :param job: the job, as a scheduler or the schedule intents recorder (RecordedJob) returns it
+    :return: the interval in seconds
+    """
+
+    interval = getattr(getattr(job, 'trigger', None), 'interval', None)
+    if interval is not None:
+        return int(interval.total_seconds())
+    return getattr(job, 'interval', None)
+
+
+def find_raw(document_cls: type, oid: str, fields: list = None) -> dict:
+    """Find a document and return its raw content, without building a Document
+
+    :param document_cls: the Document class
+    :param oid: the ObjectId of the document
+    :param fields: the only fields to return (default to all)
+    :return: the document as stored, with the BSON types (ObjectId...)
+    """
+
+    if not ObjectId.is_valid(oid):
+        raise InvalidId(f"Invalid ObjectId '{oid}'")
+    projection = projection_of(document_cls, fields)
+    son = document_cls._get_collection().find_one({'_id': ObjectId(oid)}, projection)
+    if son is None:
+        raise DoesNotExist(f"{document_cls.__name__} matching query does not exist.")
+    return son
+
+
+def keyset_query(query: dict, sort: tuple = ('_id',), after: list = None) -> dict:
+    """Return the filter of the documents coming after a keyset in the order of some keys, the last of which is unique
+
+    :param query: the pymongo filter of the documents
+    :param sort: the sort keys in the database, in ascending order ('_id' last to make them unique)
+    :param after: the keys of the last document already read (None to start from the first document)
+    :return: the pymongo filter
+    """
+
+    if after is None:
+        return query
+    # (k1, k2) > (a1, a2) <=> k1 >= a1 and (k1 > a1 or k2 > a2): the first condition gives the index bounds
+    keyset = [{key: {'$gt': value}} for key, value in zip(sort, after)]
+    if len(sort) > 1:
+        keyset = [{sort[0]: {'$gte': after[0]}, '$or': keyset}]
+    return {'$and': [query] + keyset} if query else keyset[0]
+
+
+def encode_cursor(document: dict, sort: tuple = ('_id',)) -> str:
+    """Return the opaque cursor of the documents coming after a raw document, in the order of some keys"""
+
+    keys = [document[key] for key in sort[:-1]] + [str(document['_id'])]
+    return base64.urlsafe_b64encode(json.dumps(keys).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort: tuple = ('_id',)) -> list:
+    """Return the keys of an opaque cursor (see encode_cursor()), raising a ValueError if it is not valid"""
+
+    try:
+        keys = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(keys) == len(sort):
+            return keys[:-1] + [ObjectId(keys[-1])]
+    except (ValueError, TypeError, InvalidId):
+        pass
+    raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def find_page(document_cls: type, query: dict, sort: tuple = ('_id',), after: list = None, limit: int = 100,
+              fields: list = None) -> list:
+    """Find a page of documents in the order of some keys, the last of which is unique, from a keyset
+
+    The page starts right after the keys of the last document of the previous page, which an index on the sort keys
+    finds directly: a page costs the same however deep it is, unlike skipping the documents of the previous pages.
+
+    :param document_cls: the Document class
+    :param query: the pymongo filter of the documents
+    :param sort: the sort keys in the database, in ascending order ('_id' last to make them unique)
+    :param after: the keys of the last document of the previous page (None for the first page)
+    :param limit: the maximum number of documents of the page
+    :param fields: the only fields to return (default to all)
+    :return: the raw documents of the page
+    """
+
+    return list(page_query(document_cls, query, sort, after, limit, fields))
+
+
+def page_query(document_cls: type, query: dict, sort: tuple = ('_id',), after: list = None, limit: int = 100,
+               fields: list = None):
+    """Return the query of a page of documents, see find_page()
+
+    :return: the pymongo cursor of the raw documents of the page
+    """
+
+    return document_cls._get_collection().find(
+        keyset_query(query, sort, after), projection_of(document_cls, fields), sort=[(key, 1) for key in sort],
+        limit=limit
+    )
+
+
+def export_documents(document_cls: type, query: dict, fields: list = None, after: list = None,
+                     batch_size: int = 1000):
+    """Iterate over the documents of a collection in the order of their ids, as raw documents
+
+    A single server-side cursor reads the documents by batches: the memory used is bounded by the batch size however
+    many documents are exported.
+
+    :param document_cls: the Document class
+    :param query: the pymongo filter of the documents
+    :param fields: the only fields to export (default to all)
+    :param after: the id of the last document already exported, as a list (None to start from the first document)
+    :param batch_size: the number of documents of each batch read from the server
+    :return: the pymongo cursor, iterating over the raw documents
+    """
+
+    projection = projection_of(document_cls, fields)
+    if projection is not None:
+        projection['_id'] = True  # the id of the last document exported is the resume token
+    return document_cls._get_collection().find(
+        keyset_query(query, ('_id',), after), projection, sort=[('_id', 1)], batch_size=batch_size
+    )
+
 
 class UserController:
     """"""
@@ -24,7 +241,28 @@ class UserController:
 
         if not ObjectId.is_valid(oid):
             raise InvalidId(f"Invalid ObjectId '{oid}'")
-        user = User.objects.get(id=oid)
+        user = get_user_cache().get('id', oid)
+        if user is None:
+            user = User.objects.get(id=oid)
+            get_user_cache().add(user)
+
+        return user
+
+    @classmethod
+    def find_raw(cls, oid: str, fields: list = None) -> dict:
+        """Find a user and return its raw content, from the users cache if all the fields are requested
+
+        :param oid: the ObjectId of the document
+        :param fields: the only fields to return (default to all)
+        :return: User's raw document matching the id
+        """
+
+        if fields:
+            return find_raw(User, oid, fields)
+        user = get_user_cache().get_raw('id', oid)
+        if user is None:
+            user = find_raw(User, oid)
+            get_user_cache().add_raw(user)
 
         return user
 
@@ -36,10 +274,24 @@ class UserController:
         :return: User's document matching the user address
         """
 
-        user = User.objects.get(emailAddress=email_address)
+        user = get_user_cache().get('emailAddress', email_address)
+        if user is None:
+            user = User.objects.get(emailAddress=email_address)
+            get_user_cache().add(user)
 
         return user
 
+    @classmethod
+    def find_users(cls, after: list = None, limit: int = 100) -> list:
+        """Find a page of users in the order of their ids
+
+        :param after: the id of the last user of the previous page, as a list (None for the first page)
+        :param limit: the maximum number of users
+        :return: the raw documents of the users
+        """
+
+        return find_page(User, {}, ('_id',), after, limit)
+
     @classmethod
     def create_user(cls, raw_user: dict) -> User:
         """Create a new user and return it
@@ -54,20 +306,98 @@ class UserController:
         return user
 
     @classmethod
-    def update_user(cls, oid: str, updated_user: dict) -> User:
+    def import_users(cls, items, chunk_size: int = 1000) -> iter:
+        """Import users by chunks, each validated then inserted with a single unordered bulk insert, so that a failed
+        user does not stop the others. Only one chunk is held at once, whatever the number of users.
+
+        :param items: the iterator over the (line number, properties of the document) pairs, the properties being the
+            ValueError met if the line could not be parsed
+        :param chunk_size: the number of users inserted at once
+        :return: the iterator over the progress reports, one per chunk: the lines read, the users inserted and failed
+            so far, and the errors of the chunk by line number. The last report is marked as done.
+        """
+
+        lines = inserted = failed = 0
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            chunk_inserted, errors = cls._insert_users(chunk)
+            lines, inserted, failed = chunk[-1][0], inserted + chunk_inserted, failed + len(errors)
+            chunk = []
+            logger.info(f"Users import : {lines} lines read, {inserted} users inserted, {failed} failed")
+            yield {'lines': lines, 'inserted': inserted, 'failed': failed, 'errors': errors}
+
+        errors = []
+        if chunk:
+            chunk_inserted, errors = cls._insert_users(chunk)
+            lines, inserted, failed = chunk[-1][0], inserted + chunk_inserted, failed + len(errors)
+        logger.info(f"Users import done : {lines} lines read, {inserted} users inserted, {failed} failed")
+        yield {'lines': lines, 'inserted': inserted, 'failed': failed, 'errors': errors, 'done': True}
+
+    @classmethod
+    def _insert_users(cls, chunk: list) -> (int, list):
+        """Validate a chunk of users then insert the valid ones
+
+        :param chunk: the (line number, properties of the document) pairs
+        :return: the number of users inserted and the errors, by line number
+        """
+
+        errors = []
+        users, numbers = [], []
+        for number, raw_user in chunk:
+            try:
+                if isinstance(raw_user, ValueError):
+                    raise ValidationError(f"Invalid JSON : {raw_user}")
+                if not isinstance(raw_user, dict):
+                    raise ValidationError('The user is not an object')
+                user = User(**raw_user)
+                user.validate()
+            except (ValidationError, FieldDoesNotExist, TypeError) as exc:
+                errors.append({'line': number, 'error': str(exc)})
+            else:
+                users.append(user.to_mongo())
+                numbers.append(number)
+
+        if not users:
+            return 0, errors
+        try:
+            User._get_collection().insert_many(users, ordered=False)
+            inserted = len(users)
+        except BulkWriteError as exc:
+            inserted = exc.details['nInserted']
+            for error in exc.details['writeErrors']:
+                if error['code'] == 11000:
+                    message = f"Tried to save duplicate unique keys (emailAddress " \
+                              f"'{users[error['index']]['emailAddress']}')"
+                else:
+                    message = error['errmsg']
+                errors.append({'line': numbers[error['index']], 'error': message})
+            errors.sort(key=lambda error: error['line'])
+
+        return inserted, errors
+
+    @classmethod
+    def update_user(cls, oid: str, updated_user: dict, fields: list = None) -> User:
         """Update a user and return it
 
         :param oid: the ObjectId of the document
         :param updated_user: the properties to update in the document
+        :param fields: the only fields to return (default to all)
         :return: the updated User
         """
 
         if not ObjectId.is_valid(oid):
             raise InvalidId(f"Invalid ObjectId '{oid}'")
-        user = User.objects(id=oid).modify(**updated_user)
+        user, changed = modify_one_changes(User, oid, updated_user, ['emailAddress'], fields)
         if not user:
             raise DoesNotExist(f"Can not find user with id '{oid}'")
-        user = User.objects.get(id=oid)
+        stale = [user]
+        if 'emailAddress' in changed:
+            # the user may be cached under its previous email address as well, as stored before the update
+            stale.append({'id': oid, 'emailAddress': changed['emailAddress']})
+        get_user_cache().invalidate(*stale)
 
         return user
 
@@ -83,6 +413,8 @@ class UserController:
             raise InvalidId(f"Invalid ObjectId '{oid}'")
         user = User.objects.get(id=oid)
         user.delete()
+        # after the write, or a concurrent find could cache the user again
+        get_user_cache().invalidate(user)
 
 
 class EMailController:
@@ -102,6 +434,70 @@ class EMailController:
 
         return email
 
+    @classmethod
+    def find_raw(cls, oid: str, fields: list = None) -> dict:
+        """Find an email and return its raw content
+
+        :param oid: the ObjectId of the document
+        :param fields: the only fields to return (default to all)
+        :return: EMail's raw document matching the id
+        """
+
+        return find_raw(EMail, oid, fields)
+
+    @classmethod
+    def find_emails(cls, sender: str = None, since: int = None, until: int = None, sort: str = 'id',
+                    after: list = None, limit: int = 100) -> list:
+        """Find a page of emails in the order of their ids or of their sending times
+
+        :param sender: the ObjectId of the sender of the emails
+        :param since: the minimum sending time of the emails
+        :param until: the sending time the emails are due before
+        :param sort: 'id' or 'sendAt', then id
+        :param after: the sort keys of the last email of the previous page (None for the first page)
+        :param limit: the maximum number of emails
+        :return: the raw documents of the emails
+        """
+
+        return find_page(EMail, cls.emails_query(sender, since, until), cls.sort_keys(sort), after, limit)
+
+    @classmethod
+    def export_emails(cls, sender: str = None, since: int = None, until: int = None, fields: list = None,
+                      after: list = None, batch_size: int = 1000):
+        """Iterate over the emails in the order of their ids (see export_documents())
+
+        :param sender: the ObjectId of the sender of the emails
+        :param since: the minimum sending time of the emails
+        :param until: the sending time the emails are due before
+        :param fields: the only fields to export (default to all)
+        :param after: the id of the last email already exported, as a list (None to start from the first email)
+        :param batch_size: the number of emails of each batch read from the server
+        :return: the iterator over the raw documents of the emails
+        """
+
+        return export_documents(EMail, cls.emails_query(sender, since, until), fields, after, batch_size)
+
+    @classmethod
+    def emails_query(cls, sender: str = None, since: int = None, until: int = None) -> dict:
+        """Return the pymongo filter of the emails of a sender, due in a range of time"""
+
+        query = {}
+        if sender is not None:
+            if not ObjectId.is_valid(sender):
+                raise InvalidId(f"Invalid ObjectId '{sender}'")
+            query['sender'] = ObjectId(sender)
+        if since is not None or until is not None:
+            query['sendAt'] = {key: value for key, value in (('$gte', since), ('$lt', until)) if value is not None}
+        return query
+
+    @classmethod
+    def sort_keys(cls, sort: str) -> tuple:
+        """Return the keys in the database of an order of the emails, 'id' or 'sendAt'"""
+
+        if sort not in ('id', 'sendAt'):
+            raise ValidationError(f"Invalid sort '{sort}', 'id' or 'sendAt' expected")
+        return ('sendAt', '_id') if sort == 'sendAt' else ('_id',)
+
     @classmethod
     def create_email(cls, raw_email: dict) -> EMail:
         """Create a new email and return it
@@ -113,18 +509,52 @@ class EMailController:
         # Reckon sending time
         if raw_email.get('sendAt', 0) > 0:
             raw_email['sendAt'] = TimeCalc.arg_to_timestamp(raw_email['sendAt'])
-        email = EMail(**raw_email)
+        email = EMail(**dict(raw_email, sentAt=0))
         email.save()
         cls.schedule_email(email)
 
         return email
 
     @classmethod
-    def update_email(cls, oid: str, updated_email: dict) -> EMail:
-        """Update an email and return it
+    def create_emails(cls, raw_emails: list) -> list:
+        """Create new emails with a single bulk insert and schedule them with a single bulk operation
+
+        :param raw_emails: the properties of each document
+        :return: the per-item results, holding either the id of the new email or the error met
+        """
+
+        results = [None] * len(raw_emails)
+        emails = []
+        for index, raw_email in enumerate(raw_emails):
+            try:
+                if not isinstance(raw_email, dict):
+                    raise ValidationError(f"Item {index} is not an object")
+                raw_email = dict(raw_email)
+                # Reckon sending time
+                if raw_email.get('sendAt'):
+                    raw_email['sendAt'] = TimeCalc.arg_to_timestamp(raw_email['sendAt'])
+                email = EMail(**dict(raw_email, sentAt=0))
+                email.validate()
+            except (ValidationError, FieldDoesNotExist, ValueError, TypeError) as exc:
+                results[index] = {'index': index, 'error': str(exc)}
+            else:
+                emails.append((index, email))
+
+        if emails:
+            EMail.objects.insert([email for _, email in emails], load_bulk=False)
+            cls.schedule_emails([email for _, email in emails])
+            for index, email in emails:
+                results[index] = {'index': index, '_id': str(email.id), 'sendAt': email.sendAt}
+
+        return results
+
+    @classmethod
+    def update_email(cls, oid: str, updated_email: dict, fields: list = None) -> EMail:
+        """Update an email and return it, rescheduling it if its sending or sent time changed
 
         :param updated_email: the properties to update in the document
         :param oid: the ObjectId of the document
+        :param fields: the only fields to return (default to all)
         :return: the updated EMail
         """
 
@@ -133,11 +563,15 @@ class EMailController:
         # Reckon sending time
         if int(updated_email.get('sendAt', 0)) > 0:
             updated_email['sendAt'] = TimeCalc.arg_to_timestamp(updated_email['sendAt'])
-        email = EMail.objects(id=oid).modify(**updated_email)
+        email, changed = modify_one_changes(EMail, oid, updated_email, ['sendAt', 'sentAt'], fields)
         if not email:
             raise DoesNotExist(f"Can not find email with id '{oid}'")
-        email = EMail.objects.get(id=oid)
-        cls.schedule_email(email)
+        if 'sendAt' in changed and email.sentAt and 'sentAt' not in changed:
+            # A rescheduled email is pending again, unless its sending time changed again since
+            if EMail.objects(id=email.id, sendAt=email.sendAt).update(set__sentAt=0):
+                email.sentAt = 0
+        if changed:
+            cls.schedule_email(email)
 
         return email
 
@@ -158,39 +592,181 @@ class EMailController:
     @classmethod
     def schedule_email(cls, email: EMail) -> int:
         """"""
-        if email.sendAt > 0:
-            # replace_existing is set to true. This would then also update an existing job's schedule.
-            raw_date = TimeCalc.timestamp_to_datetime(email.sendAt)
-            cls.unschedule_email(email)
-            g.scheduler.add_job(
-                EMailController.send_email,
-                'date', run_date=raw_date,
-                args=[str(email.id)],
-                id=str(email.id),
-                replace_existing=True
+        dispatcher = getattr(g, 'dispatcher', None)
+        if dispatcher is not None:
+            sharding = getattr(g, 'sharding', None)
+            if sharding is not None and not sharding.owns(email.id):
+                # The instance owning the email partition loads it on its next renewal
+                return 1 if email.sendAt > 0 else 0
+            if email.sendAt > 0:
+                return dispatcher.schedule(str(email.id), email.sendAt)
+            return -dispatcher.cancel(str(email.id))
+        if current_app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'bucket':
+            return cls.schedule_bucket(email.sendAt) if email.sendAt > 0 else 0
+        # An existing job's schedule is replaced, or deleted when the email is not scheduled anymore
+        return jobs().upsert_or_cancel(str(email.id), cls._email_job(email) if email.sendAt > 0 else None)
+
+    @classmethod
+    def schedule_emails(cls, emails: list) -> int:
+        """Schedule several new emails at once, with a single bulk operation on the job store
+
+        :param emails: the new EMail documents
+        :return: the number of scheduled emails
+        """
+
+        due_emails = [email for email in emails if email.sendAt > 0]
+        dispatcher = getattr(g, 'dispatcher', None)
+        if dispatcher is not None:
+            return dispatcher.schedule_many((str(email.id), email.sendAt) for email in due_emails)
+        if current_app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'bucket':
+            jobs().bulk_upsert_or_cancel(
+                (f"emails@{second}", cls._bucket_job(second)) for second in {email.sendAt for email in due_emails}
             )
-            return 1
-        else:
-            # any existing job's schedule has to be deleted.
-            ret = cls.unschedule_email(email)
-            return ret if ret == 0 else -1
+            return len(due_emails)
+        upserted, _ = jobs().bulk_upsert_or_cancel((str(email.id), cls._email_job(email)) for email in due_emails)
+        return upserted
 
     @classmethod
     def unschedule_email(cls, email: EMail) -> int:
         """"""
 
-        if g.scheduler.get_job(str(email.id)) is not None:
-            g.scheduler.remove_job(str(email.id))
-            return 1
-        else:
+        dispatcher = getattr(g, 'dispatcher', None)
+        if dispatcher is not None:
+            return dispatcher.cancel(str(email.id))
+        if current_app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'bucket':
+            # the bucket job is shared with other emails, its range query will just skip this one
             return 0
+        return jobs().cancel(str(email.id))
+
+    @classmethod
+    def schedule_bucket(cls, second: int) -> int:
+        """Schedule the job sending every email due at a given second, shared by all of these emails
+
+        :param second: the timestamp the emails are due at
+        :return: 1 as the bucket job is scheduled
+        """
+
+        return jobs().upsert_or_cancel(f"emails@{second}", cls._bucket_job(second))
+
+    @classmethod
+    def _email_job(cls, email: EMail) -> dict:
+        """Return the add_job() keyword arguments of the job sending an email"""
+
+        return {
+            'func': EMailController.send_email,
+            'trigger': 'date', 'run_date': TimeCalc.timestamp_to_datetime(email.sendAt),
+            'args': [str(email.id)],
+            'executor': executor_for('email')
+        }
+
+    @classmethod
+    def _bucket_job(cls, second: int) -> dict:
+        """Return the add_job() keyword arguments of the job sending every email due at a given second"""
+
+        return {
+            'func': EMailController.send_due_emails,
+            'trigger': 'date', 'run_date': TimeCalc.timestamp_to_datetime(second),
+            'args': [second, second + 1],
+            'executor': executor_for('email')
+        }
 
     @classmethod
     def send_email(cls, oid: str) -> None:
         """"""
 
-        email = cls.find(oid)
-        logger.info(f"*** Sending email : {email.to_json()}")
+        cls.send_emails([cls.find(oid)])
+
+    @classmethod
+    def send_bucket(cls, second: int, oids: list) -> None:
+        """Send every email of a dispatcher bucket
+
+        :param second: the timestamp the emails are due at
+        :param oids: the ObjectIds of the emails expected in the bucket
+        """
+
+        sent = cls.send_due_emails(second, second + 1)
+        if sent != len(oids):
+            logger.debug(f"Bucket {second} expected {len(oids)} emails, {sent} were due")
+
+    @classmethod
+    def send_due_emails(cls, t0: int, t1: int, oids: list = None) -> int:
+        """Send every pending email due in [t0, t1) fetched with a single range query
+
+        :param t0: the lower bound (inclusive) of the sending times
+        :param t1: the upper bound (exclusive) of the sending times
+        :param oids: only send the emails among these ObjectIds (None = every email due)
+        :return: the number of sent emails
+        """
+
+        emails = EMail.objects(sentAt=0, sendAt__gte=max(t0, 1), sendAt__lt=t1).hint('pending_emails')
+        if oids is not None:
+            emails = emails.filter(id__in=oids)
+        emails = list(emails.no_dereference())
+        return cls.send_emails(emails) if emails else 0
+
+    @classmethod
+    def send_emails(cls, emails: list) -> int:
+        """Claim a batch of pending emails, send the claimed ones and mark them as sent
+
+        The emails are claimed with a single update setting sentAt to a negative token of the batch, so that an email
+        is only sent by the sender claiming it, whatever the concurrent senders (another instance, a dispatcher
+        rebuilt meanwhile...). An email claimed by a sender dying before marking it as sent is not sent again.
+
+        :param emails: the EMail documents to send
+        :return: the number of sent emails
+        """
+
+        collection = EMail._get_collection()
+        claim = -1 - secrets.randbits(48)
+        oids = [email.id for email in emails]
+        claimed = collection.update_many({'_id': {'$in': oids}, 'sentAt': 0}, {'$set': {'sentAt': claim}})
+        if claimed.modified_count < len(oids):
+            # Some emails were sent, or claimed by another sender, in the meantime
+            claimed_oids = {son['_id'] for son in collection.find({'_id': {'$in': oids}, 'sentAt': claim}, {'_id': 1})}
+            emails = [email for email in emails if email.id in claimed_oids]
+        for email in emails:
+            logger.info(f"*** Sending email : {encoding.dumps(email).decode()}")
+        if emails:
+            collection.update_many({'_id': {'$in': [email.id for email in emails]}, 'sentAt': claim},
+                                   {'$set': {'sentAt': int(datetime.now().timestamp())}})
+        return len(emails)
+
+    @classmethod
+    def pending_schedules(cls, until: int = None, since: int = None) -> list:
+        """List the emails which are scheduled and not sent yet, from the pending_emails index only
+
+        :param until: only list the emails due before this timestamp (None = every pending email)
+        :param since: only list the emails due from this timestamp (None = every pending email)
+        :return: the (oid, sendAt) pairs of the pending emails
+        """
+
+        return [(str(email['_id']), email['sendAt']) for email in cls.pending_query(since, until)]
+
+    @classmethod
+    def pending_query(cls, since: int = None, until: int = None):
+        """Return the query of the pending emails due in [since, until), projected on id and sendAt so it runs as an
+        index-only scan of the pending_emails index
+
+        :param since: the lower bound (inclusive) of the sending times (None = no bound)
+        :param until: the upper bound (exclusive) of the sending times (None = no bound)
+        :return: the raw query set
+        """
+
+        emails = EMail.objects(sentAt=0, sendAt__gte=max(since or 0, 1))
+        if until is not None:
+            emails = emails.filter(sendAt__lt=until)
+        return emails.only('id', 'sendAt').hint('pending_emails').as_pymongo()
+
+    @classmethod
+    def backfill_sent_at(cls) -> int:
+        """Mark the emails saved before the sentAt field existed as pending, so that they are sent (once, after the
+        deployment of the field)
+
+        :return: the number of emails marked as pending
+        """
+
+        result = EMail._get_collection().update_many({'sentAt': {'$exists': False}}, {'$set': {'sentAt': 0}})
+        return result.modified_count
 
 
 class InvoiceController:
@@ -210,6 +786,62 @@ class InvoiceController:
 
         return invoice
 
+    @classmethod
+    def find_raw(cls, oid: str, fields: list = None) -> dict:
+        """Find an invoice and return its raw content
+
+        :param oid: the ObjectId of the document
+        :param fields: the only fields to return (default to all)
+        :return: Invoice's raw document matching the id
+        """
+
+        return find_raw(Invoice, oid, fields)
+
+    @classmethod
+    def find_invoices(cls, sender: str = None, recipient: str = None, notify: bool = None, after: list = None,
+                      limit: int = 100) -> list:
+        """Find a page of invoices in the order of their ids
+
+        :param sender: the ObjectId of the sender of the invoices
+        :param recipient: the ObjectId of the recipient of the invoices
+        :param notify: whether the recipient of the invoices is notified
+        :param after: the id of the last invoice of the previous page, as a list (None for the first page)
+        :param limit: the maximum number of invoices
+        :return: the raw documents of the invoices
+        """
+
+        return find_page(Invoice, cls.invoices_query(sender, recipient, notify), ('_id',), after, limit)
+
+    @classmethod
+    def export_invoices(cls, sender: str = None, recipient: str = None, notify: bool = None, fields: list = None,
+                        after: list = None, batch_size: int = 1000):
+        """Iterate over the invoices in the order of their ids (see export_documents())
+
+        :param sender: the ObjectId of the sender of the invoices
+        :param recipient: the ObjectId of the recipient of the invoices
+        :param notify: whether the recipient of the invoices is notified
+        :param fields: the only fields to export (default to all)
+        :param after: the id of the last invoice already exported, as a list (None to start from the first invoice)
+        :param batch_size: the number of invoices of each batch read from the server
+        :return: the iterator over the raw documents of the invoices
+        """
+
+        return export_documents(Invoice, cls.invoices_query(sender, recipient, notify), fields, after, batch_size)
+
+    @classmethod
+    def invoices_query(cls, sender: str = None, recipient: str = None, notify: bool = None) -> dict:
+        """Return the pymongo filter of the invoices of a sender or a recipient, notified or not"""
+
+        query = {}
+        for key, oid in (('sender', sender), ('recipient', recipient)):
+            if oid is not None:
+                if not ObjectId.is_valid(oid):
+                    raise InvalidId(f"Invalid ObjectId '{oid}'")
+                query[key] = ObjectId(oid)
+        if notify is not None:
+            query['notify'] = notify
+        return query
+
     @classmethod
     def create_invoice(cls, raw_invoice: dict) -> Invoice:
         """Create a new invoice and return it
@@ -224,20 +856,25 @@ class InvoiceController:
         return invoice
 
     @classmethod
-    def update_invoice(cls, oid: str, updated_invoice: dict) -> Invoice:
-        """Update a invoice and return it
+    def update_invoice(cls, oid: str, updated_invoice: dict, fields: list = None) -> Invoice:
+        """Update a invoice and return it, rescheduling it if its periodicity changed
 
         :param oid: the ObjectId of the document
         :param updated_invoice: the properties to update in the document
+        :param fields: the only fields to return (default to all)
         :return: the updated Invoice
         """
 
         if not ObjectId.is_valid(oid):
             raise InvalidId(f"Invalid ObjectId '{oid}'")
-        invoice = Invoice.objects(id=oid).modify(**updated_invoice)
+        invoice, changed = modify_one_changes(Invoice, oid, updated_invoice,
+                                              ['periodicity', 'billingRule', 'timezone'], fields)
         if not invoice:
             raise DoesNotExist(f"Can not find invoice with id '{oid}'")
-        invoice = Invoice.objects.get(id=oid)
+        if changed.keys() & {'billingRule', 'timezone'}:
+            cls.reschedule_billing(invoice)
+        elif 'periodicity' in changed and not invoice.billingRule:
+            cls.reschedule_invoice(invoice)
 
         return invoice
 
@@ -251,23 +888,126 @@ class InvoiceController:
         if not ObjectId.is_valid(oid):
             raise InvalidId(f"Invalid ObjectId '{oid}'")
         invoice = Invoice.objects.get(id=oid)
+        cls.unschedule_invoice(invoice)
+        BillingRun._get_collection().delete_many({'invoice': invoice.id})
         invoice.delete()
 
     @classmethod
-    def generate_invoice(cls, oid: str) -> None:
-        """"""
+    def find_billing_runs(cls, since: int = None, until: int = None, after: list = None, limit: int = 100) -> list:
+        """Find a page of the planned billing runs due in a window, in the order of their times, with a single range
+        query
+
+        :param since: the minimum time of the runs
+        :param until: the time the runs are due before
+        :param after: the (runAt, id) of the last run of the previous page (None for the first page)
+        :param limit: the maximum number of runs
+        :return: the raw documents of the runs
+        """
+
+        return list(cls.billing_runs_query(since, until, after, limit))
+
+    @classmethod
+    def billing_runs_query(cls, since: int = None, until: int = None, after: list = None, limit: int = 100):
+        """Return the query of a page of the billing runs due in a window, projected on the fields of the (runAt, id,
+        invoice) index so it runs as an index-only scan (see find_billing_runs())
+
+        :return: the pymongo cursor of the raw documents of the runs
+        """
+
+        query = {}
+        if since is not None:
+            query.setdefault('runAt', {})['$gte'] = since
+        if until is not None:
+            query.setdefault('runAt', {})['$lt'] = until
+        return page_query(BillingRun, query, ('runAt', '_id'), after, limit, ['id', 'runAt', 'invoice'])
+
+    @classmethod
+    def plan_billing_runs(cls, invoices: Iterable = None, count: int = None, now: int = None,
+                          batch_size: int = 1000) -> int:
+        """Plan the next runs of invoices billed on calendar dates, replacing the runs planned before. The runs are
+        computed once per billing rule and timezone, and written with a delete and a bulk write per batch of invoices.
+
+        :param invoices: the invoices (Documents or raw documents), default to every invoice with a billing rule. The
+            runs of an invoice without billing rule are removed.
+        :param count: the number of runs planned ahead (default to BILLING_RUNS_AHEAD)
+        :param now: the timestamp the runs are due after (default to now)
+        :param batch_size: the number of invoices whose runs are written at once
+        :return: the number of runs planned
+        """
+
+        count = count or current_app.config.get('BILLING_RUNS_AHEAD')
+        now = now or int(datetime.now().timestamp())
+        if invoices is None:
+            invoices = Invoice.objects(billingRule__exists=True).only('id', 'billingRule', 'timezone') \
+                .hint('calendar_invoices').as_pymongo()
+        collection = BillingRun._get_collection()
+        planned = 0
+        outdated, upserts = [], []
+        for index, invoice in enumerate(invoices, 1):
+            if isinstance(invoice, Invoice):
+                invoice = {'_id': invoice.id, 'billingRule': invoice.billingRule, 'timezone': invoice.timezone}
+            runs = []
+            if invoice.get('billingRule'):
+                runs = list(billing.next_runs(invoice['billingRule'], invoice.get('timezone') or 'utc', now, count))
+            outdated.append({'invoice': invoice['_id'], 'runAt': {'$nin': runs}})
+            upserts.extend(ReplaceOne({'invoice': invoice['_id'], 'runAt': run_at},
+                                      {'invoice': invoice['_id'], 'runAt': run_at}, upsert=True) for run_at in runs)
+            planned += len(runs)
+            if index % batch_size == 0:
+                cls._write_billing_runs(collection, outdated, upserts)
+                outdated, upserts = [], []
+        if outdated:
+            cls._write_billing_runs(collection, outdated, upserts)
+
+        return planned
+
+    @classmethod
+    def schedule_billing_plan(cls) -> int:
+        """Schedule the daily planning of the runs of every invoice with a billing rule, at BILLING_PLAN_HOUR (UTC)
+
+        Each run of an invoice plans its next runs: the daily planning keeps BILLING_RUNS_AHEAD runs planned for every
+        invoice in between, whatever the runs removed or the BILLING_RUNS_AHEAD configured since.
+
+        :return: 1 if the planning is scheduled, -1 if it is unscheduled, 0 if there was no planning to unschedule
+        """
+
+        hour = current_app.config.get('BILLING_PLAN_HOUR')
+        return jobs().upsert_or_cancel(BILLING_PLAN_JOB, None if hour is None else {
+            'func': InvoiceController.plan_billing_runs,
+            'trigger': 'cron', 'hour': hour, 'timezone': 'UTC',
+            'kwargs': {'count': current_app.config.get('BILLING_RUNS_AHEAD')},
+            'executor': executor_for('invoice')
+        })
+
+    @classmethod
+    def _write_billing_runs(cls, collection, outdated: list, upserts: list) -> None:
+        """Remove the runs of a batch of invoices which are not planned anymore, then upsert the runs planned"""
+        collection.delete_many({'$or': outdated})
+        if upserts:
+            collection.bulk_write(upserts, ordered=False)
+
+    @classmethod
+    def generate_invoice(cls, oid: str, scheduled: bool = False) -> None:
+        """Generate an invoice, then start its periodic generation if it is not scheduled yet
+
+        :param oid: the ObjectId of the document
+        :param scheduled: True when run by the invoice's own periodic job
+        """
         invoice = cls.find(oid)
-        # scd = get_scheduler()
-        cls.unschedule_invoice(invoice)
-        logger.info(f"*** Generated invoice : {invoice.to_json()}")
+        logger.info(f"*** Generated invoice : {encoding.dumps(invoice).decode()}")
 
         if invoice.notify:
-            recipient = UserController.find(str(invoice.recipient.id))
+            with no_dereference(Invoice):
+                # the users are looked up by id, through the users cache
+                sender_id, recipient_id = str(invoice.sender.id), str(invoice.recipient.id)
+            recipient = UserController.find(recipient_id)
             if invoice.notifyAt >= 0:
-                send_at = TimeCalc.today_trigger(invoice.notifyAt)
+                send_at = TimeCalc.today_trigger(invoice.notifyAt, invoice.timezone or recipient.timezone)
+                # the notifications due at the same round time are spread, each invoice keeping its own delay
+                send_at = get_load_spreader().spread(str(invoice.id), send_at)
                 email = EMailController.create_email(
                     {
-                        'sender': str(invoice.sender.id),
+                        'sender': sender_id,
                         'recipient': recipient.emailAddress,
                         'title': f"Your invoice {invoice.reference}",
                         'content': 'Please find below our small invoice for this hard work.',
@@ -277,7 +1017,7 @@ class InvoiceController:
             else:
                 email = EMailController.create_email(
                     {
-                        'sender': str(invoice.sender.id),
+                        'sender': sender_id,
                         'recipient': recipient.emailAddress,
                         'title': f"Your invoice {invoice.reference}",
                         'content': 'Please find below our small invoice for this hard work.'
@@ -285,29 +1025,96 @@ class InvoiceController:
                 )
                 EMailController.send_email(str(email.id))
 
-        if invoice.periodicity > 0:
-            raw_date = TimeCalc.timestamp_to_datetime(
-                TimeCalc.next_run_timestamp(invoice.periodicity)
-            )
-            cls.unschedule_invoice(invoice)
-            g.scheduler.add_job(
-            # scd.add_job(
-                InvoiceController.generate_invoice,
-                'date', run_date=raw_date,
-                args=[str(invoice.id)],
-                id=str(invoice.id),
-                replace_existing=True
-            )
-        else:
+        if invoice.billingRule:
+            if scheduled or jobs().get_job(str(invoice.id)) is None:
+                # The job of a billing rule runs once, each run schedules the next one
+                cls.schedule_invoice(invoice)
+        elif invoice.periodicity <= 0:
             # any existing job's schedule has to be deleted.
             cls.unschedule_invoice(invoice)
+        elif not scheduled and jobs().get_job(str(invoice.id)) is None:
+            # The periodic job keeps running on its own once started
+            cls.schedule_invoice(invoice)
+
+    @classmethod
+    def schedule_invoice(cls, invoice: Invoice, anchor: datetime = None) -> int:
+        """Schedule the periodic generation of an invoice with a single interval trigger
+
+        The interval trigger plans every run from the anchor (anchor + n * periodicity), not from the end of the
+        previous run, so the schedule does not drift.
+        An invoice with a billing rule is scheduled on its next run instead, once its next runs are planned.
+
+        :param invoice: the invoice to schedule
+        :param anchor: the planned time the periodicity is counted from (default to now)
+        :return: 1 if the invoice is scheduled, else 0
+        """
+
+        if invoice.billingRule:
+            now = int(datetime.now().timestamp())
+            cls.plan_billing_runs([invoice], now=now)
+            runs = billing.next_runs(invoice.billingRule, invoice.timezone or 'utc', now,
+                                     current_app.config.get('BILLING_RUNS_AHEAD'))
+            if not runs:
+                cls.unschedule_invoice(invoice)
+                return 0
+            return jobs().upsert_or_cancel(str(invoice.id), {
+                'func': InvoiceController.generate_invoice,
+                'trigger': 'date', 'run_date': TimeCalc.timestamp_to_datetime(runs[0]),
+                'args': [str(invoice.id), True],
+                'executor': executor_for('invoice')
+            })
+        if invoice.periodicity <= 0:
+            return 0
+        anchor = anchor or TimeCalc.timestamp_to_datetime(int(datetime.now().timestamp()))
+        return jobs().upsert_or_cancel(str(invoice.id), {
+            'func': InvoiceController.generate_invoice,
+            'trigger': 'interval', 'seconds': invoice.periodicity,
+            'start_date': anchor + timedelta(seconds=invoice.periodicity),
+            'args': [str(invoice.id), True],
+            'executor': executor_for('invoice')
+        })
+
+    @classmethod
+    def reschedule_invoice(cls, invoice: Invoice) -> int:
+        """Reschedule in place the periodic job of an invoice whose periodicity is updated
+
+        The new periodicity is counted from the last planned run (the next run less the interval of the job), so the
+        schedule stays aligned.
+
+        :param invoice: the updated invoice
+        :return: 1 if the invoice is rescheduled, 0 if it is not scheduled, -1 if it is unscheduled
+        """
+
+        job = jobs().get_job(str(invoice.id))
+        if job is None:
+            return 0
+        if invoice.periodicity <= 0:
+            cls.unschedule_invoice(invoice)
+            return -1
+        anchor = None
+        interval = job_interval(job)
+        if job.next_run_time is not None and interval:
+            anchor = job.next_run_time - timedelta(seconds=interval)
+        return cls.schedule_invoice(invoice, anchor)
+
+    @classmethod
+    def reschedule_billing(cls, invoice: Invoice) -> int:
+        """Reschedule the job of an invoice whose billing rule or timezone changed, planning its runs again
+
+        :param invoice: the updated invoice
+        :return: 1 if the invoice is rescheduled, 0 if it is not scheduled, -1 if it is unscheduled
+        """
+
+        if jobs().get_job(str(invoice.id)) is None:
+            return 0
+        if not invoice.billingRule:
+            cls.plan_billing_runs([invoice])  # removes the runs planned
+            if invoice.periodicity <= 0:
+                cls.unschedule_invoice(invoice)
+                return -1
+        return cls.schedule_invoice(invoice)
 
     @classmethod
     def unschedule_invoice(cls, invoice: Invoice) -> int:
         """"""
-        # scd = get_scheduler()
-        if g.scheduler.get_job(str(invoice.id)) is not None:
-            g.scheduler.remove_job(str(invoice.id))
-            return 1
-        else:
-            return 0
+        return jobs().cancel(str(invoice.id))
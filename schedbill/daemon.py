@@ -0,0 +1,69 @@
+"""Standalone scheduler daemon (schedbill-scheduler), running the executors apart from the web workers.
+
+The web workers run with APP_ROLE = 'web' and only record schedule intents, which this daemon applies to its scheduler.
+
+    python -m schedbill.daemon --config production --metrics-port 9100
+"""
+from flask import Flask
+import argparse
+import logging
+import signal
+import threading
+from schedbill import create_app, config
+import metrics
+
+logger = logging.getLogger()
+
+CONFIGURATIONS = {
+    'production': config.ProductionConfiguration,
+    'development': config.DevelopmentConfiguration,
+    'testing': config.TestingConfiguration,
+}
+
+
+def shutdown(app: Flask) -> None:
+    """Stop the scheduling objects of the application, the intents consumer first
+
+    :param app: the application created with the 'scheduler' role
+    """
+
+    scheduling = app.extensions.get('schedbill', {})
+    if 'intents' in scheduling:
+        scheduling['intents'].shutdown()
+    if 'sharding' in scheduling:
+        scheduling['sharding'].shutdown()
+    elif 'dispatcher' in scheduling:
+        scheduling['dispatcher'].shutdown()
+    if 'scheduler' in scheduling:
+        scheduling['scheduler'].shutdown()
+
+
+def main(argv: list = None) -> int:
+    """Run the scheduler daemon until SIGTERM or SIGINT
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-scheduler', description=__doc__.splitlines()[0])
+    parser.add_argument('--config', choices=CONFIGURATIONS, default='development', help='configuration to use')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='port serving the scheduler metrics in the Prometheus text format (0 = not served)')
+    args = parser.parse_args(argv)
+
+    app = create_app(CONFIGURATIONS[args.config], role='scheduler')
+    metrics_server = metrics.serve(args.metrics_port) if args.metrics_port else None
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    logger.info(f"Scheduler daemon started with the {args.config} configuration")
+    stopped.wait()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    shutdown(app)
+    logger.info('Scheduler daemon stopped')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
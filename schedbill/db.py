@@ -1,55 +1,258 @@
 import mongoengine
-from flask import current_app, g
+from flask import current_app, g, Response
 from flask_mongoengine import MongoEngine
+from collections.abc import Mapping
+from contextlib import contextmanager
 import logging
+import os
+import threading
+import time
 import config
-from pymongo import monitoring
+import metrics
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
 from pymongo.monitoring import CommandStartedEvent, CommandSucceededEvent, CommandFailedEvent
 
 
 logger = logging.getLogger()
 
 
-# class CommandLogger(monitoring.CommandListener):
-#     """This class extends a utility class provided by pymongo.monitoring.
-#      It is going to monitor and log the MongoDB driver events."""
-#
-#     def started(self, event: "CommandStartedEvent") -> None:
-#         """"""
-#         logger.debug(
-#             "Command {0.command_name} (0.request_id) started on server {0.connection_id}".format(
-#                 event
-#             )
-#         )
-#
-#     def succeeded(self, event: "CommandSucceededEvent") -> None:
-#         """"""
-#         logger.debug(
-#             "Command {0.command_name} (0.request_id) started on server {0.connection_id} "
-#             "succeeded in {0.duration_micros} microseconds.".format(
-#                 event
-#             )
-#         )
-#
-#     def failed(self, event: "CommandFailedEvent") -> None:
-#         """"""
-#         logger.debug(
-#             "Command {0.command_name} (0.request_id) started on server {0.connection_id} "
-#             "failed in {0.duration_micros} microseconds.".format(
-#                 event
-#             )
-#         )
+class CommandProfile:
+    """The MongoDB commands run by a Flask request or a scheduler job"""
+
+    __slots__ = ('commands', 'duration_micros', 'slowest_command', 'slowest_micros')
+
+    def __init__(self) -> None:
+        self.commands = 0
+        self.duration_micros = 0
+        self.slowest_command = None
+        self.slowest_micros = 0
+
+    def server_timing(self) -> str:
+        """Return the profile as the value of a Server-Timing header (durations in milliseconds)"""
+        timing = f'db;desc="{self.commands} MongoDB commands";dur={self.duration_micros / 1000:.3f}'
+        if self.slowest_command is not None:
+            timing += f', db-slowest;desc="{self.slowest_command}";dur={self.slowest_micros / 1000:.3f}'
+        return timing
+
+
+class _ProfilerState(threading.local):
+    profile = None
+    command = None
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """This class extends a utility class provided by pymongo.monitoring.
+    It adds the commands up into the profile of the current thread, i.e. of the Flask request or the scheduler job it
+    runs, and logs the commands slower than a threshold. Nothing is formatted unless a command is slow."""
+
+    def __init__(self, slow_ms: float = 100) -> None:
+        self.slow_micros = slow_ms * 1000
+        self._state = _ProfilerState()
+
+    def start(self) -> CommandProfile:
+        """Start the profile of the current thread, replacing any profile in progress"""
+        profile = self._state.profile = CommandProfile()
+        return profile
+
+    def stop(self) -> CommandProfile:
+        """Stop the profile of the current thread and return it (None if not started)"""
+        profile, self._state.profile = self._state.profile, None
+        return profile
+
+    @contextmanager
+    def profile(self):
+        """Profile the commands run in the with block, resuming the enclosing profile if any afterwards"""
+        enclosing = self._state.profile
+        try:
+            yield self.start()
+        finally:
+            self._state.profile = enclosing
+
+    def started(self, event: "CommandStartedEvent") -> None:
+        self._state.command = event.command  # only read to log a slow command
+
+    def succeeded(self, event: "CommandSucceededEvent") -> None:
+        self._record(event, 'succeeded')
+
+    def failed(self, event: "CommandFailedEvent") -> None:
+        self._record(event, 'failed')
+
+    def _record(self, event, outcome: str) -> None:
+        state = self._state
+        micros = event.duration_micros
+        profile = state.profile
+        if profile is not None:
+            profile.commands += 1
+            profile.duration_micros += micros
+            if micros > profile.slowest_micros:
+                profile.slowest_micros = micros
+                profile.slowest_command = event.command_name
+        if micros >= self.slow_micros:
+            logger.warning(f"Slow MongoDB command {event.command_name} {outcome} in {micros / 1000:.1f} ms "
+                           f"on {event.database_name} : {str(state.command)[:1000]}")
+        state.command = None
+
+
+COMMAND_PROFILER = CommandProfiler()
+
+
+def load_profiler() -> None:
+    """Profile the MongoDB commands of each request, returned in the Server-Timing header of the response"""
+
+    @current_app.before_request
+    def start_db_profile() -> None:
+        COMMAND_PROFILER.start()
+
+    @current_app.after_request
+    def add_server_timing(response: Response) -> Response:
+        profile = COMMAND_PROFILER.stop()
+        if profile is not None:
+            response.headers.add('Server-Timing', profile.server_timing())
+        return response
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """This class extends a utility class provided by pymongo.monitoring.
+    It counts the open and checked out connections of each pool and measures the checkout wait times (CMAP events),
+    which are exposed as metrics."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the counts, e.g. of the pools inherited from a parent process"""
+        self._lock = threading.Lock()
+        self._open = {}
+        self._in_use = {}
+
+    def stats(self) -> dict:
+        """Return the number of open and checked out connections of each pool, by server address"""
+        with self._lock:
+            return {address: {'open': self._open.get(address, 0), 'in_use': self._in_use.get(address, 0)}
+                    for address in set(self._open) | set(self._in_use)}
+
+    def _count(self, counts: dict, state: str, event, amount: int) -> None:
+        address = '{0}:{1}'.format(*event.address)
+        with self._lock:
+            counts[address] = counts.get(address, 0) + amount
+            metrics.DB_POOL_CONNECTIONS.set(address, state, value=counts[address])
+
+    def connection_created(self, event: "monitoring.ConnectionCreatedEvent") -> None:
+        self._count(self._open, 'open', event, 1)
+
+    def connection_closed(self, event: "monitoring.ConnectionClosedEvent") -> None:
+        self._count(self._open, 'open', event, -1)
+
+    def connection_checked_out(self, event: "monitoring.ConnectionCheckedOutEvent") -> None:
+        self._count(self._in_use, 'in_use', event, 1)
+        metrics.DB_POOL_CHECKOUT_WAIT.observe('{0}:{1}'.format(*event.address), value=event.duration)
+
+    def connection_checked_in(self, event: "monitoring.ConnectionCheckedInEvent") -> None:
+        self._count(self._in_use, 'in_use', event, -1)
+
+    def connection_check_out_failed(self, event: "monitoring.ConnectionCheckOutFailedEvent") -> None:
+        metrics.DB_POOL_CHECKOUT_FAILED.inc('{0}:{1}'.format(*event.address), event.reason)
+
+    def connection_check_out_started(self, event: "monitoring.ConnectionCheckOutStartedEvent") -> None:
+        pass
+
+    def connection_ready(self, event: "monitoring.ConnectionReadyEvent") -> None:
+        pass
+
+    def pool_created(self, event: "monitoring.PoolCreatedEvent") -> None:
+        pass
+
+    def pool_ready(self, event: "monitoring.PoolReadyEvent") -> None:
+        pass
+
+    def pool_cleared(self, event: "monitoring.PoolClearedEvent") -> None:
+        logger.warning(f"MongoDB connection pool of {event.address[0]}:{event.address[1]} cleared")
+
+    def pool_closed(self, event: "monitoring.PoolClosedEvent") -> None:
+        pass
+
+
+POOL_STATS = PoolStats()
+
+# The settings the client of this process was created with, to create it again in a forked child
+_client_settings = None
+
+
+def client_settings(conf) -> dict:
+    """Return the settings of the MongoDB client shared by the whole process, as mongoengine.connect() arguments
+
+    The slow command threshold of the commands profiler is set along.
+
+    :param conf: the configuration, a configuration class or the Flask application config
+    :return: the connection URI, the pool, timeouts, compression and write concern options and the listeners
+    """
+
+    def setting(key: str, default=None):
+        return conf.get(key, default) if isinstance(conf, Mapping) else getattr(conf, key, default)
+
+    COMMAND_PROFILER.slow_micros = setting('DB_SLOW_COMMAND_MS', 100) * 1000
+
+    return {
+        'host': setting('DB_URI_FORMAT').format(
+            user=setting('DB_USER'),
+            secret=setting('DB_SECRET'),
+            host=setting('DB_HOST'),
+            db=setting('DB_NAME')
+        ),
+        'maxPoolSize': setting('DB_MAX_POOL_SIZE', 100),
+        'minPoolSize': setting('DB_MIN_POOL_SIZE', 0),
+        'compressors': setting('DB_COMPRESSORS', ''),
+        'connectTimeoutMS': setting('DB_CONNECT_TIMEOUT_MS', 20000),
+        'serverSelectionTimeoutMS': setting('DB_SERVER_SELECTION_TIMEOUT_MS', 30000),
+        'w': setting('DB_WRITE_CONCERN', 'majority'),
+        'event_listeners': [POOL_STATS, COMMAND_PROFILER] if setting('DB_PROFILE', False) else [POOL_STATS]
+    }
+
+
+def warm_up(client, connections: int, timeout: float = 5.0) -> int:
+    """Wait for the pool to open its minimum number of connections, so the first requests do not pay for the handshakes
+
+    :param client: the MongoDB client
+    :param connections: the number of connections to wait for (the minPoolSize of the client)
+    :param timeout: the maximum time (in seconds) to wait for
+    :return: the number of open connections
+    """
+
+    if not isinstance(client, MongoClient) or connections <= 0:
+        return 0
+    client.admin.command('ping')  # discovers the servers, whose pools then fill up to minPoolSize in the background
+    deadline = time.monotonic() + timeout
+    while True:
+        opened = sum(pool['open'] for pool in POOL_STATS.stats().values())
+        if opened >= connections or time.monotonic() >= deadline:
+            logger.debug(f"{opened} MongoDB connections open")
+            return opened
+        time.sleep(0.05)
+
+
+def _reset_after_fork() -> None:
+    """Drop the client inherited from the parent process: a MongoDB client is not fork-safe.
+    The client is created again, with the same settings, on first use in the child."""
+
+    if _client_settings is not None:
+        POOL_STATS.reset()
+        mongoengine.disconnect_all()
+        mongoengine.register_connection(mongoengine.DEFAULT_CONNECTION_NAME, **_client_settings)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def connect_db(conf=config.DevelopmentConfiguration) -> MongoEngine:
     """"""
+    global _client_settings
     conn = None
-    host_config = conf.DB_URI_FORMAT.format(
-        user=conf.DB_USER,
-        secret=conf.DB_SECRET,
-        host=conf.DB_HOST,
-        db=conf.DB_NAME
-    )
+    settings = client_settings(conf)
     try:
-        conn = mongoengine.connect(host=host_config)
+        conn = mongoengine.connect(**settings)
+        _client_settings = settings
+        warm_up(conn, settings['minPoolSize'])
     except Exception as exc:
         logger.error(f"Can not connect to Mongo DB {str(exc)}")
     return conn
@@ -58,22 +261,99 @@ def connect_db(conf=config.DevelopmentConfiguration) -> MongoEngine:
 def get_db() -> MongoEngine:
     """Set the MongoEngine connection up to the MongoDB driver if not already done
 
+    The connection settings are the same for all the applications of the process, so that mongoengine shares a single
+    client (and its connection pool) between them.
+
     :return: the MongoEngine connection
     """
+    global _client_settings
     db =  getattr(g, 'db', None)
     if db is None:
-        current_app.config['MONGODB_SETTINGS'] = {
-            'host': current_app.config.get('DB_URI_FORMAT').format(
-                user=current_app.config.get('DB_USER'),
-                secret=current_app.config.get('DB_SECRET'),
-                host=current_app.config.get('DB_HOST'),
-                db=current_app.config.get('DB_NAME')
-            )
-        }
+        settings = client_settings(current_app.config)
+        current_app.config['MONGODB_SETTINGS'] = settings
         try:
             db = g.db = MongoEngine(current_app)
+            _client_settings = settings
+            warm_up(mongoengine.connection.get_connection(), settings['minPoolSize'])
         except Exception as exc:
             logger.error(f"Can not connect to Mongo DB {str(exc)}")
     return db
 
-# monitoring.register(CommandLogger())
+
+def ensure_indexes(documents: list, poll_interval: float = 5.0) -> dict:
+    """Create the indexes declared in the meta of the documents, reporting the progress of the builds in the logs
+
+    :param documents: the Document classes
+    :param poll_interval: the time (in seconds) between two progress reports
+    :return: the names of the indexes of each collection
+    """
+
+    raw_db = mongoengine.connection.get_db()
+    done = threading.Event()
+    reporter = threading.Thread(
+        target=_report_index_builds,
+        args=(raw_db, done, poll_interval),
+        name='schedbill-indexes',
+        daemon=True
+    )
+    reporter.start()
+    indexes = {}
+    try:
+        for document in documents:
+            started = time.monotonic()
+            # raw collection: mongoengine still runs its own checks on the first use of the document
+            collection = raw_db[document._get_collection_name()]
+            try:
+                for spec in document._meta['index_specs']:
+                    options = {key: value for key, value in spec.items() if key not in ('fields', 'cls')}
+                    collection.create_index(spec['fields'], **options)
+            except PyMongoError as exc:
+                # e.g. duplicates preventing a unique index: the application still runs, with the indexes built
+                logger.error(f"Indexes of {collection.name} can not be created : {exc}")
+            indexes[collection.name] = sorted(collection.index_information())
+            logger.info(f"Indexes of {collection.name} ready in {time.monotonic() - started:.1f}s : "
+                        f"{', '.join(indexes[collection.name])}")
+    finally:
+        done.set()
+        reporter.join()
+    return indexes
+
+
+def _report_index_builds(raw_db, done: threading.Event, poll_interval: float) -> None:
+    """Log the progress of the index builds running on the database until done"""
+
+    while not done.wait(poll_interval):
+        try:
+            operations = raw_db.client.admin.command(
+                'currentOp', {'command.createIndexes': {'$exists': True}, 'ns': {'$regex': f"^{raw_db.name}\\."}}
+            )['inprog']
+        except PyMongoError as exc:
+            logger.info(f"Index builds progress not available : {exc}")
+            return
+        for operation in operations:
+            progress = operation.get('progress', {})
+            if progress.get('total'):
+                percent = f"{100 * progress.get('done', 0) / progress['total']:.0f}%"
+            else:
+                percent = 'in progress'
+            logger.info(f"Index build on {operation.get('ns')} : {operation.get('msg', '')} {percent}".strip())
+
+
+def index_only(queryset) -> bool:
+    """Tell whether a query runs as an index-only (covered) scan, from its explain() winning plan
+
+    :param queryset: the query set (or pymongo cursor) to explain
+    :return: True if the plan scans an index and never fetches the documents
+    """
+
+    plan = queryset.explain()['queryPlanner']['winningPlan']
+    stages = _plan_stages(plan.get('queryPlan', plan))  # queryPlan with the slot based execution engine
+    return any(stage in ('IXSCAN', 'DISTINCT_SCAN', 'COUNT_SCAN') for stage in stages) and \
+        not any(stage in ('FETCH', 'COLLSCAN') for stage in stages)
+
+
+def _plan_stages(plan: dict) -> list:
+    stages = [plan['stage']]
+    for child in plan.get('inputStages', []) + ([plan['inputStage']] if 'inputStage' in plan else []):
+        stages.extend(_plan_stages(child))
+    return stages
@@ -0,0 +1,80 @@
+from bson import json_util
+from flask import current_app, json as flask_json
+from mongoengine import Document
+from mongoengine.queryset import QuerySet
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:  # the standard json module encodes instead, slower
+    orjson = None
+
+logger = logging.getLogger()
+
+# What converts the values which are not BSON types, as Flask does
+_flask_encoder = flask_json.JSONEncoder()
+
+
+def to_json_value(obj):
+    """Convert what JSON can not encode natively, as the JSON encoder of flask-mongoengine did but without walking the
+    whole document first: a Document becomes its raw content, whose ObjectId, datetime... values are converted in turn
+    to their MongoDB extended JSON form ({"$oid": ...}, {"$date": ...}) while they are encoded.
+
+    :param obj: the value to convert
+    :return: the value JSON can encode
+    """
+
+    if isinstance(obj, Document):
+        return obj.to_mongo()
+    if isinstance(obj, QuerySet):
+        return list(obj.as_pymongo())
+    try:
+        return json_util.default(obj)
+    except TypeError:
+        # Not a BSON type (date, UUID, dataclass...)
+        return _flask_encoder.default(obj)
+
+
+def dumps(obj, sort_keys: bool = False, indent: int = None) -> bytes:
+    """Encode to JSON in a single pass, with orjson if installed, Documents and raw documents included
+
+    :param obj: the value to encode
+    :param sort_keys: True to sort the keys of the objects
+    :param indent: None for a compact JSON, else the indentation of a pretty printed JSON (always 2 with orjson)
+    :return: the UTF-8 encoded JSON
+    """
+
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=to_json_value, option=option)
+        except TypeError:
+            # Integers beyond 64 bits, keys which are not strings...: the standard json module knows better
+            pass
+    separators = None if indent else (',', ':')
+    return json.dumps(obj, default=to_json_value, sort_keys=sort_keys, indent=indent, separators=separators,
+                      ensure_ascii=False).encode()
+
+
+class JSONEncoder(flask_json.JSONEncoder):
+    """This class is the JSON encoder of the Flask application (jsonify() and the JSON responses), encoding
+    Documents, raw documents and BSON values with dumps()"""
+
+    def encode(self, o) -> str:
+        return dumps(o, sort_keys=self.sort_keys, indent=self.indent).decode()
+
+    def default(self, o):
+        return to_json_value(o)
+
+
+def load_json_encoder() -> None:
+    """Make the Flask application encode its JSON responses with the JSONEncoder, once flask-mongoengine has set its
+    own up"""
+
+    current_app.json_encoder = JSONEncoder
+    logger.debug(f"JSON responses encoded with {'orjson' if orjson is not None else 'json'}")
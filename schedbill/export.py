@@ -0,0 +1,73 @@
+"""Collections export (schedbill-export), writing the emails or the invoices as NDJSON (one JSON object per line).
+
+The documents are read in the order of their ids by a single server-side cursor, by batches, so the memory used stays
+flat however big the collection is. An interrupted export prints the cursor to resume it from.
+
+    python -m schedbill.export invoices --config ProductionConfiguration --output invoices.ndjson
+    python -m schedbill.export emails --since 1700000000 --cursor WyI2NT...In0= >> emails.ndjson
+"""
+import argparse
+import sys
+import config
+import db
+from controllers import EMailController, InvoiceController, decode_cursor, encode_cursor
+from views import ndjson_line
+
+
+def main(argv: list = None) -> int:
+    """Export a collection, filtered, then print the number of documents exported
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-export', description=__doc__.splitlines()[0])
+    parser.add_argument('collection', choices=['emails', 'invoices'], help='collection to export')
+    parser.add_argument('--config', default='DevelopmentConfiguration', help='configuration class of the database')
+    parser.add_argument('--sender', help='ObjectId of the sender of the documents')
+    parser.add_argument('--recipient', help='ObjectId of the recipient of the invoices')
+    parser.add_argument('--notify', choices=['true', 'false'], help='whether the recipient of the invoices is notified')
+    parser.add_argument('--since', type=int, help='minimum sending time of the emails')
+    parser.add_argument('--until', type=int, help='sending time the emails are due before')
+    parser.add_argument('--fields', help='comma separated fields to export (default to all)')
+    parser.add_argument('--cursor', help='cursor of the last document already exported, to resume an export')
+    parser.add_argument('--batch-size', type=int, default=config.Configuration.API_EXPORT_BATCH_SIZE,
+                        help='documents read from MongoDB at once')
+    parser.add_argument('--output', help='file to write to (default to the standard output)')
+    args = parser.parse_args(argv)
+
+    if db.connect_db(getattr(config, args.config)) is None:
+        return 1
+    try:
+        after = decode_cursor(args.cursor) if args.cursor else None
+    except ValueError as exc:
+        parser.error(str(exc))
+    fields = args.fields.split(',') if args.fields else None
+    if args.collection == 'emails':
+        documents = EMailController.export_emails(args.sender, args.since, args.until, fields, after, args.batch_size)
+    else:
+        notify = None if args.notify is None else args.notify == 'true'
+        documents = InvoiceController.export_invoices(args.sender, args.recipient, notify, fields, after,
+                                                      args.batch_size)
+    output = open(args.output, 'a' if args.cursor else 'w') if args.output else sys.stdout
+    count, last = 0, None
+    try:
+        for document in documents:
+            output.write(ndjson_line(document))
+            last = document
+            count += 1
+    except (KeyboardInterrupt, Exception) as exc:
+        cursor = args.cursor if last is None else encode_cursor(last)
+        print(f"Export interrupted after {count} {args.collection} ({exc or type(exc).__name__}), "
+              f"resume it with --cursor {cursor}", file=sys.stderr)
+        return 1
+    finally:
+        output.flush()
+        if output is not sys.stdout:
+            output.close()
+    print(f"{count} {args.collection} exported", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,58 @@
+"""Users import (schedbill-import-users), reading the users as NDJSON (one JSON object per line).
+
+The lines are parsed as they are read and the users inserted by chunks, each with a single unordered bulk insert, so the
+memory used stays flat however big the file is. The progress is printed once each chunk is inserted, and the lines that
+failed (invalid user, already existing email address...) are written as NDJSON to the errors output.
+
+    python -m schedbill.import_users contacts.ndjson --config ProductionConfiguration --errors rejected.ndjson
+    gunzip -c contacts.ndjson.gz | python -m schedbill.import_users
+"""
+import argparse
+import json
+import sys
+import config
+import db
+from controllers import UserController
+from views import parse_ndjson
+
+
+def main(argv: list = None) -> int:
+    """Import users, then print the number of users inserted and failed
+
+    :param argv: the command line arguments
+    :return: the exit status, 1 if some users failed
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-import-users', description=__doc__.splitlines()[0])
+    parser.add_argument('input', nargs='?', help='file to read from (default to the standard input)')
+    parser.add_argument('--config', default='DevelopmentConfiguration', help='configuration class of the database')
+    parser.add_argument('--chunk-size', type=int, default=config.Configuration.API_IMPORT_CHUNK_SIZE,
+                        help='users inserted at once')
+    parser.add_argument('--errors', help='file to write the failed lines to (default to the standard output)')
+    args = parser.parse_args(argv)
+
+    if db.connect_db(getattr(config, args.config)) is None:
+        return 1
+    source = open(args.input) if args.input else sys.stdin
+    errors = open(args.errors, 'w') if args.errors else sys.stdout
+    report = {'lines': 0, 'inserted': 0, 'failed': 0}
+    try:
+        for report in UserController.import_users(parse_ndjson(source), args.chunk_size):
+            for error in report['errors']:
+                errors.write(json.dumps(error) + '\n')
+            print(f"{report['lines']} lines read, {report['inserted']} users inserted, {report['failed']} failed",
+                  file=sys.stderr)
+    except KeyboardInterrupt:
+        print(f"Import interrupted after line {report['lines']}", file=sys.stderr)
+        return 1
+    finally:
+        errors.flush()
+        if errors is not sys.stdout:
+            errors.close()
+        if source is not sys.stdin:
+            source.close()
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
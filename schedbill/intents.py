@@ -0,0 +1,278 @@
+from apscheduler.events import SchedulerEvent, EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.util import obj_to_ref, ref_to_obj
+from bson import ObjectId
+from datetime import datetime
+from flask import current_app, g
+from pymongo import ReplaceOne, DeleteOne
+from pytz import utc
+from typing import NamedTuple
+import logging
+import threading
+import mongoengine
+from scheduler import add_jobs
+
+logger = logging.getLogger()
+
+
+class RecordedJob(NamedTuple):
+    """A job which may exist in the scheduler daemon, as seen from the web role"""
+    id: str
+    next_run_time: datetime = None
+    interval: int = None  # the seconds between two runs of an interval job
+
+
+class IntentRecorder:
+    """This class records schedule intents in MongoDB for the scheduler daemon, instead of running a scheduler.
+
+    In the web role it stands in for the scheduler (add_job, add_jobs, get_job, remove_job) and for the email
+    dispatcher (schedule, schedule_many, cancel). Intents are keyed by job id so only the latest one is kept.
+    Once consumed, the long-lived jobs (interval, cron) are looked up in the jobs scheduled by the consumer.
+    """
+
+    def __init__(self, collection, scheduled=None):
+        """
+        :param collection: the pymongo collection holding the intents
+        :param scheduled: the pymongo collection of the long-lived jobs scheduled by the consumer (None = not known)
+        """
+        self.collection = collection
+        self.scheduled = scheduled
+        collection.create_index('version')  # the consumer polls the intents in this order
+
+    def add_job(self, func, trigger=None, args=None, id=None, replace_existing=True, **trigger_args) -> RecordedJob:
+        """Record the intent to add (or replace) a job, see BaseScheduler.add_job()"""
+        self.add_jobs([dict(func=func, trigger=trigger, args=args or [], id=id, **trigger_args)])
+        return RecordedJob(id, trigger_args.get('run_date'))
+
+    def add_jobs(self, jobs: list) -> int:
+        """Record the intents to add (or replace) several jobs with a single bulk write
+
+        :param jobs: the add_job() keyword arguments of each job
+        :return: the number of recorded intents
+        """
+        intents = []
+        for job in jobs:
+            job = dict(job)
+            job.pop('replace_existing', None)
+            intents.append({
+                '_id': job.pop('id'),
+                'op': 'add',
+                'func': obj_to_ref(job.pop('func')),
+                'trigger': job.pop('trigger', None) or 'date',
+                'args': list(job.pop('args', None) or []),
+                'trigger_args': job
+            })
+        return self._record(intents)
+
+    def get_job(self, job_id: str):
+        """Return the job as it may exist once the intents are consumed, None if it has been removed or is not known
+        (a date job which has run)"""
+        intent = self.collection.find_one({'_id': job_id}, {'op': 1, 'trigger_args': 1})
+        if intent is None:
+            job = self.scheduled.find_one({'_id': job_id}) if self.scheduled is not None else None
+            if job is None:
+                return None
+            next_run_time, interval = job['next_run_time'], job.get('interval')
+        elif intent['op'] in ('remove', 'cancel'):
+            return None
+        else:
+            trigger_args = intent.get('trigger_args', {})
+            next_run_time = trigger_args.get('run_date') or trigger_args.get('start_date')
+            interval = trigger_args.get('seconds')
+        return RecordedJob(job_id, next_run_time.replace(tzinfo=utc) if next_run_time else None, interval)
+
+    def remove_job(self, job_id: str) -> None:
+        """Record the intent to remove a job"""
+        self.remove_jobs([job_id])
+
+    def remove_jobs(self, job_ids: list) -> int:
+        """Record the intents to remove several jobs with a single bulk write"""
+        return self._record([{'_id': job_id, 'op': 'remove'} for job_id in job_ids])
+
+    def schedule(self, oid: str, send_at: int) -> int:
+        """Record the intent to dispatch an email, see EMailDispatcher.schedule()"""
+        return self.schedule_many([(oid, send_at)])
+
+    def schedule_many(self, schedules) -> int:
+        """Record the intents to dispatch several emails, see EMailDispatcher.schedule_many()"""
+        return self._record([
+            {'_id': oid, 'op': 'dispatch', 'sendAt': int(send_at)} if int(send_at) > 0 else {'_id': oid, 'op': 'cancel'}
+            for oid, send_at in schedules
+        ])
+
+    def cancel(self, oid: str) -> int:
+        """Record the intent to cancel the dispatch of an email, see EMailDispatcher.cancel()"""
+        return self._record([{'_id': oid, 'op': 'cancel'}])
+
+    def _record(self, intents: list) -> int:
+        if intents:
+            self.collection.bulk_write([
+                ReplaceOne({'_id': intent['_id']}, dict(intent, version=ObjectId()), upsert=True)
+                for intent in intents
+            ], ordered=False)
+        return len(intents)
+
+
+class IntentConsumer:
+    """This class applies the schedule intents recorded by the web role to the scheduler of the daemon."""
+
+    def __init__(self, collection, jobs, dispatcher=None, sharding=None, interval: float = 1.0,
+                 batch_size: int = 500, scheduled=None):
+        """
+        :param collection: the pymongo collection holding the intents
+        :param jobs: what the jobs are scheduled with (the scheduler or the sharded scheduling)
+        :param dispatcher: the email dispatcher, if any
+        :param sharding: the sharded scheduling, if any
+        :param interval: the polling interval (in seconds) when there is no intent left
+        :param batch_size: the maximum number of intents applied at once
+        :param scheduled: the pymongo collection the long-lived jobs (interval, cron) applied are recorded in, until
+            they are removed from the scheduler, so the recorder still finds them (None = not recorded)
+        """
+        self.collection = collection
+        self.jobs = jobs
+        self.scheduled = scheduled
+        # each poll reads the oldest intents first from this index, instead of sorting the whole collection
+        collection.create_index('version')
+        self._recorded = set()
+        if scheduled is not None:
+            self._recorded.update(scheduled.distinct('_id'))
+            scheduler = jobs if isinstance(jobs, BaseScheduler) else jobs.scheduler
+            scheduler.add_listener(self._track, EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+        self.dispatcher = dispatcher
+        self.sharding = sharding
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def consume(self) -> int:
+        """Apply a batch of intents, oldest first, then delete them unless they were replaced in the meantime
+
+        :return: the number of applied intents
+        """
+        intents = list(self.collection.find().sort('version', 1).limit(self.batch_size))
+        if not intents:
+            return 0
+
+        added, dispatched, recorded = [], [], []
+        for intent in intents:
+            try:
+                if intent['op'] == 'add':
+                    if intent['trigger'] != 'date':
+                        recorded.append({
+                            '_id': intent['_id'],
+                            'next_run_time': intent['trigger_args'].get('start_date'),
+                            'interval': intent['trigger_args'].get('seconds')
+                        })
+                    added.append(dict(
+                        func=ref_to_obj(intent['func']),
+                        trigger=intent['trigger'],
+                        args=intent['args'],
+                        id=intent['_id'],
+                        **{key: value.replace(tzinfo=utc) if isinstance(value, datetime) and value.tzinfo is None
+                           else value for key, value in intent['trigger_args'].items()}  # BSON dates are UTC
+                    ))
+                elif intent['op'] == 'remove':
+                    try:
+                        self.jobs.remove_job(intent['_id'])
+                    except JobLookupError:
+                        self._forget(intent['_id'])
+                elif self.dispatcher is None:
+                    logger.warning(f"Intent {intent['op']} on {intent['_id']} ignored : no email dispatcher")
+                elif self.sharding is not None and not self.sharding.owns(intent['_id']):
+                    # The instance owning the email partition loads it on its next renewal
+                    pass
+                elif intent['op'] == 'dispatch':
+                    dispatched.append((intent['_id'], intent['sendAt']))
+                elif intent['op'] == 'cancel':
+                    self.dispatcher.cancel(intent['_id'])
+            except Exception as exc:
+                logger.error(f"Intent {intent['op']} on {intent['_id']} failed : {exc}")
+
+        if added:
+            if isinstance(self.jobs, BaseScheduler):
+                add_jobs(self.jobs, added)
+            else:
+                self.jobs.add_jobs(added)
+        if dispatched:
+            self.dispatcher.schedule_many(dispatched)
+        if recorded and self.scheduled is not None:
+            self.scheduled.bulk_write([ReplaceOne({'_id': job['_id']}, job, upsert=True) for job in recorded],
+                                      ordered=False)
+            self._recorded.update(job['_id'] for job in recorded)
+        self.collection.bulk_write([
+            DeleteOne({'_id': intent['_id'], 'version': intent['version']}) for intent in intents
+        ], ordered=False)
+        return len(intents)
+
+    def _track(self, event: SchedulerEvent) -> None:
+        """Forget the recorded jobs removed from the scheduler (by a remove intent or by the scheduler itself)"""
+        if event.code == EVENT_ALL_JOBS_REMOVED:
+            self.scheduled.delete_many({})
+            self._recorded.clear()
+        else:
+            self._forget(event.job_id)
+
+    def _forget(self, job_id: str) -> None:
+        if job_id in self._recorded:
+            self.scheduled.delete_one({'_id': job_id})
+            self._recorded.discard(job_id)
+
+    def start(self) -> None:
+        """Start the consuming thread"""
+        self._thread = threading.Thread(target=self._run, name='schedbill-intents', daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        """Stop the consuming thread"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        consumed = 0
+        while not self._stopped.wait(0 if consumed == self.batch_size else self.interval):
+            try:
+                consumed = self.consume()
+            except Exception as exc:
+                consumed = 0
+                logger.error(f"Schedule intents consumption failed : {exc}")
+
+
+def get_intent_recorder() -> IntentRecorder:
+    """Register the schedule intents recorder in flask.g, as both the scheduler and the email dispatcher
+
+    :return: the schedule intents recorder
+    """
+
+    recorder = getattr(g, 'scheduler', None)
+    if not isinstance(recorder, IntentRecorder):
+        raw_db = mongoengine.connection.get_db()
+        recorder = g.scheduler = IntentRecorder(raw_db['schedule_intents'], raw_db['scheduled_jobs'])
+        if current_app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'dispatcher':
+            g.dispatcher = recorder
+    return recorder
+
+
+def get_intent_consumer() -> IntentConsumer:
+    """Register the schedule intents consumer in flask.g or returns it if already existing
+
+    :return: the schedule intents consumer
+    """
+
+    consumer = getattr(g, 'intents', None)
+    if consumer is None:
+        sharding = getattr(g, 'sharding', None)
+        raw_db = mongoengine.connection.get_db()
+        consumer = g.intents = IntentConsumer(
+            raw_db['schedule_intents'],
+            sharding or g.scheduler,
+            dispatcher=getattr(g, 'dispatcher', None),
+            sharding=sharding,
+            interval=current_app.config.get('SCHEDULER_INTENTS_INTERVAL'),
+            scheduled=raw_db['scheduled_jobs']
+        )
+        consumer.start()
+    return consumer
@@ -0,0 +1,389 @@
+"""Scheduler and database metrics, exposed in the Prometheus text format.
+
+The metrics are kept in memory by each process (scheduler, web workers), in a module-level registry. Recording a value is
+a dict lookup and a few additions under a lock, cheap enough to stay on under full load.
+"""
+from apscheduler.events import (
+    SchedulerEvent, EVENT_SCHEDULER_STARTED, EVENT_JOBSTORE_ADDED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_EXECUTED,
+    EVENT_JOB_ERROR, EVENT_JOB_MISSED
+)
+from apscheduler.executors.base import run_job
+from apscheduler.executors.pool import BasePoolExecutor, ThreadPoolExecutor, ProcessPoolExecutor
+from apscheduler.schedulers.base import BaseScheduler
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import db
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the histogram buckets
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Job store operations whose latency is measured
+JOBSTORE_OPERATIONS = ('lookup_job', 'get_due_jobs', 'get_next_run_time', 'get_all_jobs', 'add_job', 'update_job',
+                       'remove_job', 'remove_all_jobs')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+    """Base class of the metrics, holding one value per combination of label values"""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """
+        :param name: the metric name
+        :param documentation: the help text of the metric
+        :param labelnames: the names of the metric labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> list:
+        """Return the lines of the metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            samples = sorted(self._values.items())
+        for labels, value in samples:
+            lines.extend(self._render_sample(labels, value))
+        return lines
+
+    def _render_sample(self, labels: tuple, value) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    """A value which only goes up"""
+
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """A value which goes up and down"""
+
+    type = 'gauge'
+
+    def set(self, *labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+
+class Histogram(Metric):
+    """A distribution of values, counted in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        """
+        :param buckets: the upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(labels)
+            if sample is None:
+                # the counts of each bucket (the last one being +Inf), the sum and the count of the observations
+                sample = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the time spent in a with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - started)
+
+    def count(self, *labels) -> int:
+        sample = self._values.get(labels)
+        return sample[2] if sample else 0
+
+    def _render_sample(self, labels: tuple, sample) -> list:
+        counts, total, count = sample
+        lines, cumulated = [], 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulated += bucket_count
+            bucket_labels = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulated}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """This class holds the metrics of the process and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def clear(self) -> None:
+        """Reset every metric"""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+JOB_DISPATCH_LAG = REGISTRY.histogram(
+    'schedbill_job_dispatch_lag_seconds', 'Delay between the scheduled run time of a job and its actual start',
+    ('job',), LAG_BUCKETS
+)
+JOB_DURATION = REGISTRY.histogram(
+    'schedbill_job_duration_seconds', 'Execution time of the jobs', ('job',)
+)
+JOB_RUNS = REGISTRY.counter(
+    'schedbill_job_runs_total', 'Job runs by outcome (executed, error)', ('job', 'outcome')
+)
+JOB_DB_COMMANDS = REGISTRY.counter(
+    'schedbill_job_db_commands_total', 'MongoDB commands run by the jobs', ('job',)
+)
+JOB_DB_TIME = REGISTRY.histogram(
+    'schedbill_job_db_seconds', 'Time spent by the jobs in MongoDB commands', ('job',)
+)
+JOB_MISSED = REGISTRY.counter(
+    'schedbill_job_missed_total', 'Job runs skipped for being later than the misfire grace time', ('job',)
+)
+JOB_MAX_INSTANCES = REGISTRY.counter(
+    'schedbill_job_max_instances_total', 'Job runs refused as the maximum number of running instances is reached'
+)
+EXECUTOR_IN_FLIGHT = REGISTRY.gauge(
+    'schedbill_executor_in_flight_jobs', 'Jobs submitted to an executor and not finished yet', ('executor',)
+)
+EXECUTOR_QUEUE_DEPTH = REGISTRY.gauge(
+    'schedbill_executor_queue_depth', 'Jobs submitted to an executor and waiting for a free worker', ('executor',)
+)
+JOBSTORE_LATENCY = REGISTRY.histogram(
+    'schedbill_jobstore_operation_seconds', 'Latency of the job store operations', ('jobstore', 'operation')
+)
+
+DB_POOL_CONNECTIONS = REGISTRY.gauge(
+    'schedbill_db_pool_connections', 'Connections of the MongoDB pools, by state (open, in_use)', ('address', 'state')
+)
+DB_POOL_CHECKOUT_WAIT = REGISTRY.histogram(
+    'schedbill_db_pool_checkout_seconds', 'Time waited to check a connection out of a MongoDB pool', ('address',)
+)
+DB_POOL_CHECKOUT_FAILED = REGISTRY.counter(
+    'schedbill_db_pool_checkout_failed_total', 'Connection checkouts failed, by reason (timeout, connectionError...)',
+    ('address', 'reason')
+)
+
+NOTIFY_SPREAD_DELAY = REGISTRY.histogram(
+    'schedbill_notify_spread_delay_seconds', 'Delay added to the invoice notifications to spread their load', (),
+    (0, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    'schedbill_cache_lookups_total', 'Lookups of the documents caches, by result (hit, miss)', ('cache', 'result')
+)
+
+
+def job_type(job) -> str:
+    """Return the type of a job, as the name of the callable it runs (EMailController.send_email...)"""
+    return job.func_ref.rpartition(':')[2]
+
+
+def run_timed_job(job, jobstore_alias: str, run_times: list, logger_name: str) -> list:
+    """Run a job as apscheduler.executors.base.run_job() does, recording its start, execution time and MongoDB commands
+    in its events
+
+    It runs in the executor workers, possibly in another process: the timings travel back to the scheduler with the
+    events.
+    """
+    events = []
+    for run_time in run_times:
+        started_at = time.time()
+        with db.COMMAND_PROFILER.profile() as profile:
+            run_events = run_job(job, jobstore_alias, [run_time], logger_name)
+        duration = time.time() - started_at
+        for event in run_events:
+            event.job_type = job_type(job)
+            event.started_at = started_at
+            event.duration = duration
+            event.db_commands = profile.commands
+            event.db_time = profile.duration_micros / 1e6
+        events.extend(run_events)
+    return events
+
+
+class MeteredPoolExecutor(BasePoolExecutor):
+    """Pool executor running the jobs with run_timed_job() and keeping track of its in-flight jobs"""
+
+    def _do_submit_job(self, job, run_times) -> None:
+        alias = self._logger.name.rpartition('.')[2]
+
+        def callback(f):
+            self._track(alias, -1)
+            exc, tb = (f.exception_info() if hasattr(f, 'exception_info')
+                       else (f.exception(), getattr(f.exception(), '__traceback__', None)))
+            if exc:
+                self._run_job_error(job.id, exc, tb)
+            else:
+                self._run_job_success(job.id, f.result())
+
+        self._track(alias, 1)
+        try:
+            f = self._pool.submit(run_timed_job, job, job._jobstore_alias, run_times, self._logger.name)
+        except BaseException:
+            self._track(alias, -1)
+            raise
+        f.add_done_callback(callback)
+
+    def _track(self, alias: str, amount: int) -> None:
+        EXECUTOR_IN_FLIGHT.inc(alias, amount=amount)
+        EXECUTOR_QUEUE_DEPTH.set(alias, value=max(0, EXECUTOR_IN_FLIGHT.value(alias) - self._pool._max_workers))
+
+
+class MeteredThreadPoolExecutor(ThreadPoolExecutor, MeteredPoolExecutor):
+    """Thread pool executor with metrics"""
+
+
+class MeteredProcessPoolExecutor(ProcessPoolExecutor, MeteredPoolExecutor):
+    """Process pool executor with metrics"""
+
+
+def observe_event(event: SchedulerEvent) -> None:
+    """Scheduler events listener recording the job metrics"""
+    if event.code == EVENT_JOB_MAX_INSTANCES:
+        JOB_MAX_INSTANCES.inc()
+        return
+    job = getattr(event, 'job_type', 'unknown')
+    if event.code == EVENT_JOB_MISSED:
+        JOB_MISSED.inc(job)
+        return
+    JOB_RUNS.inc(job, 'executed' if event.code == EVENT_JOB_EXECUTED else 'error')
+    if hasattr(event, 'started_at'):
+        JOB_DISPATCH_LAG.observe(job, value=max(0.0, event.started_at - event.scheduled_run_time.timestamp()))
+        JOB_DURATION.observe(job, value=event.duration)
+        JOB_DB_COMMANDS.inc(job, amount=event.db_commands)
+        JOB_DB_TIME.observe(job, value=event.db_time)
+
+
+OBSERVED_EVENTS = EVENT_JOB_MAX_INSTANCES | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED
+
+
+def meter_jobstore(store, alias: str):
+    """Measure the latency of the operations of a job store
+
+    The operations are wrapped on the instance, so the job store keeps its class.
+
+    :param store: the job store
+    :param alias: the alias of the job store
+    :return: the job store
+    """
+    if getattr(store, '_metered', False):
+        return store
+
+    def timed(operation: str, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with JOBSTORE_LATENCY.time(alias, operation):
+                return method(*args, **kwargs)
+        return wrapper
+
+    for operation in JOBSTORE_OPERATIONS:
+        setattr(store, operation, timed(operation, getattr(store, operation)))
+    store._metered = True
+    return store
+
+
+def meter_jobstores(scheduler: BaseScheduler, event: SchedulerEvent = None) -> None:
+    """Scheduler events listener measuring the job stores, as they are started or added"""
+    for alias, store in list(scheduler._jobstores.items()):
+        meter_jobstore(store, alias)
+
+
+METERED_JOBSTORE_EVENTS = EVENT_SCHEDULER_STARTED | EVENT_JOBSTORE_ADDED
+
+
+def serve(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Serve the metrics over HTTP in a background thread, for the processes which do not serve the application
+
+    :param port: the port to listen to
+    :param host: the interface to listen to
+    :return: the HTTP server
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='schedbill-metrics', daemon=True).start()
+    return server
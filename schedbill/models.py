@@ -1,4 +1,20 @@
-from mongoengine import Document, StringField, EmailField, IntField, BooleanField, ReferenceField
+from mongoengine import Document, StringField, EmailField, IntField, BooleanField, ReferenceField, ValidationError
+from billing import parse_rule
+import pytz
+
+
+def validate_timezone(tz: str) -> None:
+    """Check a timezone is known to the tz database (as 'Europe/Paris')"""
+    if tz not in pytz.all_timezones_set:
+        raise ValidationError(f"Unknown timezone '{tz}'")
+
+
+def validate_billing_rule(rule: str) -> None:
+    """Check a billing rule can be read (see billing.py)"""
+    try:
+        parse_rule(rule)
+    except ValueError as exc:
+        raise ValidationError(str(exc))
 
 
 class User(Document):
@@ -7,25 +23,72 @@ class User(Document):
     emailAddress = EmailField(required=True, unique=True)
     lastName = StringField()
     firstName = StringField()
+    timezone = StringField(validation=validate_timezone)  # the invoices are notified at times of this timezone
 
 
 class EMail(Document):
     """"""
-    meta = {'collection': 'emails'}
+    meta = {
+        'collection': 'emails',
+        'indexes': [
+            # Listings, whose pages are sorted by (sendAt, id) or id
+            ('sendAt', 'id'),
+            ('sender', 'sendAt', 'id'),
+            ('sender', 'id'),
+            # Pending emails (sentAt = 0) which are scheduled: the due-work queries projecting id and sendAt are
+            # answered from this index only
+            {
+                'name': 'pending_emails',
+                'fields': ('sentAt', 'sendAt', 'id'),
+                'partialFilterExpression': {'sentAt': 0, 'sendAt': {'$gt': 0}}
+            }
+        ]
+    }
     sender = ReferenceField(User)
     recipient = EmailField(required=True)
     title = StringField(default="")
     content = StringField(required=True)
     sendAt = IntField(default=0)
+    sentAt = IntField(default=0)  # 0 = pending, < 0 = claimed by a sender, else the time the email was sent at
 
 
 class Invoice(Document):
     """"""
-    meta = {'collection': 'invoices'}
+    meta = {
+        'collection': 'invoices',
+        'indexes': [
+            # Listings, whose pages are sorted by id
+            ('sender', 'id'),
+            ('recipient', 'id'),
+            # Invoices billed on calendar dates, whose runs are planned in bulk
+            {
+                'name': 'calendar_invoices',
+                'fields': ('billingRule', 'timezone', 'id'),
+                'partialFilterExpression': {'billingRule': {'$exists': True}}
+            }
+        ]
+    }
     sender = ReferenceField(User)
     recipient = ReferenceField(User)
     reference = StringField(unique=True, required=True)
     periodicity = IntField(default=0)
     notify = BooleanField(default=False)
     notifyAt = IntField(default=-1)
+    timezone = StringField(validation=validate_timezone)  # notifyAt is reckoned in, default to the recipient's one
+    billingRule = StringField(validation=validate_billing_rule)  # calendar billing, instead of the periodicity
+
+
+class BillingRun(Document):
+    """"""
+    meta = {
+        'collection': 'billing_runs',
+        'indexes': [
+            # The runs due in a window are found by a single range query, their pages sorted by (runAt, id), from this
+            # index only
+            ('runAt', 'id', 'invoice'),
+            {'fields': ('invoice', 'runAt'), 'unique': True}
+        ]
+    }
+    invoice = ReferenceField(Invoice, required=True)
+    runAt = IntField(required=True)
 
@@ -1,94 +1,108 @@
 from pytz import utc
+from concurrent.futures import ThreadPoolExecutor as BucketPoolExecutor
+from typing import Callable, Iterable
+import heapq
+import threading
+import time
 from apscheduler.schedulers.background import BaseScheduler, BackgroundScheduler
+from apscheduler.schedulers.base import STATE_STOPPED
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
 from apscheduler.jobstores.mongodb import MongoDBJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.util import datetime_to_utc_timestamp
 from apscheduler.events import (
-    SchedulerEvent, EVENT_SCHEDULER_STARTED, EVENT_SCHEDULER_SHUTDOWN, EVENT_EXECUTOR_ADDED, EVENT_EXECUTOR_REMOVED,
+    SchedulerEvent, JobEvent, EVENT_SCHEDULER_STARTED, EVENT_SCHEDULER_SHUTDOWN, EVENT_EXECUTOR_ADDED, EVENT_EXECUTOR_REMOVED,
     EVENT_JOBSTORE_ADDED, EVENT_JOBSTORE_REMOVED, EVENT_JOB_ADDED, EVENT_JOB_REMOVED, EVENT_JOB_MODIFIED,
-    EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+    EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED,
+    EVENT_ALL_JOBS_REMOVED
 )
 from flask import current_app, g
+from bson.binary import Binary
+from datetime import datetime
+from pymongo import ReplaceOne
+from functools import partial
+from types import SimpleNamespace
 import logging
+import pickle
+import mongoengine
 import config
+import db
+import metrics
+from metrics import MeteredThreadPoolExecutor, MeteredProcessPoolExecutor
 
 logger = logging.getLogger()
 
+# add_job() keyword arguments which are not trigger arguments
+_JOB_KWARGS = ('func', 'trigger', 'args', 'kwargs', 'id', 'name', 'executor', 'misfire_grace_time', 'coalesce',
+               'max_instances')
 
-def scheduler_hooks(event: SchedulerEvent) -> None:
-    """Events listeners handlers"""
-    handlers = {
-        # class apscheduler.events.SchedulerEvent(code, alias=None)
-        EVENT_SCHEDULER_STARTED: lambda: logger.info(
-            f"Scheduler started : {event.code}"
-        ),
-        EVENT_SCHEDULER_SHUTDOWN: lambda: logger.info(
-            f"Scheduler stopped : {event.code}"
-        ),
-        EVENT_EXECUTOR_ADDED: lambda: logger.info(
-            f"Scheduler executor added : {event.alias} ({event.code})"
-        ),
-        EVENT_EXECUTOR_REMOVED: lambda: logger.info(
-            f"Scheduler executor removed : {event.alias} ({event.code})"
-        ),
-        EVENT_JOBSTORE_ADDED: lambda: logger.info(
-            f"Scheduler jobstore added : {event.alias} ({event.code})"
-        ),
-        EVENT_JOBSTORE_REMOVED: lambda: logger.info(
-            f"Scheduler jobstore removed : {event.alias} ({event.code})"
-        ),
-        # class apscheduler.events.JobEvent(code, job_id, jobstore)
-        EVENT_JOB_ADDED: lambda: logger.debug(
-            f"Scheduler job {event.job_id} ({event.code}) added on jobstore {event.jobstore}"
-        ),
-        EVENT_JOB_REMOVED: lambda: logger.debug(
-            f"Scheduler job {event.job_id} ({event.code}) removed from jobstore {event.jobstore}"
-        ),
-        EVENT_JOB_MODIFIED: lambda: logger.debug(
-            f"Scheduler job {event.job_id} ({event.code}) modified on jobstore {event.jobstore}"
-        ),
-        # class apscheduler.events.JobSubmissionEvent(code, job_id, jobstore, scheduled_run_times)
-        EVENT_JOB_SUBMITTED: lambda: logger.debug(
-            f"Scheduler job {event.job_id} ({event.code}) submitted from jobstore {event.jobstore}"
-        ),
-        EVENT_JOB_MAX_INSTANCES: lambda: logger.error(
-            f"""Scheduler job {event.job_id} ({event.code}) refused from executor on jobstore {event.jobstore}
+# Settings of the application set up at startup from the others, by the process pool workers as well
+WORKER_DERIVED_SETTINGS = ('MONGODB_SETTINGS',)
+
+
+# Log level and message of each scheduler event, built once
+_EVENT_LOGS = {
+    # class apscheduler.events.SchedulerEvent(code, alias=None)
+    EVENT_SCHEDULER_STARTED: (logging.INFO, "Scheduler started : {e.code}"),
+    EVENT_SCHEDULER_SHUTDOWN: (logging.INFO, "Scheduler stopped : {e.code}"),
+    EVENT_EXECUTOR_ADDED: (logging.INFO, "Scheduler executor added : {e.alias} ({e.code})"),
+    EVENT_EXECUTOR_REMOVED: (logging.INFO, "Scheduler executor removed : {e.alias} ({e.code})"),
+    EVENT_JOBSTORE_ADDED: (logging.INFO, "Scheduler jobstore added : {e.alias} ({e.code})"),
+    EVENT_JOBSTORE_REMOVED: (logging.INFO, "Scheduler jobstore removed : {e.alias} ({e.code})"),
+    # class apscheduler.events.JobEvent(code, job_id, jobstore)
+    EVENT_JOB_ADDED: (logging.DEBUG, "Scheduler job {e.job_id} ({e.code}) added on jobstore {e.jobstore}"),
+    EVENT_JOB_REMOVED: (logging.DEBUG, "Scheduler job {e.job_id} ({e.code}) removed from jobstore {e.jobstore}"),
+    EVENT_JOB_MODIFIED: (logging.DEBUG, "Scheduler job {e.job_id} ({e.code}) modified on jobstore {e.jobstore}"),
+    # class apscheduler.events.JobSubmissionEvent(code, job_id, jobstore, scheduled_run_times)
+    EVENT_JOB_SUBMITTED: (logging.DEBUG, "Scheduler job {e.job_id} ({e.code}) submitted from jobstore {e.jobstore}"),
+    EVENT_JOB_MAX_INSTANCES: (
+        logging.ERROR,
+        """Scheduler job {e.job_id} ({e.code}) refused from executor on jobstore {e.jobstore}
             MAX instances reached"""
-        ),
-        # class apscheduler.events.JobExecutionEvent(code, job_id, jobstore, scheduled_run_time, retval=None,
-        #                                            exception=None, traceback=None)
-        EVENT_JOB_EXECUTED: lambda: logger.info(
-            f"Scheduler job {event.job_id} ({event.code}) executed on jobstore {event.jobstore}"
-        ),
-        EVENT_JOB_ERROR: lambda: logger.error(
-            f"Scheduler job {event.job_id} ({event.code}) on jobstore {event.jobstore} exception : {event.exception}"
-        ),
-        EVENT_JOB_MISSED: lambda: logger.error(
-            f"""Scheduler job {event.job_id} ({event.code}) missed on jobstore {event.jobstore} 
-            exception : {event.exception}"""
-        ),
-    }
+    ),
+    # class apscheduler.events.JobExecutionEvent(code, job_id, jobstore, scheduled_run_time, retval=None,
+    #                                            exception=None, traceback=None)
+    EVENT_JOB_EXECUTED: (logging.INFO, "Scheduler job {e.job_id} ({e.code}) executed on jobstore {e.jobstore}"),
+    EVENT_JOB_ERROR: (
+        logging.ERROR, "Scheduler job {e.job_id} ({e.code}) on jobstore {e.jobstore} exception : {e.exception}"
+    ),
+    EVENT_JOB_MISSED: (
+        logging.ERROR,
+        """Scheduler job {e.job_id} ({e.code}) missed on jobstore {e.jobstore} 
+            exception : {e.exception}"""
+    ),
+}
+_UNHANDLED_EVENT_LOG = (logging.WARNING, "Unhandled event trapped : {e.code}")
+
 
-    handlers.get(event.code, lambda : logger.warning(f"Unhandled event trapped : {event.code}"))()
+def scheduler_hooks(event: SchedulerEvent) -> None:
+    """Events listeners handlers"""
+    level, message = _EVENT_LOGS.get(event.code, _UNHANDLED_EVENT_LOG)
+    if logger.isEnabledFor(level):
+        logger.log(level, message.format(e=event))
 
 
 def setup_scheduler(max_threads: int = 25, job_coalesce: bool = False, misfire_grace_time: int = 15,
-                    timezone='Europe/Paris') -> BaseScheduler:
+                    timezone='Europe/Paris', max_processes: int = 0, process_config: dict = None) -> BaseScheduler:
     """ Set the scheduler's configuration up and return it
 
     :param max_threads: maximum threads in a ThreadPoolExecutor
     :param job_coalesce: if False a same job won't be replayed several times if late
     :param misfire_grace_time: the grace time (in seconds) to allow execution for a late job (None = run unconditionaly)
     :param timezone: the timezone of the scheduler
+    :param max_processes: maximum processes in a ProcessPoolExecutor (0 = no process pool)
+    :param process_config: the configuration the process pool workers set their application up with
     :return: the configured scheduler
     """
 
-    job_stores = {
-        'mongo': MongoDBJobStore()
-    }
-
     executors = {
-        'default': ThreadPoolExecutor(max_threads)
+        'default': MeteredThreadPoolExecutor(max_threads)
     }
+    if max_processes > 0:
+        executors['processpool'] = MeteredProcessPoolExecutor(
+            max_processes,
+            pool_kwargs={'initializer': init_process_worker, 'initargs': (process_config or {},)}
+        )
 
     job_defaults = {
         'coalesce': job_coalesce,
@@ -105,9 +119,10 @@ def setup_scheduler(max_threads: int = 25, job_coalesce: bool = False, misfire_g
                            EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_EXECUTED |
                            EVENT_JOB_ERROR | EVENT_JOB_MISSED
                            )
+    app_scheduler.add_listener(metrics.observe_event, metrics.OBSERVED_EVENTS)
+    app_scheduler.add_listener(partial(metrics.meter_jobstores, app_scheduler), metrics.METERED_JOBSTORE_EVENTS)
 
     app_scheduler.configure(
-        job_stores=job_stores,
         executors=executors,
         job_defaults=job_defaults,
         timezone=timezone
@@ -128,7 +143,475 @@ def get_scheduler() -> BaseScheduler:
                 max_threads=current_app.config.get('SCHEDULER_MAX_THREADS'),
                 job_coalesce=current_app.config.get('SCHEDULER_JOB_COALESCE'),
                 misfire_grace_time=current_app.config.get('SCHEDULER_MISFIRE_GRACE_TIME'),
-                timezone=current_app.config.get('SCHEDULER_TIMEZONE')
+                timezone=current_app.config.get('SCHEDULER_TIMEZONE'),
+                max_processes=current_app.config.get('SCHEDULER_MAX_PROCESSES', 0),
+                process_config=worker_config(current_app.config)
             )
         app_scheduler.start()
     return app_scheduler
+
+
+def worker_config(app_config) -> dict:
+    """Return the configuration the process pool workers set their application up with
+
+    The pool pickles it to its workers: the settings derived at startup (MONGODB_SETTINGS, holding the MongoDB event
+    listeners), which the workers derive again, and the values which can not be pickled are left out.
+
+    :param app_config: the configuration of the application
+    :return: the uppercase settings to pass to the workers
+    """
+
+    worker_settings = {}
+    for key, value in app_config.items():
+        if not key.isupper() or key in WORKER_DERIVED_SETTINGS:
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception as exc:
+            logger.warning(f"Setting {key} not passed to the process pool workers : {exc}")
+            continue
+        worker_settings[key] = value
+    return worker_settings
+
+
+def executor_for(job_type: str) -> str:
+    """Return the alias of the executor running a type of job, as routed by SCHEDULER_JOB_EXECUTORS
+
+    :param job_type: the type of job ('email', 'invoice'...)
+    :return: the executor alias, 'default' (the thread pool) unless the job type is routed to an existing pool
+    """
+
+    executor = current_app.config.get('SCHEDULER_JOB_EXECUTORS', {}).get(job_type, 'default')
+    if executor == 'processpool' and not current_app.config.get('SCHEDULER_MAX_PROCESSES', 0):
+        return 'default'
+    return executor
+
+
+def init_process_worker(app_config: dict) -> None:
+    """Set a process pool worker up, once per child process
+
+    A MongoDB client is not fork-safe: whatever connection the worker may inherit from the parent is dropped and the
+    worker connects on its own. The worker then keeps an application context with the 'worker' role, so the jobs it
+    runs record their schedule intents, which the scheduler of the parent applies.
+
+    :param app_config: the configuration of the parent application
+    """
+
+    from schedbill import create_app
+    mongoengine.disconnect_all()
+    app = create_app(SimpleNamespace(**app_config), role='worker')
+    app.app_context().push()
+
+
+def _write_jobs(store: BaseJobStore, jobs: list) -> None:
+    """Add (or replace) built jobs in a job store, with a single bulk write for a MongoDB job store"""
+
+    if isinstance(store, MongoDBJobStore):
+        with metrics.JOBSTORE_LATENCY.time(store._alias, 'bulk_write'):
+            store.collection.bulk_write([
+                ReplaceOne(
+                    {'_id': job.id},
+                    {
+                        '_id': job.id,
+                        'next_run_time': datetime_to_utc_timestamp(job.next_run_time),
+                        'job_state': Binary(pickle.dumps(job.__getstate__(), store.pickle_protocol))
+                    },
+                    upsert=True
+                ) for job in jobs
+            ], ordered=False)
+    else:
+        for job in jobs:
+            try:
+                store.add_job(job)
+            except ConflictingIdError:
+                store.update_job(job)
+
+
+def add_jobs(scheduler: BaseScheduler, jobs: list, jobstore: str = 'default') -> int:
+    """Add (or replace) several jobs with a single bulk operation on the job store
+
+    :param scheduler: the scheduler owning the job store
+    :param jobs: the add_job() keyword arguments of each job (func, trigger, id, args, run_date...)
+    :param jobstore: the alias of the job store, or a job store which is not attached to the scheduler
+    :return: the number of added jobs
+    """
+
+    # add_job() writes one job at a time: the jobs are built and written as BaseScheduler (APScheduler 3) does, through
+    # its internals (_create_trigger, _job_defaults, _lookup_jobstore, _jobstores_lock, _dispatch_event)
+    detached = isinstance(jobstore, BaseJobStore)
+    if scheduler.state == STATE_STOPPED and not detached:
+        # The job stores are not started yet: add_job() only records pending jobs
+        for job in jobs:
+            scheduler.add_job(jobstore=jobstore, replace_existing=True, **job)
+        return len(jobs)
+
+    now = datetime.now(scheduler.timezone)
+    built_jobs = []
+    for spec in jobs:
+        spec = dict(spec)
+        spec.pop('replace_existing', None)  # always True here
+        trigger_args = {key: spec.pop(key) for key in list(spec) if key not in _JOB_KWARGS}
+        spec['trigger'] = scheduler._create_trigger(spec.get('trigger'), trigger_args)
+        spec['args'] = tuple(spec.get('args', ()))
+        spec['kwargs'] = dict(spec.get('kwargs', {}))
+        spec.setdefault('executor', 'default')
+        job = Job(scheduler, **spec)
+        job._modify(
+            next_run_time=job.trigger.get_next_fire_time(None, now),
+            **{key: value for key, value in scheduler._job_defaults.items() if key not in spec}
+        )
+        built_jobs.append(job)
+
+    if detached:
+        _write_jobs(jobstore, built_jobs)
+        # The scheduler owning the job store picks the jobs up on its next wakeup
+        return len(built_jobs)
+    # The scheduler thread reads and modifies its job stores holding this lock, as add_job() does
+    with scheduler._jobstores_lock:
+        _write_jobs(scheduler._lookup_jobstore(jobstore), built_jobs)
+    for job in built_jobs:
+        job._jobstore_alias = jobstore
+        scheduler._dispatch_event(JobEvent(EVENT_JOB_ADDED, job.id, jobstore))
+    scheduler.wakeup()
+
+    return len(built_jobs)
+
+
+class JobsFacade:
+    """This class schedules the jobs with as few job store round trips as possible.
+
+    A job is either upserted (added or replaced with a single write) or cancelled, one at a time or in bulk. When the
+    jobs are run by a local scheduler, the ids of its jobs are kept in memory from the scheduler events, so cancelling
+    or looking up a job which does not exist costs no query. This relies on the scheduler being the only writer of
+    its job store: the other roles record their schedule intents, which it applies.
+    Other targets (the sharded scheduling, the schedule intents recorder) are always queried.
+    """
+
+    def __init__(self, target, jobstore: str = 'default'):
+        """
+        :param target: what the jobs are scheduled with (a scheduler, the sharded scheduling or the intents recorder)
+        :param jobstore: the alias of the scheduler job store
+        """
+        self.target = target
+        self.jobstore = jobstore
+        self._known = None
+        if isinstance(target, BaseScheduler):
+            self._known = set()
+            target.add_listener(self._track, EVENT_SCHEDULER_STARTED | EVENT_JOB_ADDED | EVENT_JOB_REMOVED |
+                                EVENT_ALL_JOBS_REMOVED)
+            if target.state != STATE_STOPPED:
+                self._load()
+
+    def __contains__(self, job_id: str) -> bool:
+        """Tell whether a job may exist (always True when the job ids are not tracked)"""
+        return self._known is None or job_id in self._known
+
+    def get_job(self, job_id: str):
+        """Return the job or None if it does not exist, without any query if it is not known"""
+        if job_id not in self:
+            return None
+        if self._known is None:
+            return self.target.get_job(job_id)
+        return self.target.get_job(job_id, self.jobstore)
+
+    def upsert_or_cancel(self, job_id: str, job: dict = None) -> int:
+        """Add or replace a job with a single write, or cancel it
+
+        :param job_id: the id of the job
+        :param job: the add_job() keyword arguments of the job, without its id (None = cancel the job)
+        :return: 1 if the job is upserted, -1 if it is cancelled, 0 if there was no job to cancel
+        """
+        upserted, cancelled = self.bulk_upsert_or_cancel([(job_id, job)])
+        return upserted or -cancelled
+
+    def cancel(self, job_id: str) -> int:
+        """Cancel a job
+
+        :param job_id: the id of the job
+        :return: 1 if the job is cancelled, 0 if there was no job to cancel
+        """
+        return self.bulk_upsert_or_cancel([(job_id, None)])[1]
+
+    def bulk_upsert_or_cancel(self, operations: Iterable) -> (int, int):
+        """Upsert or cancel several jobs with one bulk write for the upserts and one for the cancellations
+
+        :param operations: the (job_id, job) pairs, job being the add_job() keyword arguments without the id or None
+            to cancel the job
+        :return: the numbers of upserted and cancelled jobs
+        """
+        upserts, cancels = [], []
+        for job_id, job in operations:
+            if job is not None:
+                upserts.append(dict(job, id=job_id))
+            elif job_id in self:
+                cancels.append(job_id)
+
+        upserted = 0
+        if upserts:
+            if isinstance(self.target, BaseScheduler):
+                upserted = add_jobs(self.target, upserts, self.jobstore)
+            else:
+                upserted = self.target.add_jobs(upserts)
+        return upserted, self._remove_jobs(cancels) if cancels else 0
+
+    def _remove_jobs(self, job_ids: list) -> int:
+        if self._known is None:
+            if hasattr(self.target, 'remove_jobs'):
+                return self.target.remove_jobs(job_ids)
+            removed = 0
+            for job_id in job_ids:
+                try:
+                    self.target.remove_job(job_id)
+                    removed += 1
+                except JobLookupError:
+                    pass
+            return removed
+
+        store = self.target._lookup_jobstore(self.jobstore) if self.target.state != STATE_STOPPED else None
+        if isinstance(store, MongoDBJobStore) and len(job_ids) > 1:
+            with self.target._jobstores_lock, metrics.JOBSTORE_LATENCY.time(self.jobstore, 'delete_many'):
+                removed = store.collection.delete_many({'_id': {'$in': job_ids}}).deleted_count
+            for job_id in job_ids:
+                self.target._dispatch_event(JobEvent(EVENT_JOB_REMOVED, job_id, self.jobstore))
+            return removed
+        removed = 0
+        for job_id in job_ids:
+            try:
+                self.target.remove_job(job_id, self.jobstore)
+                removed += 1
+            except JobLookupError:
+                # Already run and removed in the meantime
+                self._known.discard(job_id)
+        return removed
+
+    def _load(self) -> None:
+        store = self.target._lookup_jobstore(self.jobstore)
+        if isinstance(store, MongoDBJobStore):
+            self._known.update(store.collection.distinct('_id'))
+        else:
+            self._known.update(job.id for job in store.get_all_jobs())
+
+    def _track(self, event: SchedulerEvent) -> None:
+        if event.code == EVENT_SCHEDULER_STARTED:
+            self._load()
+        elif event.code == EVENT_ALL_JOBS_REMOVED:
+            if event.alias in (None, self.jobstore):
+                self._known.clear()
+        elif event.jobstore == self.jobstore:
+            if event.code == EVENT_JOB_ADDED:
+                self._known.add(event.job_id)
+            else:
+                self._known.discard(event.job_id)
+
+
+def get_jobs_facade() -> JobsFacade:
+    """Register the jobs facade of the current scheduling target in flask.g or returns it if already existing
+
+    :return: the jobs facade
+    """
+
+    target = getattr(g, 'sharding', None) or g.scheduler
+    facade = getattr(g, 'jobs', None)
+    if facade is None or facade.target is not target:
+        facade = g.jobs = JobsFacade(target)
+    return facade
+
+
+class EMailDispatcher:
+    """This class dispatches the scheduled emails from an in-memory min-heap indexed by EMail.sendAt.
+
+    Every email due within the same second is handed over to the bucket handler in a single call. A rescheduled
+    or cancelled email leaves a stale entry in the heap which is dropped once it reaches the top of it.
+    """
+
+    def __init__(self, on_bucket: Callable[[int, list], None], max_threads: int = 5,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param on_bucket: the handler called with the due second and the ids of the emails due at that second
+        :param max_threads: maximum threads used to run the bucket handlers
+        :param clock: the function returning the current timestamp
+        """
+        self._on_bucket = on_bucket
+        self._max_threads = max_threads
+        self._clock = clock
+        self._heap = []
+        self._due = {}  # email id -> sendAt of its live entry in the heap
+        self._in_flight = set()  # ids of the emails whose bucket handler is running
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._pool = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, oid: str) -> bool:
+        return oid in self._due
+
+    def schedule(self, oid: str, send_at: int) -> int:
+        """Schedule (or reschedule) an email
+
+        :param oid: the ObjectId of the email
+        :param send_at: the timestamp the email is due at
+        :return: 1 if the email is scheduled, else 0
+        """
+        return self.schedule_many([(oid, send_at)])
+
+    def schedule_many(self, schedules: Iterable) -> int:
+        """Schedule (or reschedule) several emails at once
+
+        :param schedules: the (oid, sendAt) pairs to schedule
+        :return: the number of scheduled emails
+        """
+        count = 0
+        with self._cond:
+            head = self._heap[0][0] if self._heap else None
+            for oid, send_at in schedules:
+                send_at = int(send_at)
+                if send_at <= 0:
+                    self._due.pop(oid, None)
+                    continue
+                if self._due.get(oid) != send_at:
+                    self._due[oid] = send_at
+                    heapq.heappush(self._heap, (send_at, oid))
+                count += 1
+            if self._heap and (head is None or self._heap[0][0] < head):
+                self._cond.notify()
+        return count
+
+    def cancel(self, oid: str) -> int:
+        """Cancel the schedule of an email
+
+        :param oid: the ObjectId of the email
+        :return: 1 if a schedule was cancelled, else 0
+        """
+        with self._cond:
+            return 0 if self._due.pop(oid, None) is None else 1
+
+    def rebuild(self, schedules: Iterable) -> int:
+        """Replace the whole state of the dispatcher
+
+        The emails whose bucket handler is running are left out: they may still be pending when the schedules are read.
+
+        :param schedules: the (oid, sendAt) pairs of every pending email
+        :return: the number of scheduled emails
+        """
+        with self._cond:
+            self._due = {oid: int(send_at) for oid, send_at in schedules
+                         if int(send_at) > 0 and oid not in self._in_flight}
+            self._heap = [(send_at, oid) for oid, send_at in self._due.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+            return len(self._due)
+
+    def next_due(self):
+        """Return the timestamp of the next due email or None if nothing is scheduled"""
+        with self._cond:
+            return self._peek()
+
+    def pop_due(self, now: float = None) -> list:
+        """Remove every email due at the given time and group them by second
+
+        :param now: the current timestamp (default to the dispatcher clock)
+        :return: the list of (second, [oid, ...]) buckets, sorted by second
+        """
+        now = self._clock() if now is None else now
+        buckets = []
+        with self._cond:
+            while self._peek() is not None and self._heap[0][0] <= now:
+                send_at, oid = heapq.heappop(self._heap)
+                del self._due[oid]
+                if buckets and buckets[-1][0] == send_at:
+                    buckets[-1][1].append(oid)
+                else:
+                    buckets.append((send_at, [oid]))
+        return buckets
+
+    def start(self) -> None:
+        """Start the dispatching thread"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._pool = BucketPoolExecutor(self._max_threads, thread_name_prefix='schedbill-dispatch')
+        self._thread = threading.Thread(target=self._run, name='schedbill-dispatcher', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the dispatching thread
+
+        :param wait: True to wait for the running bucket handlers to complete
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    def _peek(self):
+        """Return the due time on top of the heap once the stale entries are dropped (lock held)"""
+        while self._heap:
+            send_at, oid = self._heap[0]
+            if self._due.get(oid) == send_at:
+                return send_at
+            heapq.heappop(self._heap)
+        return None
+
+    def _run(self) -> None:
+        """Sleep until the next due second and hand its bucket over to the thread pool"""
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                next_due = self._peek()
+                delay = None if next_due is None else next_due - self._clock()
+                if delay is None or delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            with self._cond:
+                buckets = self.pop_due()
+                for _, oids in buckets:
+                    self._in_flight.update(oids)
+            for second, oids in buckets:
+                self._pool.submit(self._run_bucket, second, oids)
+
+    def _run_bucket(self, second: int, oids: list) -> None:
+        """Run the bucket handler, logging its failures and recording its metrics"""
+        started_at = self._clock()
+        metrics.JOB_DISPATCH_LAG.observe('EMailDispatcher.bucket', value=max(0.0, started_at - second))
+        with db.COMMAND_PROFILER.profile() as profile:
+            try:
+                with metrics.JOB_DURATION.time('EMailDispatcher.bucket'):
+                    self._on_bucket(second, oids)
+                metrics.JOB_RUNS.inc('EMailDispatcher.bucket', 'executed')
+            except Exception as exc:
+                metrics.JOB_RUNS.inc('EMailDispatcher.bucket', 'error')
+                logger.error(f"Dispatcher bucket {second} ({len(oids)} emails) exception : {exc}")
+            finally:
+                with self._cond:
+                    self._in_flight.difference_update(oids)
+        metrics.JOB_DB_COMMANDS.inc('EMailDispatcher.bucket', amount=profile.commands)
+        metrics.JOB_DB_TIME.observe('EMailDispatcher.bucket', value=profile.duration_micros / 1e6)
+
+
+def get_dispatcher() -> EMailDispatcher:
+    """Register the email dispatcher in flask.g, rebuilt from the pending emails, or returns it if already existing
+
+    :return: the email dispatcher
+    """
+
+    dispatcher = getattr(g, 'dispatcher', None)
+    if dispatcher is None:
+        from controllers import EMailController
+        dispatcher = g.dispatcher = EMailDispatcher(
+            EMailController.send_bucket,
+            max_threads=current_app.config.get('SCHEDULER_MAX_THREADS')
+        )
+        count = dispatcher.rebuild(EMailController.pending_schedules())
+        logger.debug(f"Email dispatcher rebuilt with {count} pending emails")
+        dispatcher.start()
+    return dispatcher
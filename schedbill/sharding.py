@@ -0,0 +1,322 @@
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from flask import current_app, g
+from pymongo.errors import DuplicateKeyError
+from typing import Callable
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+import zlib
+import mongoengine
+from scheduler import BaseScheduler, EMailDispatcher, add_jobs
+
+logger = logging.getLogger()
+
+
+def partition_of(oid, partitions: int) -> int:
+    """Compute the partition of a document from a stable hash of its id
+
+    :param oid: the ObjectId (or its string representation) of the document
+    :param partitions: the number of partitions
+    :return: the partition number, in [0, partitions)
+    """
+    return zlib.crc32(str(oid).encode()) % partitions
+
+
+class PartitionLeases:
+    """This class claims and renews a fair share of the partitions through lease documents in MongoDB.
+
+    A lease document ({_id: partition, owner, expiresAt}) grants its owner the partition until expiresAt. Every
+    instance also keeps a heartbeat document in the members collection, so the fair share of partitions can be
+    computed from the number of live instances. Partitions of a dead instance are claimed once its leases expire.
+    """
+
+    def __init__(self, leases, members, partitions: int, ttl: int = 30, owner: str = None,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param leases: the pymongo collection holding the lease documents
+        :param members: the pymongo collection holding the heartbeat documents
+        :param partitions: the number of partitions
+        :param ttl: the time (in seconds) a lease is valid without renewal
+        :param owner: the unique name of this instance (default to host:pid:random)
+        :param clock: the function returning the current timestamp
+        """
+        self.leases = leases
+        self.members = members
+        self.partitions = partitions
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._clock = clock
+        self._owned = frozenset()
+        # Stop using the partitions a bit before the lease expires, so two instances never own one at once
+        self._valid_until = 0
+        self._margin = ttl / 6
+
+    @property
+    def owned(self) -> frozenset:
+        """The partitions currently owned (empty once the leases are about to expire without renewal)"""
+        return self._owned if self._clock() < self._valid_until else frozenset()
+
+    def owns(self, oid) -> bool:
+        """Tell whether the partition of a document is owned by this instance
+
+        :param oid: the ObjectId of the document
+        :return: True if the document partition is owned
+        """
+        return partition_of(oid, self.partitions) in self.owned
+
+    def renew(self) -> (set, set):
+        """Renew the owned leases, then release or claim partitions to converge to a fair share
+
+        :return: the sets of acquired and lost partitions
+        """
+        now = self._clock()
+        expires_at = now + self.ttl
+        self.members.update_one({'_id': self.owner}, {'$set': {'expiresAt': expires_at}}, upsert=True)
+        live_members = self.members.count_documents({'expiresAt': {'$gt': now}})
+        fair_share = math.ceil(self.partitions / max(live_members, 1))
+
+        self.leases.update_many({'owner': self.owner, 'expiresAt': {'$gt': now}}, {'$set': {'expiresAt': expires_at}})
+        leases = {lease['_id']: lease for lease in self.leases.find({}, {'owner': 1, 'expiresAt': 1})}
+        owned = {p for p, lease in leases.items() if lease['owner'] == self.owner and lease['expiresAt'] > now}
+
+        if len(owned) > fair_share:
+            # Another instance joined: give the extra partitions back
+            released = sorted(owned)[fair_share:]
+            self.leases.update_many({'_id': {'$in': released}, 'owner': self.owner}, {'$set': {'expiresAt': 0}})
+            owned.difference_update(released)
+        elif len(owned) < fair_share:
+            free = [p for p in range(self.partitions) if p not in leases or leases[p]['expiresAt'] <= now]
+            random.shuffle(free)
+            for partition in free[:fair_share - len(owned)]:
+                try:
+                    self.leases.find_one_and_update(
+                        {'_id': partition, 'expiresAt': {'$lte': now}},
+                        {'$set': {'owner': self.owner, 'expiresAt': expires_at}},
+                        upsert=True
+                    )
+                    owned.add(partition)
+                except DuplicateKeyError:
+                    # Claimed by another instance in the meantime
+                    pass
+
+        previous = self._owned
+        self._owned = frozenset(owned)
+        self._valid_until = expires_at - self._margin
+        return owned - previous, previous - owned
+
+    def lose(self) -> None:
+        """Stop using the owned partitions at once, when their leases can not be renewed and may lapse"""
+        self._owned = frozenset()
+        self._valid_until = 0
+
+    def release(self) -> None:
+        """Release every owned lease and the heartbeat, so other instances take the partitions over at once"""
+        self.leases.update_many({'owner': self.owner}, {'$set': {'expiresAt': 0}})
+        self.members.delete_one({'_id': self.owner})
+        self._owned = frozenset()
+
+
+class ShardedScheduling:
+    """This class runs the scheduling of the partitions owned by this instance.
+
+    Scheduled jobs are stored in one MongoDBJobStore per partition (collection jobs_p<n>), which is attached to the
+    scheduler only while its lease is owned. Jobs of a partition owned by another instance are written straight to
+    its collection and picked up by the owner on its next renewal. When emails are dispatched by an EMailDispatcher,
+    it is resynchronized with the pending emails of the owned partitions on every renewal.
+    """
+
+    def __init__(self, scheduler: BaseScheduler, leases: PartitionLeases,
+                 pending_schedules: Callable[[int], list] = None, send_due_emails: Callable = None,
+                 max_threads: int = 5, sync_horizon: int = 3600):
+        """
+        :param scheduler: the scheduler running the jobs of the owned partitions
+        :param leases: the partition leases of this instance
+        :param pending_schedules: the function listing the (oid, sendAt) pairs of the emails due before a timestamp
+        :param send_due_emails: the function sending the emails due in [t0, t1) among a list of ids (None = emails
+            are scheduled as jobs, not dispatched)
+        :param max_threads: maximum threads of the email dispatcher
+        :param sync_horizon: how far ahead (in seconds) the pending emails are loaded in the dispatcher
+        """
+        self.scheduler = scheduler
+        self.leases = leases
+        self._pending_schedules = pending_schedules
+        self._send_due_emails = send_due_emails
+        self.dispatcher = EMailDispatcher(self._send_bucket, max_threads) if send_due_emails else None
+        self._sync_horizon = sync_horizon
+        self._attached = set()  # partitions whose job store is attached to the scheduler
+        self._stores = {}  # detached job stores of the partitions owned by other instances
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def jobstore_alias(partition: int) -> str:
+        return f"p{partition}"
+
+    def owns(self, oid) -> bool:
+        return self.leases.owns(oid)
+
+    def add_job(self, func, trigger=None, args=None, id=None, replace_existing=True, **trigger_args):
+        """Add (or replace) a job in the job store of its partition
+
+        :param func: the callable to run
+        :param trigger: the trigger alias or instance
+        :param args: the positional arguments of the callable
+        :param id: the id of the job, which is also the id of the partitioned document
+        :param replace_existing: always True, kept for compatibility with the scheduler API
+        :param trigger_args: the arguments of the trigger
+        """
+        self.add_jobs([dict(func=func, trigger=trigger, args=args or [], id=id, **trigger_args)])
+
+    def add_jobs(self, jobs: list) -> int:
+        """Add (or replace) several jobs with a single bulk operation per partition job store
+
+        :param jobs: the add_job() keyword arguments of each job
+        :return: the number of added jobs
+        """
+        by_partition = {}
+        for job in jobs:
+            by_partition.setdefault(partition_of(job['id'], self.leases.partitions), []).append(job)
+        return sum(add_jobs(self.scheduler, partition_jobs, jobstore=self._jobstore(partition_jobs[0]['id']))
+                   for partition_jobs in by_partition.values())
+
+    def get_job(self, job_id: str):
+        """Return the job from the job store of its partition or None if it does not exist"""
+        store = self._jobstore(job_id)
+        if isinstance(store, str):
+            return self.scheduler.get_job(job_id, store)
+        return store.lookup_job(job_id)
+
+    def remove_job(self, job_id: str) -> None:
+        """Remove the job from the job store of its partition"""
+        store = self._jobstore(job_id)
+        if isinstance(store, str):
+            self.scheduler.remove_job(job_id, store)
+        else:
+            store.remove_job(job_id)
+
+    def start(self) -> None:
+        """Claim the partitions and start the renewal and dispatching threads"""
+        self.renew()
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        self._thread = threading.Thread(target=self._run, name='schedbill-leases', daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        """Stop the renewal and dispatching threads and release the owned partitions"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        for partition in list(self._attached):
+            self._detach(partition)
+        self.leases.release()
+
+    def renew(self) -> None:
+        """Renew the leases, attach or detach the partition job stores and resynchronize the dispatcher
+
+        A failed renewal loses every partition: their leases may lapse before the next renewal, so their jobs must not
+        run here anymore.
+        """
+        try:
+            self.leases.renew()
+        except Exception:
+            self.leases.lose()
+            self._detach_lost()
+            raise
+        owned = self._detach_lost()
+        for partition in owned - self._attached:
+            logger.info(f"Partition {partition} acquired by {self.leases.owner}")
+            self._stores.pop(partition, None)
+            self.scheduler.add_jobstore(self._create_jobstore(partition), self.jobstore_alias(partition))
+            self._attached.add(partition)
+        if self.dispatcher is not None:
+            self.dispatcher.rebuild(
+                (oid, send_at) for oid, send_at in self._pending_schedules(int(time.time()) + self._sync_horizon)
+                if partition_of(oid, self.leases.partitions) in owned
+            )
+        # Pick up the jobs written by the other instances
+        self.scheduler.wakeup()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.leases.ttl / 3):
+            # the leases may have lapsed during a renewal slower than their validity
+            self._detach_lost()
+            try:
+                self.renew()
+            except Exception as exc:
+                logger.error(f"Partition leases renewal failed for {self.leases.owner} : {exc}")
+
+    def _send_bucket(self, second: int, oids: list) -> None:
+        """Send the emails of a dispatcher bucket which still belong to an owned partition"""
+        oids = [oid for oid in oids if self.leases.owns(oid)]
+        if oids:
+            self._send_due_emails(second, second + 1, oids)
+
+    def _detach_lost(self) -> frozenset:
+        """Detach the job stores of the partitions whose lease is not held anymore, and return the owned partitions"""
+        owned = self.leases.owned
+        for partition in self._attached - owned:
+            logger.info(f"Partition {partition} lost by {self.leases.owner}")
+            self._detach(partition)
+        return owned
+
+    def _detach(self, partition: int) -> None:
+        self.scheduler.remove_jobstore(self.jobstore_alias(partition), shutdown=False)
+        self._attached.discard(partition)
+
+    def _jobstore(self, job_id: str):
+        """Return the alias of the job store of an owned partition, or a detached job store otherwise"""
+        partition = partition_of(job_id, self.leases.partitions)
+        if partition in self._attached:
+            return self.jobstore_alias(partition)
+        store = self._stores.get(partition)
+        if store is None:
+            store = self._stores[partition] = self._create_jobstore(partition)
+            store.start(self.scheduler, self.jobstore_alias(partition))
+        return store
+
+    def _create_jobstore(self, partition: int) -> MongoDBJobStore:
+        return MongoDBJobStore(
+            database=mongoengine.connection.get_db().name,
+            collection=f"jobs_p{partition}",
+            client=mongoengine.connection.get_connection()
+        )
+
+
+def get_sharding() -> ShardedScheduling:
+    """Register the sharded scheduling (and its email dispatcher, if any) in flask.g or returns it if already existing
+
+    :return: the sharded scheduling
+    """
+
+    sharding = getattr(g, 'sharding', None)
+    if sharding is None:
+        from controllers import EMailController
+        raw_db = mongoengine.connection.get_db()
+        leases = PartitionLeases(
+            raw_db['scheduler_leases'],
+            raw_db['scheduler_members'],
+            partitions=current_app.config.get('SCHEDULER_PARTITIONS'),
+            ttl=current_app.config.get('SCHEDULER_LEASE_TTL')
+        )
+        dispatching = current_app.config.get('SCHEDULER_EMAIL_DISPATCH') == 'dispatcher'
+        sharding = g.sharding = ShardedScheduling(
+            g.scheduler,
+            leases,
+            pending_schedules=EMailController.pending_schedules,
+            send_due_emails=EMailController.send_due_emails if dispatching else None,
+            max_threads=current_app.config.get('SCHEDULER_MAX_THREADS'),
+            sync_horizon=current_app.config.get('SCHEDULER_SYNC_HORIZON')
+        )
+        if sharding.dispatcher is not None:
+            g.dispatcher = sharding.dispatcher
+        sharding.start()
+    return sharding
@@ -0,0 +1,447 @@
+"""Scheduling simulator (schedbill-simulate), replaying a load of emails and invoices on a virtual clock.
+
+The scheduler runs its real job store and trigger code, but time is virtual: it jumps from one due time to the next
+and the jobs are not run, their execution only occupies a virtual worker of the executor for a modeled cost. A day of
+load is then replayed in seconds, and every scheduler configuration can be compared on the same load.
+
+    python -m schedbill.simulation --emails 1000000 --invoices 1000 --dispatch jobstore bucket dispatcher
+"""
+from apscheduler.executors.base import BaseExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.schedulers.base import BaseScheduler
+from array import array
+from datetime import datetime, timedelta
+from pytz import utc
+from typing import NamedTuple
+import argparse
+import bisect
+import heapq
+import itertools
+import random
+import time
+import tracemalloc
+from scheduler import EMailDispatcher, add_jobs
+
+DAY = 86400
+
+
+class VirtualClock:
+    """A clock which only moves forward when told to"""
+
+    def __init__(self, start: float):
+        """
+        :param start: the initial timestamp
+        """
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def datetime(self, tz=utc) -> datetime:
+        return datetime.fromtimestamp(self.now, tz)
+
+    def advance_to(self, timestamp: float) -> None:
+        self.now = max(self.now, timestamp)
+
+
+class VirtualWorkers:
+    """A pool of virtual workers, each one busy until the end of the last run handed over to it"""
+
+    def __init__(self, max_workers: int, clock: VirtualClock):
+        """
+        :param max_workers: the number of workers
+        :param clock: the virtual clock
+        """
+        self._free_at = [clock()] * max_workers
+        self._clock = clock
+
+    def run(self, cost: float) -> float:
+        """Hand a run over to the first free worker
+
+        :param cost: the time (in seconds) the run occupies the worker
+        :return: the timestamp the run starts at
+        """
+        started_at = max(self._clock(), heapq.heappop(self._free_at))
+        heapq.heappush(self._free_at, started_at + cost)
+        return started_at
+
+
+class SimulatedExecutor(BaseExecutor):
+    """Executor which does not run the jobs: each run occupies a virtual worker for its cost and is recorded"""
+
+    def __init__(self, workers: VirtualWorkers, on_run):
+        """
+        :param workers: the virtual workers of the executor
+        :param on_run: the function called with (job, run_time, workers) on each submitted run, which hands the run
+            over to the workers and records it
+        """
+        super().__init__()
+        self.workers = workers
+        self._on_run = on_run
+
+    def submit_job(self, job, run_times) -> None:
+        for run_time in run_times:
+            self._on_run(job, run_time, self.workers)
+
+    def _do_submit_job(self, job, run_times) -> None:
+        pass
+
+
+class SimulatedScheduler(BaseScheduler):
+    """Scheduler processing its jobs on a virtual clock, whenever the simulation tells it to"""
+
+    def __init__(self, clock: VirtualClock, **options):
+        """
+        :param clock: the virtual clock
+        :param options: the scheduler options, see BaseScheduler.configure()
+        """
+        self.clock = clock
+        super().__init__(**options)
+
+    def shutdown(self, wait: bool = True) -> None:
+        super().shutdown(wait)
+
+    def wakeup(self) -> None:
+        # The simulation processes the jobs at the next wakeup time by itself
+        pass
+
+    def process_jobs(self):
+        """Submit the due jobs as BaseScheduler._process_jobs() does, at the virtual time
+
+        :return: the next wakeup time or None if there is no job left
+        """
+        now = self.clock.datetime(self.timezone)
+        next_wakeup_time = None
+        with self._jobstores_lock:
+            for alias, store in self._jobstores.items():
+                for job in store.get_due_jobs(now):
+                    run_times = job._get_run_times(now)
+                    run_times = run_times[-1:] if run_times and job.coalesce else run_times
+                    if run_times:
+                        self._lookup_executor(job.executor).submit_job(job, run_times)
+                        next_run_time = job.trigger.get_next_fire_time(run_times[-1], now)
+                        if next_run_time:
+                            job._modify(next_run_time=next_run_time)
+                            store.update_job(job)
+                        else:
+                            self.remove_job(job.id, alias)
+                store_next_run_time = store.get_next_run_time()
+                if store_next_run_time and (next_wakeup_time is None or store_next_run_time < next_wakeup_time):
+                    next_wakeup_time = store_next_run_time
+        return next_wakeup_time
+
+
+def simulated_job(*args) -> None:
+    """The callable of the simulated jobs, never run"""
+
+
+class Load(NamedTuple):
+    """A load of emails and invoices to replay"""
+    send_ats: list  # the sending times, relative to the start of the simulation, in increasing order
+    periodicities: list  # the periodicities of the invoices
+
+
+def synthetic_load(emails: int, invoices: int = 0, duration: int = DAY, peak_ratio: float = 0.3,
+                   seed: int = 0) -> Load:
+    """Generate a load of emails spread over a duration, part of them due on the round minutes
+
+    :param emails: the number of emails
+    :param invoices: the number of periodic invoices
+    :param duration: the time (in seconds) the emails are spread over
+    :param peak_ratio: the part of the emails due on a round minute, as users favour them
+    :param seed: the seed of the random generator, so the load is reproducible
+    :return: the load
+    """
+    rng = random.Random(seed)
+    send_ats = sorted(
+        rng.randrange(0, duration, 60) if rng.random() < peak_ratio else rng.randrange(duration)
+        for _ in range(emails)
+    )
+    periodicities = [rng.choice((3600, 6 * 3600, DAY, 7 * DAY)) for _ in range(invoices)]
+    return Load(send_ats, periodicities)
+
+
+def recorded_load(raw_db, since: int = None) -> Load:
+    """Read the load of the pending emails and the periodic invoices of a database
+
+    :param raw_db: the pymongo database
+    :param since: the timestamp the load starts at (default to the first sending time)
+    :return: the load
+    """
+    send_ats = sorted(
+        email['sendAt'] for email in raw_db['emails'].find({'sentAt': 0, 'sendAt': {'$gt': 0}}, {'sendAt': 1})
+    )
+    since = send_ats[0] if since is None and send_ats else since or 0
+    periodicities = [
+        invoice['periodicity'] for invoice in raw_db['invoices'].find({'periodicity': {'$gt': 0}}, {'periodicity': 1})
+    ]
+    return Load([send_at - since for send_at in send_ats if send_at >= since], periodicities)
+
+
+class SimulationConfig(NamedTuple):
+    """A scheduler configuration to simulate"""
+    dispatch: str = 'jobstore'  # the SCHEDULER_EMAIL_DISPATCH mode
+    max_threads: int = 20  # the threads of the default executor
+    job_coalesce: bool = True
+    misfire_grace_time: int = None
+    jobstore: str = 'memory'  # 'memory' or 'mongomock'
+    job_cost: float = 0.002  # the time (in seconds) a job run takes besides its emails (queries)
+    email_cost: float = 0.0005  # the time (in seconds) sending one email takes
+    horizon: int = 3600  # how far ahead (in seconds) the emails are scheduled (None = all of them at once)
+    processing_time: bool = True  # True = the scheduler processing time (real) delays the virtual clock
+
+    def __str__(self) -> str:
+        return (f"{self.dispatch}/{self.jobstore} threads={self.max_threads} coalesce={self.job_coalesce} "
+                f"grace={self.misfire_grace_time}")
+
+
+class SimulationReport(NamedTuple):
+    """The results of a simulation"""
+    config: SimulationConfig
+    emails: int  # the number of sent emails
+    invoices: int  # the number of invoice runs
+    missed: int  # the number of runs skipped for being later than the misfire grace time
+    dispatch_rate: float  # emails dispatched per second of scheduler processing (real) time, scheduling excluded
+    email_lag: dict  # the percentiles (p50, p90, p99, max) of the delay between the sending time and the sending
+    invoice_lag: dict  # the percentiles of the delay between the planned run of an invoice and its run
+    peak_memory: float  # the peak memory (in MB) allocated while simulating, None if not traced
+    wall_time: float  # the real time (in seconds) the simulation took
+
+    def __str__(self) -> str:
+        memory = '-' if self.peak_memory is None else f"{self.peak_memory:.1f}MB"
+        return (f"{self.config}\n"
+                f"  emails={self.emails} invoices={self.invoices} missed={self.missed} "
+                f"rate={self.dispatch_rate:.0f}/s memory={memory} wall={self.wall_time:.1f}s\n"
+                f"  email lag {_format_lag(self.email_lag)}\n"
+                f"  invoice lag {_format_lag(self.invoice_lag)}")
+
+
+def percentiles(values) -> dict:
+    """Return the p50, p90, p99 and max of the values, None for an empty list"""
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    return {
+        'p50': values[len(values) // 2],
+        'p90': values[min(len(values) - 1, len(values) * 90 // 100)],
+        'p99': values[min(len(values) - 1, len(values) * 99 // 100)],
+        'max': values[-1]
+    }
+
+
+def _format_lag(lag: dict) -> str:
+    return ' '.join(f"{key}={'-' if value is None else f'{value:.3f}s'}" for key, value in lag.items())
+
+
+class Simulation:
+    """This class replays a load on a simulated scheduler configuration and measures the dispatching."""
+
+    def __init__(self, load: Load, config: SimulationConfig = SimulationConfig(), start: float = None):
+        """
+        :param load: the load to replay
+        :param config: the scheduler configuration
+        :param start: the timestamp the simulation starts at, which must not be past as the triggers compute their
+            first run from the real time (default to the next midnight UTC)
+        """
+        self.load = load
+        self.config = config
+        self.clock = VirtualClock(start if start is not None else (int(time.time()) // DAY + 1) * DAY)
+        self.start = self.clock()
+        self._email_lag = array('d')
+        self._invoice_lag = array('d')
+        self._missed = 0
+        self._bucket_sizes = {}
+        self._processing = 0.0
+
+    def run(self, until: float = None, trace_memory: bool = True) -> SimulationReport:
+        """Replay the whole load
+
+        :param until: the relative time (in seconds) the simulation stops at (default to the last sending time)
+        :param trace_memory: True to measure the peak memory, which slows the simulation down
+        :return: the report of the simulation
+        """
+        wall_started = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            self._run(self.start + (until if until is not None else (self.load.send_ats or [0])[-1] + 1))
+            peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        emails = len(self._email_lag)
+        return SimulationReport(
+            config=self.config,
+            emails=emails,
+            invoices=len(self._invoice_lag),
+            missed=self._missed,
+            dispatch_rate=emails / self._processing if self._processing else 0.0,
+            email_lag=percentiles(self._email_lag),
+            invoice_lag=percentiles(self._invoice_lag),
+            peak_memory=peak_memory,
+            wall_time=time.perf_counter() - wall_started
+        )
+
+    def _run(self, end: float) -> None:
+        config = self.config
+        scheduler = self._setup_scheduler()
+        dispatcher = None
+        if config.dispatch == 'dispatcher':
+            workers = scheduler._lookup_executor('default').workers
+            dispatcher = EMailDispatcher(lambda second, oids: self._run_bucket(second, len(oids), workers),
+                                         clock=self.clock)
+        scheduler.start()
+        add_jobs(scheduler, [
+            dict(func=simulated_job, trigger='interval', seconds=periodicity, id=f"invoice{index}",
+                 # the first runs are spread over the periodicity
+                 start_date=self.clock.datetime() + timedelta(
+                     seconds=periodicity * (index + 1) // (len(self.load.periodicities) + 1)
+                 ),
+                 args=['invoice'])
+            for index, periodicity in enumerate(self.load.periodicities)
+        ])
+
+        send_ats = self.load.send_ats
+        loaded, refill_at = 0, self.clock()
+        while True:
+            if self.clock() >= refill_at:
+                # The emails are created ahead of their sending time, up to the horizon, refilled every half horizon
+                horizon = end if config.horizon is None else self.clock() + config.horizon
+                upto = bisect.bisect_left(send_ats, horizon - self.start, loaded)
+                self._schedule(scheduler, dispatcher, loaded, upto)
+                loaded = upto
+                refill_at = end if config.horizon is None else self.clock() + config.horizon / 2
+
+            started = time.perf_counter()
+            next_wakeup_time = scheduler.process_jobs()
+            if dispatcher is not None:
+                for second, oids in dispatcher.pop_due(self.clock()):
+                    dispatcher._on_bucket(second, oids)
+            processing = time.perf_counter() - started
+            self._processing += processing
+
+            next_times = [next_wakeup_time.timestamp()] if next_wakeup_time else []
+            if dispatcher is not None and dispatcher.next_due() is not None:
+                next_times.append(dispatcher.next_due())
+            if loaded < len(send_ats):
+                next_times.append(refill_at)
+            if not next_times or min(next_times) >= end:
+                break
+            # The scheduler is busy while processing, the next round can not start earlier
+            self.clock.advance_to(max(min(next_times), self.clock() + (processing if config.processing_time else 0)))
+        scheduler.shutdown()
+
+    def _setup_scheduler(self) -> SimulatedScheduler:
+        config = self.config
+        if config.jobstore == 'mongomock':
+            import mongomock
+            jobstore = MongoDBJobStore(client=mongomock.MongoClient())
+        else:
+            jobstore = MemoryJobStore()
+        return SimulatedScheduler(
+            self.clock,
+            jobstores={'default': jobstore},
+            executors={'default': SimulatedExecutor(VirtualWorkers(config.max_threads, self.clock), self._run_job)},
+            job_defaults={
+                'coalesce': config.job_coalesce,
+                'misfire_grace_time': config.misfire_grace_time,
+                'max_instances': 1
+            },
+            timezone=utc
+        )
+
+    def _schedule(self, scheduler: SimulatedScheduler, dispatcher: EMailDispatcher, first: int, last: int) -> None:
+        """Schedule the emails of the load between two indexes, as the EMailController does"""
+        if first == last:
+            return
+        send_ats = [int(self.start) + send_at for send_at in self.load.send_ats[first:last]]
+        if self.config.dispatch == 'dispatcher':
+            dispatcher.schedule_many((f"email{index}", send_at) for index, send_at in enumerate(send_ats, first))
+        elif self.config.dispatch == 'bucket':
+            seconds = {}
+            for send_at in send_ats:
+                seconds[send_at] = seconds.get(send_at, 0) + 1
+            for second, count in seconds.items():
+                self._bucket_sizes[second] = self._bucket_sizes.get(second, 0) + count
+            add_jobs(scheduler, [
+                dict(func=simulated_job, trigger='date', run_date=datetime.fromtimestamp(second, utc),
+                     id=f"emails@{second}", args=['bucket', second]) for second in seconds
+            ])
+        else:
+            add_jobs(scheduler, [
+                dict(func=simulated_job, trigger='date', run_date=datetime.fromtimestamp(send_at, utc),
+                     id=f"email{index}", args=['email']) for index, send_at in enumerate(send_ats, first)
+            ])
+
+    def _run_job(self, job, run_time: datetime, workers: VirtualWorkers) -> None:
+        kind = job.args[0]
+        if kind == 'bucket':
+            self._run_bucket(job.args[1], self._bucket_sizes.pop(job.args[1], 0), workers, job.misfire_grace_time)
+            return
+        started_at = workers.run(self.config.job_cost + (self.config.email_cost if kind == 'email' else 0))
+        lag = started_at - run_time.timestamp()
+        if job.misfire_grace_time is not None and lag > job.misfire_grace_time:
+            self._missed += 1
+        elif kind == 'email':
+            self._email_lag.append(lag + self.config.job_cost + self.config.email_cost)
+        else:
+            self._invoice_lag.append(lag)
+
+    def _run_bucket(self, second: int, count: int, workers: VirtualWorkers, misfire_grace_time: int = None) -> None:
+        """Run the job sending the emails due at a second, one after the other after a single query"""
+        started_at = workers.run(self.config.job_cost + count * self.config.email_cost)
+        lag = started_at - second
+        if misfire_grace_time is not None and lag > misfire_grace_time:
+            self._missed += count
+            return
+        self._email_lag.extend(lag + self.config.job_cost + (rank + 1) * self.config.email_cost
+                               for rank in range(count))
+
+
+def main(argv: list = None) -> int:
+    """Simulate every combination of the given scheduler configurations on a synthetic load, then print reports
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-simulate', description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=100000, help='number of emails of the synthetic load')
+    parser.add_argument('--invoices', type=int, default=100, help='number of periodic invoices')
+    parser.add_argument('--duration', type=int, default=DAY, help='time (in seconds) the emails are spread over')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic load')
+    parser.add_argument('--dispatch', nargs='+', default=['jobstore', 'bucket', 'dispatcher'],
+                        choices=['jobstore', 'bucket', 'dispatcher'], help='email dispatch modes to simulate')
+    parser.add_argument('--threads', nargs='+', type=int, default=[20], help='threads of the default executor')
+    parser.add_argument('--jobstore', nargs='+', default=['memory'], choices=['memory', 'mongomock'],
+                        help='job stores to simulate (mongomock is much slower, for small loads)')
+    parser.add_argument('--misfire-grace-time', type=int, default=None, help='misfire grace time (in seconds)')
+    parser.add_argument('--no-coalesce', action='store_true', help='do not coalesce the late runs')
+    parser.add_argument('--job-cost', type=float, default=SimulationConfig._field_defaults['job_cost'],
+                        help='time (in seconds) a job run takes besides its emails')
+    parser.add_argument('--email-cost', type=float, default=SimulationConfig._field_defaults['email_cost'],
+                        help='time (in seconds) sending one email takes')
+    parser.add_argument('--horizon', type=int, default=SimulationConfig._field_defaults['horizon'],
+                        help='how far ahead (in seconds) the emails are scheduled (0 = all of them at once)')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure the memory, which is faster')
+    args = parser.parse_args(argv)
+
+    load = synthetic_load(args.emails, args.invoices, args.duration, seed=args.seed)
+    for dispatch, max_threads, jobstore in itertools.product(args.dispatch, args.threads, args.jobstore):
+        config = SimulationConfig(
+            dispatch=dispatch,
+            max_threads=max_threads,
+            job_coalesce=not args.no_coalesce,
+            misfire_grace_time=args.misfire_grace_time,
+            jobstore=jobstore,
+            job_cost=args.job_cost,
+            email_cost=args.email_cost,
+            horizon=args.horizon or None
+        )
+        print(Simulation(load, config).run(until=args.duration, trace_memory=not args.no_memory), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
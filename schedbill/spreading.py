@@ -0,0 +1,180 @@
+"""Load spreading (schedbill-spread), delaying the jobs planned on the same second across a window following it.
+
+The invoices notify their recipients at notifyAt, usually a round time (09:00...): thousands of emails are then due on
+the same second and overflow the executor. Each job is delayed by a jitter derived from its id, so the same job is
+always delayed the same way. In the capacity mode, a job is delayed further to the first second of the window under a
+target rate, counting the pending emails already due then.
+
+    python -m schedbill.spreading --jobs 20000 --window 600 --rate 0 50
+"""
+from collections import Counter
+from flask import current_app, g
+import argparse
+import threading
+import zlib
+import metrics
+from models import EMail
+from simulation import percentiles
+
+# Seconds the load of the past is kept for, by the spreader
+LOAD_MEMORY = 86400
+
+
+def jitter(oid: str, window: int) -> int:
+    """Return the delay of a job within a window, the same for every run of the job
+
+    :param oid: the id of the job (the ObjectId of the invoice...)
+    :param window: the number of seconds the jobs are spread over
+    :return: the delay in seconds, between 0 and window - 1
+    """
+
+    return zlib.crc32(oid.encode()) % window if window > 0 else 0
+
+
+def pending_counts(start: int, end: int) -> dict:
+    """Count the pending emails due on each second of a window, from the pending_emails index only
+
+    :param start: the first second of the window
+    :param end: the second the window ends before
+    :return: the number of emails by sending time
+    """
+
+    return {count['_id']: count['n'] for count in EMail._get_collection().aggregate([
+        {'$match': {'sentAt': 0, 'sendAt': {'$gte': start, '$lt': end}}},
+        {'$group': {'_id': '$sendAt', 'n': {'$sum': 1}}}
+    ], hint='pending_emails')}
+
+
+class LoadSpreader:
+    """This class spreads the jobs planned on the same second across the window following it, and reports how."""
+
+    def __init__(self, window: int = 0, rate: int = 0, counts=None):
+        """
+        :param window: the number of seconds after its planned time a job can be delayed by (0 = no spreading)
+        :param rate: the target jobs per second (0 = the jitter only, whatever the load)
+        :param counts: the function returning the number of jobs already due by second in a window (start, end), read
+            once per planned second (default to no other jobs)
+        """
+        self.window = window
+        self.rate = rate
+        self._counts = counts
+        self._lock = threading.Lock()
+        self._load = Counter()  # the jobs due by second
+        self._loaded = set()  # the planned seconds whose window load is read
+        self._planned = Counter()  # the spread jobs by planned second
+        self._spread = Counter()  # the spread jobs by second they are due on
+        self._delays = Counter()  # the spread jobs by delay
+
+    def spread(self, oid: str, planned: int) -> int:
+        """Return the time a job planned at a time is due at
+
+        :param oid: the id of the job
+        :param planned: the planned timestamp
+        :return: the timestamp of the second the job is due at
+        """
+
+        if self.window <= 0:
+            return planned
+        planned = int(planned)
+        offset = jitter(oid, self.window)
+        with self._lock:
+            if self.rate > 0:
+                self._read_load(planned)
+                seconds = [planned + (offset + step) % self.window for step in range(self.window)]
+                second = next((second for second in seconds if self._load[second] < self.rate), None)
+                if second is None:  # the whole window is over the rate
+                    second = min(seconds, key=lambda second: self._load[second])
+            else:
+                second = planned + offset
+            self._load[second] += 1
+            self._planned[planned] += 1
+            self._spread[second] += 1
+            self._delays[second - planned] += 1
+        metrics.NOTIFY_SPREAD_DELAY.observe(value=second - planned)
+        return second
+
+    def report(self) -> dict:
+        """Report how the jobs were spread
+
+        :return: the number of jobs spread, the most jobs planned on a second (peak_planned) and due on a second once
+            spread (peak_spread, counting the other jobs in the capacity mode), the number of seconds the jobs are due
+            on, how many are over the rate, and the percentiles (p50, p90, p99, max) of the delays
+        """
+
+        with self._lock:
+            delays = [delay for delay, count in sorted(self._delays.items()) for _ in range(count)]
+            return {
+                'jobs': sum(self._planned.values()),
+                'peak_planned': max(self._planned.values(), default=0),
+                'peak_spread': max((self._load[second] for second in self._spread), default=0),
+                'seconds': len(self._spread),
+                'over_rate': sum(self._load[second] > self.rate for second in self._spread) if self.rate else 0,
+                'delay': percentiles(delays)
+            }
+
+    def _read_load(self, planned: int) -> None:
+        """Read the jobs already due in the window of a planned second, the first time it is spread"""
+
+        if planned in self._loaded:
+            return
+        self._forget(planned - LOAD_MEMORY)
+        self._loaded.add(planned)
+        if self._counts is not None:
+            for second, count in self._counts(planned, planned + self.window).items():
+                # the jobs spread before are already counted if saved since
+                self._load[second] = max(self._load[second], count)
+
+    def _forget(self, before: int) -> None:
+        """Forget the load of the seconds before a time, bounding the memory used"""
+
+        for seconds in (self._load, self._planned, self._spread):
+            for second in [second for second in seconds if second < before]:
+                del seconds[second]
+        self._loaded = {second for second in self._loaded if second >= before}
+
+
+def get_load_spreader() -> LoadSpreader:
+    """Register the load spreader of the invoice notifications in flask.g or returns it if already existing
+
+    :return: the load spreader, spreading over NOTIFY_SPREAD_WINDOW with the NOTIFY_SPREAD_RATE target
+    """
+
+    load_spreader = getattr(g, 'load_spreader', None)
+    if load_spreader is None:
+        load_spreader = g.load_spreader = LoadSpreader(current_app.config.get('NOTIFY_SPREAD_WINDOW', 0),
+                                                       current_app.config.get('NOTIFY_SPREAD_RATE', 0),
+                                                       pending_counts)
+    return load_spreader
+
+
+def main(argv: list = None) -> int:
+    """Spread a herd of jobs planned on the same second, then print how, for each target rate
+
+    :param argv: the command line arguments
+    :return: the exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='schedbill-spread', description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=10000, help='number of jobs planned on the same second')
+    parser.add_argument('--window', type=int, default=600, help='seconds the jobs are spread over')
+    parser.add_argument('--rate', nargs='+', type=int, default=[0, 20],
+                        help='target jobs per second (0 = the jitter only)')
+    parser.add_argument('--background', type=int, default=0,
+                        help='jobs already due on each second of the window, as other emails')
+    args = parser.parse_args(argv)
+
+    planned = 0
+    oids = [f"{number:024x}" for number in range(args.jobs)]
+    for rate in args.rate:
+        spreader = LoadSpreader(args.window, rate, lambda start, end: dict.fromkeys(range(start, end), args.background))
+        for oid in oids:
+            spreader.spread(oid, planned)
+        report = spreader.report()
+        print(f"rate={rate or '-'} jobs={report['jobs']} peak planned={report['peak_planned']}/s "
+              f"spread={report['peak_spread']}/s over {report['seconds']}s, {report['over_rate']}s over the rate, "
+              f"delay " + ' '.join(f"{key}={value}s" for key, value in report['delay'].items()))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,70 @@
-from datetime import datetime, timezone
+from datetime import date, datetime, time, timedelta, timezone
 from dateutil.parser import parse
+from functools import lru_cache
 from helpers import is_float
 import pytz
 
+try:
+    import numpy
+except ImportError:  # the batch methods convert item by item and return lists instead of arrays
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1)
+
+# Date strings whose timestamp is remembered, the least recently parsed beyond are forgotten
+PARSED_DATES_SIZE = 4096
+# UTC days whose UTC offset is remembered for each timezone, the least recently used beyond are forgotten
+UTC_DAYS_SIZE = 65536
+
+
+@lru_cache(maxsize=PARSED_DATES_SIZE)
+def parse_date_string(date_string: str, today: date) -> int:
+    """Convert a string representing a date and time to a timestamp, parsing ISO 8601 directly and anything else with
+    dateutil. The timestamps are remembered, so that the dates repeated throughout a batch are parsed only once.
+
+    :param date_string: the date and time, in the local timezone unless it holds its own
+    :param today: the current date, which dateutil completes partial dates and times with
+    :return: the timestamp of the date
+    """
+
+    try:
+        return int(datetime.fromisoformat(date_string).timestamp())
+    except ValueError:
+        return int(parse(date_string, default=datetime.combine(today, datetime.min.time())).timestamp())
+
+
+@lru_cache(maxsize=None)
+def timezone_of(tz: str) -> pytz.BaseTzInfo:
+    """Return the timezone of a name, looked up in the tz database once"""
+    return pytz.timezone(tz)
+
+
+# The timestamps of the midnights starting the current day and the next one, by timezone (None for the local time)
+_midnights = {}
+
+
+@lru_cache(maxsize=UTC_DAYS_SIZE)
+def utc_day_offset(tz: str, day: int):
+    """Return the UTC offset of a timezone during a UTC day, if it does not change within the day
+
+    :param tz: the timezone
+    :param day: the UTC day, as the number of days since the epoch
+    :return: the UTC offset (in seconds), None if it changes within the day
+    """
+
+    tzinfo = timezone_of(tz)
+    start, end = (datetime.fromtimestamp(day * 86400 + second, tzinfo).utcoffset() for second in (0, 86399))
+    return int(start.total_seconds()) if start == end else None
+
+
+def local_day(ts, tz: str) -> int:
+    """Return the day of a timestamp in a timezone, as the number of days since the epoch"""
+
+    offset = utc_day_offset(tz, int(ts // 86400))
+    if offset is None:
+        return (datetime.fromtimestamp(ts, timezone_of(tz)).date() - EPOCH.date()).days
+    return int(ts + offset) // 86400
+
 
 class TimeCalc:
     """This class provides class methods to ease timestamp and datetime conversions."""
@@ -20,14 +82,44 @@ class TimeCalc:
         elif isinstance(date_arg, str):
             if str.isnumeric(date_arg) :  # the argument is a string which represents a timestamp
                 return int(date_arg)
-            elif is_float(date_arg):  # the argument is a string which represents a timestamp with milliseconds
+            try:  # the argument is a string which represents a timestamp with milliseconds
                 return int(float(date_arg))
-            else: # the argument is a string which has to represent a date and time
-                dtfs = parse(date_arg)
-                return int(dtfs.timestamp())
-        elif is_float(date_arg):  # the argument is already a timestamp
+            except ValueError:  # the argument is a string which has to represent a date and time
+                return parse_date_string(date_arg, date.today())
+        elif isinstance(date_arg, (int, float)) or is_float(date_arg):  # the argument is already a timestamp
             return int(date_arg)
 
+    @classmethod
+    def args_to_timestamps(cls, date_args) -> list:
+        """Convert arguments to timestamps, as arg_to_timestamp() does
+
+        :param date_args: the dates, as strings or numerics, representing parsable dates or timestamps
+        :return: the list of the timestamps representations of the dates
+        """
+
+        arg_to_timestamp = cls.arg_to_timestamp
+        return [arg_to_timestamp(date_arg) for date_arg in date_args]
+
+    @classmethod
+    def to_timestamps(cls, date_args):
+        """Convert a column of dates to timestamps in one pass, as arg_to_timestamp() does for each of them. A NumPy
+        array of numbers is converted as a whole, the distinct values of anything else are converted once each.
+
+        :param date_args: the sequence or the NumPy array of the dates, as strings or numerics, representing parsable
+            dates or timestamps
+        :return: the NumPy array (int64) of the timestamps, a list if NumPy is not installed
+        """
+
+        if numpy is not None and isinstance(date_args, numpy.ndarray) and date_args.dtype.kind in 'iuf':
+            if date_args.dtype.kind == 'f' and not numpy.isfinite(date_args).all():
+                raise ValueError('Timestamps must be finite')
+            return date_args.astype(numpy.int64)  # truncated toward zero, as int() does
+        timestamps = {}
+        arg_to_timestamp = cls.arg_to_timestamp
+        converted = [timestamps[date_arg] if date_arg in timestamps
+                     else timestamps.setdefault(date_arg, arg_to_timestamp(date_arg))
+                     for date_arg in date_args]
+        return converted if numpy is None else numpy.array(converted, dtype=numpy.int64)
 
     @classmethod
     def timestamp_to_datetime(cls, ts, tz='utc'):
@@ -37,9 +129,7 @@ class TimeCalc:
         :param tz: the timezone to use for the conversion (default to UTC)
         :return: the datetime object representing the timestamp converted in the destination timezone
         """
-        local_date = datetime.fromtimestamp(ts)
-        target_tz = pytz.timezone(tz)
-        return local_date.astimezone(target_tz)
+        return datetime.fromtimestamp(ts, timezone_of(tz))
 
     @classmethod
     def next_run_timestamp(cls, periodicity: int = 0) -> int:
@@ -54,13 +144,97 @@ class TimeCalc:
             return 0
 
     @classmethod
-    def today_trigger(cls, sec_from_midnight: int) -> int:
+    def next_run_timestamps(cls, periodicities):
+        """Compute the timestamps adding periodicities in seconds to the current time, as next_run_timestamp() does for
+        each of them, in one pass
+
+        :param periodicities: the sequence or the NumPy array of the periodicities in seconds
+        :return: the NumPy array (int64) of the computed timestamps, 0 for no periodicity, a list if NumPy is not
+            installed
+        """
+
+        now = datetime.now().timestamp()
+        if numpy is None:
+            return [int(now + periodicity) if periodicity > 0 else 0 for periodicity in periodicities]
+        periodicities = numpy.asarray(periodicities)
+        return numpy.where(periodicities > 0, now + periodicities, 0).astype(numpy.int64)
+
+    @classmethod
+    def midnight_timestamp(cls, ts, tz='utc') -> int:
+        """Compute the timestamp of the midnight starting the day of a timestamp in a timezone
+
+        :param ts: the timestamp
+        :param tz: the timezone the day is reckoned in (default to UTC)
+        :return: the timestamp of the midnight, in standard time if the day starts twice
+        """
+
+        return cls.day_midnight(cls.timestamp_to_datetime(ts, tz).date(), tz)
+
+    @classmethod
+    def midnight_timestamps(cls, timestamps, tz='utc'):
+        """Compute the timestamps of the midnights starting the days of timestamps in a timezone, as
+        midnight_timestamp() does for each of them, in one pass: the local days are reckoned with the UTC offset of
+        each distinct UTC day (computed once per timezone and day), then the midnight of each distinct day is computed
+        once.
+
+        :param timestamps: the sequence or the NumPy array of the timestamps
+        :param tz: the timezone the days are reckoned in (default to UTC)
+        :return: the NumPy array (int64) of the timestamps of the midnights, a list if NumPy is not installed
+        """
+
+        if numpy is None:
+            days = [local_day(ts, tz) for ts in timestamps]
+            midnights = {day: cls.day_midnight(EPOCH.date() + timedelta(days=day), tz) for day in set(days)}
+            return [midnights[day] for day in days]
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        flat = timestamps.ravel()
+        utc_days, utc_inverse = numpy.unique(flat // 86400, return_inverse=True)
+        day_offsets = [utc_day_offset(tz, int(day)) for day in utc_days]
+        offsets = numpy.array([offset or 0 for offset in day_offsets], dtype=numpy.int64)[utc_inverse.ravel()]
+        days = (flat + offsets) // 86400
+        # the UTC offset changes within some days: their timestamps are converted one by one
+        changing = numpy.array([offset is None for offset in day_offsets])[utc_inverse.ravel()]
+        if changing.any():
+            days[changing] = [local_day(int(ts), tz) for ts in flat[changing]]
+        days, inverse = numpy.unique(days, return_inverse=True)
+        midnights = numpy.array([cls.day_midnight(EPOCH.date() + timedelta(days=int(day)), tz) for day in days],
+                                dtype=numpy.int64)
+        return midnights[inverse.reshape(timestamps.shape)]
+
+    @classmethod
+    def day_midnight(cls, day: date, tz: str) -> int:
+        """Compute the timestamp of the midnight starting a day in a timezone"""
+        return int(timezone_of(tz).localize(datetime.combine(day, time())).timestamp())
+
+    @classmethod
+    def today_midnight(cls, tz: str = None) -> int:
+        """Return the timestamp of the midnight starting the current day in a timezone, computed again only once the
+        day is over
+
+        :param tz: the timezone (default to the local time)
+        :return: the timestamp of the midnight
+        """
+
+        now = datetime.now().timestamp()
+        midnights = _midnights.get(tz)
+        if midnights is None or not midnights[0] <= now < midnights[1]:
+            if tz is None:
+                today = datetime.fromtimestamp(now).date()
+                midnights = (int(datetime.combine(today, time()).timestamp()),
+                             int(datetime.combine(today + timedelta(days=1), time()).timestamp()))
+            else:
+                today = cls.timestamp_to_datetime(now, tz).date()
+                midnights = (cls.day_midnight(today, tz), cls.day_midnight(today + timedelta(days=1), tz))
+            _midnights[tz] = midnights
+        return midnights[0]
+
+    @classmethod
+    def today_trigger(cls, sec_from_midnight: int, tz: str = None) -> int:
         """Compute a timestamp adding a number of seconds to the current day starting at midnight
 
         :param sec_from_midnight:the number of seconds to add
+        :param tz: the timezone of the day (default to the local time)
         :return: the commuted timestamp
         """
-        today_string = datetime.now().strftime("%Y-%m-%d 00:00:00")
-        today_ts = parse(today_string).timestamp()
 
-        return today_ts + sec_from_midnight
+        return cls.today_midnight(tz) + sec_from_midnight
@@ -1,10 +1,127 @@
-from flask import current_app, g, request, jsonify
-from controllers import UserController, EMailController, InvoiceController
+from flask import current_app, g, request, jsonify, Response, stream_with_context
+from flask.app import BadRequest
+from controllers import UserController, EMailController, InvoiceController, decode_cursor, encode_cursor
+import encoding
+import json
+import metrics
 import logging
+from spreading import get_load_spreader
 
 logger = logging.getLogger()
 
 
+def read_batch() -> list:
+    """Read the items of a batch request, sent either as a JSON array or as NDJSON (one JSON object per line)
+
+    :return: the list of items
+    """
+
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        items = []
+        for number, item in parse_ndjson(request.get_data(as_text=True).splitlines()):
+            if isinstance(item, ValueError):
+                raise BadRequest(f"Invalid JSON on line {number} : {item}")
+            items.append(item)
+        return items
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise BadRequest('A JSON array of items is expected')
+    return items
+
+
+def parse_ndjson(lines) -> iter:
+    """Parse NDJSON (one JSON object per line) lazily, line by line as they are read, skipping the blank lines
+
+    :param lines: the iterator over the lines, as str or bytes
+    :return: the iterator over the (line number, item) pairs, the item being the ValueError met on an invalid line
+    """
+
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError as exc:
+                yield number, exc
+
+
+def read_fields() -> list:
+    """Read the fields projection of a request, given as a comma separated 'fields' query parameter
+
+    :return: the list of fields, None to get every field
+    """
+
+    fields = request.args.get('fields')
+    return [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+
+
+def read_page(sort: tuple = ('_id',)) -> (int, list):
+    """Read the size and the cursor of the page a listing request asks for
+
+    :param sort: the sort keys of the listing, '_id' last
+    :return: the maximum number of items of the page (API_PAGE_SIZE by default, at most API_PAGE_MAX_SIZE) and the
+        keys the page starts after (None for the first page)
+    """
+
+    limit = request.args.get('limit', current_app.config.get('API_PAGE_SIZE'), type=int)
+    limit = max(1, min(limit, current_app.config.get('API_PAGE_MAX_SIZE')))
+    return limit, read_cursor(sort)
+
+
+def read_cursor(sort: tuple = ('_id',)) -> list:
+    """Read the cursor a listing or an export request resumes from
+
+    :param sort: the sort keys of the documents, '_id' last
+    :return: the keys the documents start after (None to start from the first document)
+    """
+
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor, sort)
+    except ValueError as exc:
+        raise BadRequest(str(exc))
+
+
+def page_response(documents: list, limit: int, sort: tuple = ('_id',)) -> Response:
+    """Return the response of a listing request, with the cursor of the next page if there is one
+
+    :param documents: the raw documents found, up to one more than the page size
+    :param limit: the size of the page
+    :param sort: the sort keys of the documents, '_id' last
+    :return: the JSON response, whose 'next' is the cursor of the next page (null for the last page)
+    """
+
+    cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        cursor = encode_cursor(documents[-1], sort)
+    return jsonify(data=documents, next=cursor)
+
+
+def ndjson_response(documents) -> Response:
+    """Return a response streaming raw documents as NDJSON (one JSON object per line), as they are read
+
+    :param documents: the iterator over the raw documents
+    :return: the streamed response
+    """
+
+    return Response(stream_with_context(ndjson_line(document) for document in documents),
+                    mimetype='application/x-ndjson')
+
+
+def ndjson_line(document: dict) -> str:
+    """Return a raw document as a line of NDJSON"""
+
+    return encoding.dumps(document).decode() + '\n'
+
+
+def raw_reads() -> bool:
+    """Tell whether the endpoint of the request reads raw documents, listed in API_RAW_READS, instead of Documents"""
+
+    return request.endpoint in current_app.config.get('API_RAW_READS', ())
+
+
 def load() -> None:
     """Setup routes using the Flask app context"""
 
@@ -15,15 +132,40 @@ def load() -> None:
     def home() -> None:
         return 'The documentation would fit here'
 
+    # GET the scheduler metrics in the Prometheus text format
+    @current_app.route('/metrics', methods=['GET'])
+    def get_metrics() -> (Response, int):
+        """This route exposes the scheduler metrics of this process"""
+        return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE), 200
+
+    # GET how the invoice notifications were spread by this process
+    @current_app.route('/metrics/spreading', methods=['GET'])
+    def get_spreading() -> (Response, int):
+        """This route reports the load spreading of the invoice notifications (see LoadSpreader.report())"""
+        load_spreader = get_load_spreader()
+        return jsonify(window=load_spreader.window, rate=load_spreader.rate, **load_spreader.report()), 200
+
     #
     # User routes
     #
 
+    # GET a page of users
+    @current_app.route('/users', methods=['GET'])
+    def get_users() -> (str, int):
+        """This route lists the users, by pages in the order of their ids"""
+        limit, after = read_page()
+        users = UserController.find_users(after, limit + 1)
+        logger.debug(f"{request} responded with {min(len(users), limit)} users")
+        return page_response(users, limit), 200
+
     # GET user by oid
     @current_app.route('/users/<string:oid>', methods=['GET'])
     def get_user(oid: str) -> (str, int):
         """This route retrieves a user using its _id"""
-        user = UserController.find(oid)
+        if raw_reads():
+            user = UserController.find_raw(oid, read_fields())
+        else:
+            user = UserController.find(oid)
         logger.debug(f"{request} responded with user with id '{oid}'")
         return jsonify(data=user), 200
 
@@ -43,11 +185,24 @@ def load() -> None:
         logger.debug(f"{request} successfully created a new user'")
         return jsonify(data=user), 201
 
+    # POST a stream of new users
+    @current_app.route('/users/import', methods=['POST'])
+    def import_users() -> (str, int):
+        """This route imports users sent as NDJSON, inserting them by chunks as the lines arrive. The response streams
+        a progress report as NDJSON once each chunk is inserted, listing the lines of the chunk that failed"""
+        if request.mimetype not in ('application/x-ndjson', 'application/jsonl'):
+            raise BadRequest('NDJSON users are expected')
+        reports = UserController.import_users(parse_ndjson(request.stream),
+                                              current_app.config.get('API_IMPORT_CHUNK_SIZE'))
+        logger.debug(f"{request} is importing users")
+        return Response(stream_with_context(json.dumps(report) + '\n' for report in reports),
+                        mimetype='application/x-ndjson'), 200
+
     # PUT (update) user by oid
     @current_app.route('/users/<string:oid>', methods=['PUT'])
     def update_user(oid: str) -> (str, int):
         """This route updates a user, identified by its oid, in the database"""
-        user = UserController.update_user(oid, request.get_json())
+        user = UserController.update_user(oid, request.get_json(), read_fields())
         logger.debug(f"{request} successfully updated user with id {oid}'")
         return jsonify(data=user), 200
 
@@ -63,11 +218,46 @@ def load() -> None:
     # EMail routes
     #
 
+    # GET a page of emails, by sender and sending time
+    @current_app.route('/emails', methods=['GET'])
+    def get_emails() -> (str, int):
+        """This route lists the emails, by pages in the order of their ids or of their sending times (sort=sendAt)"""
+        sort = request.args.get('sort', 'id')
+        limit, after = read_page(EMailController.sort_keys(sort))
+        emails = EMailController.find_emails(
+            sender=request.args.get('sender'),
+            since=request.args.get('since', type=int),
+            until=request.args.get('until', type=int),
+            sort=sort,
+            after=after,
+            limit=limit + 1
+        )
+        logger.debug(f"{request} responded with {min(len(emails), limit)} emails")
+        return page_response(emails, limit, EMailController.sort_keys(sort)), 200
+
+    # GET the emails as an NDJSON stream, by sender and sending time
+    @current_app.route('/emails/export', methods=['GET'])
+    def export_emails() -> (Response, int):
+        """This route streams the emails in the order of their ids, resuming after a cursor if any"""
+        emails = EMailController.export_emails(
+            sender=request.args.get('sender'),
+            since=request.args.get('since', type=int),
+            until=request.args.get('until', type=int),
+            fields=read_fields(),
+            after=read_cursor(),
+            batch_size=current_app.config.get('API_EXPORT_BATCH_SIZE')
+        )
+        logger.debug(f"{request} streaming emails")
+        return ndjson_response(emails), 200
+
     # GET email by id
     @current_app.route('/emails/<string:oid>', methods=['GET'])
     def get_email(oid: str) -> (str, int):
         """This route retrieves an email using its _id"""
-        email = EMailController.find(oid)
+        if raw_reads():
+            email = EMailController.find_raw(oid, read_fields())
+        else:
+            email = EMailController.find(oid)
 
         logger.debug(f"{request} responded with email with id '{oid}'")
         return jsonify(data=email), 200
@@ -81,11 +271,21 @@ def load() -> None:
         logger.debug(f"{request} successfully created a new email'")
         return jsonify(data=email), 201
 
+    # POST a batch of new emails
+    @current_app.route('/emails/batch', methods=['POST'])
+    def new_emails() -> (str, int):
+        """This route creates a batch of new emails in the database, sent as a JSON array or as NDJSON"""
+        results = EMailController.create_emails(read_batch())
+
+        created = sum(1 for result in results if 'error' not in result)
+        logger.debug(f"{request} successfully created {created} new emails out of {len(results)}'")
+        return jsonify(data=results), 201 if created == len(results) else 207
+
     # PUT (update) email by id
     @current_app.route('/emails/<string:oid>', methods=['PUT'])
     def update_email(oid: str) -> (str, int):
         """This route updates an email, identified by its id, in the database"""
-        email = EMailController.update_email(oid, request.get_json())
+        email = EMailController.update_email(oid, request.get_json(), read_fields())
         logger.debug(f"{request} successfully updated email with id {oid}'")
         return jsonify(data=email), 200
 
@@ -102,11 +302,61 @@ def load() -> None:
     # Invoice routes
     #
 
+    # GET a page of invoices, by sender, recipient and notification
+    @current_app.route('/invoices', methods=['GET'])
+    def get_invoices() -> (str, int):
+        """This route lists the invoices, by pages in the order of their ids"""
+        limit, after = read_page()
+        notify = request.args.get('notify')
+        invoices = InvoiceController.find_invoices(
+            sender=request.args.get('sender'),
+            recipient=request.args.get('recipient'),
+            notify=None if notify is None else notify.lower() in ('1', 'true'),
+            after=after,
+            limit=limit + 1
+        )
+        logger.debug(f"{request} responded with {min(len(invoices), limit)} invoices")
+        return page_response(invoices, limit), 200
+
+    # GET the invoices as an NDJSON stream, by sender, recipient and notification
+    @current_app.route('/invoices/export', methods=['GET'])
+    def export_invoices() -> (Response, int):
+        """This route streams the invoices in the order of their ids, resuming after a cursor if any"""
+        notify = request.args.get('notify')
+        invoices = InvoiceController.export_invoices(
+            sender=request.args.get('sender'),
+            recipient=request.args.get('recipient'),
+            notify=None if notify is None else notify.lower() in ('1', 'true'),
+            fields=read_fields(),
+            after=read_cursor(),
+            batch_size=current_app.config.get('API_EXPORT_BATCH_SIZE')
+        )
+        logger.debug(f"{request} streaming invoices")
+        return ndjson_response(invoices), 200
+
+    # GET a page of the billing runs planned in a window
+    @current_app.route('/invoices/runs', methods=['GET'])
+    def get_billing_runs() -> (str, int):
+        """This route lists the planned runs of the invoices billed on calendar dates, due between since and until,
+        by pages in the order of their times"""
+        limit, after = read_page(('runAt', '_id'))
+        runs = InvoiceController.find_billing_runs(
+            since=request.args.get('since', type=int),
+            until=request.args.get('until', type=int),
+            after=after,
+            limit=limit + 1
+        )
+        logger.debug(f"{request} responded with {min(len(runs), limit)} billing runs")
+        return page_response(runs, limit, ('runAt', '_id')), 200
+
     # GET invoice by id
     @current_app.route('/invoices/<string:oid>', methods=['GET'])
     def get_invoice(oid: str) -> (str, int):
         """This route retrieves an invoice using its _id"""
-        invoice = InvoiceController.find(oid)
+        if raw_reads():
+            invoice = InvoiceController.find_raw(oid, read_fields())
+        else:
+            invoice = InvoiceController.find(oid)
 
         logger.debug(f"{request} responded with invoice with ObjectId '{oid}'")
         return jsonify(data=invoice), 200
@@ -124,7 +374,7 @@ def load() -> None:
     @current_app.route('/invoices/<string:oid>', methods=['PUT'])
     def update_invoice(oid: str) -> (str, int):
         """This route updates an invoice, identified by its id, in the database"""
-        invoice = InvoiceController.update_invoice(oid, request.get_json())
+        invoice = InvoiceController.update_invoice(oid, request.get_json(), read_fields())
         logger.debug(f"{request} successfully updated invoice with id {id}'")
         return jsonify(data=invoice), 200
 
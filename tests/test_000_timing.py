@@ -1,10 +1,12 @@
 import unittest
+from unittest import mock
 from schedbill import create_app, config
 from flask import Flask
 from datetime import datetime, timezone, timedelta
 from dateutil.parser import *
 import pytz
-from timing import TimeCalc
+import timing
+from timing import TimeCalc, parse_date_string
 
 
 class MyTestCase(unittest.TestCase):
@@ -72,6 +74,59 @@ class MyTestCase(unittest.TestCase):
             TimeCalc.arg_to_timestamp(self.test_string_float_timestamp)
         )
 
+    def test_parsed_string_arg_to_ts(self) -> None:
+        # ISO 8601 and free-form strings give the same timestamps as dateutil, the repeated ones parsed once
+        parse_date_string.cache_clear()
+        for date_string in ('2022-06-01T16:10:00Z', '2022-06-01T18:10:00.500+02:00', '2022-06-01', 'June 1 2022 6:10pm',
+                            '2022-06-01T16:10:00Z'):
+            self.assertEqual(int(parse(date_string).timestamp()), TimeCalc.arg_to_timestamp(date_string))
+        self.assertEqual(1, parse_date_string.cache_info().hits)
+        # partial dates are completed with the current date
+        self.assertEqual(int(parse('18:10').timestamp()), TimeCalc.arg_to_timestamp('18:10'))
+        with self.assertRaises(ValueError):
+            TimeCalc.arg_to_timestamp('not a date')
+
+    def test_args_to_ts(self) -> None:
+        self.assertEqual(
+            [self.test_int_timestamp] * 4,
+            TimeCalc.args_to_timestamps([self.test_int_timestamp, self.test_string_float_timestamp,
+                                         self.test_string_utc, self.test_datetime_utc])
+        )
+
+    def test_batch_conversions(self) -> None:
+        # the batch methods give the same results as the scalar ones, as arrays (or lists without NumPy)
+        date_args = [self.test_string_utc, self.test_float_timestamp, self.test_string_utc, '2022-03-27T03:00:00+02:00']
+        self.assertEqual([TimeCalc.arg_to_timestamp(date_arg) for date_arg in date_args],
+                         [int(ts) for ts in TimeCalc.to_timestamps(date_args)])
+        self.assertEqual([0, 0], [int(ts) for ts in TimeCalc.next_run_timestamps([0, -1])])
+        next_run = TimeCalc.next_run_timestamp(60)
+        self.assertAlmostEqual(next_run, int(TimeCalc.next_run_timestamps([60])[0]), delta=1)
+        # around the DST changes of Europe/Paris
+        timestamps = [1648342800 + hours * 3600 for hours in range(-30, 30)] + [1667091600 + hours * 3600
+                                                                               for hours in range(-30, 30)]
+        # and past the end of the tz database tables
+        timestamps += [2216336400 + hours * 3600 for hours in range(-30, 30)]
+        for tz in ('utc', 'Europe/Paris', 'EST', 'Asia/Kolkata'):
+            self.assertEqual([TimeCalc.midnight_timestamp(ts, tz) for ts in timestamps],
+                             [int(ts) for ts in TimeCalc.midnight_timestamps(timestamps, tz)])
+            with mock.patch.object(timing, 'numpy', None):
+                self.assertEqual([TimeCalc.midnight_timestamp(ts, tz) for ts in timestamps],
+                                 TimeCalc.midnight_timestamps(timestamps, tz))
+        self.assertEqual(1654034400, TimeCalc.midnight_timestamp(self.test_int_timestamp, 'Europe/Paris'))
+
+    def test_today_trigger(self) -> None:
+        now = int(datetime.now().timestamp())
+        for tz in (None, 'Europe/Paris', 'Pacific/Kiritimati', 'America/Adak'):
+            midnight = int(parse('00:00').timestamp()) if tz is None else TimeCalc.midnight_timestamp(now, tz)
+            self.assertEqual(midnight + 3600 * 8, TimeCalc.today_trigger(3600 * 8, tz))
+            # the midnight is computed again only once the day is over
+            with mock.patch.object(TimeCalc, 'day_midnight', side_effect=AssertionError):
+                self.assertEqual(midnight, TimeCalc.today_midnight(tz))
+        with mock.patch('timing.datetime', wraps=datetime) as clock:
+            clock.now.return_value = datetime.now() + timedelta(days=1)
+            self.assertEqual(TimeCalc.midnight_timestamp(now + 86400, 'Europe/Paris'),
+                             TimeCalc.today_midnight('Europe/Paris'))
+
     def test_timestamp_to_datetime(self):
         self.assertEqual(
             self.test_datetime_locale,
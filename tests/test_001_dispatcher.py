@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+from scheduler import EMailDispatcher
+
+
+class EMailDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.fired = []
+        self.now = 1654099800
+        self.dispatcher = EMailDispatcher(
+            lambda second, oids: self.fired.append((second, oids)),
+            clock=lambda: self.now
+        )
+
+    def test_buckets_by_second(self) -> None:
+        self.dispatcher.schedule_many([('a', self.now + 2), ('b', self.now + 1), ('c', self.now + 1)])
+        self.assertEqual(3, len(self.dispatcher))
+        self.assertEqual(self.now + 1, self.dispatcher.next_due())
+        self.assertEqual([], self.dispatcher.pop_due(self.now))
+        buckets = self.dispatcher.pop_due(self.now + 2)
+        self.assertEqual([self.now + 1, self.now + 2], [second for second, _ in buckets])
+        self.assertCountEqual(['b', 'c'], buckets[0][1])
+        self.assertEqual(['a'], buckets[1][1])
+        self.assertEqual(0, len(self.dispatcher))
+        self.assertIsNone(self.dispatcher.next_due())
+
+    def test_reschedule_and_cancel(self) -> None:
+        self.dispatcher.schedule('a', self.now + 1)
+        self.dispatcher.schedule('b', self.now + 1)
+        # rescheduling leaves a stale entry which must not fire
+        self.dispatcher.schedule('a', self.now + 10)
+        self.assertEqual(1, self.dispatcher.cancel('b'))
+        self.assertEqual(0, self.dispatcher.cancel('b'))
+        self.assertEqual(self.now + 10, self.dispatcher.next_due())
+        self.assertEqual([(self.now + 10, ['a'])], self.dispatcher.pop_due(self.now + 10))
+        # a null sendAt cancels the schedule
+        self.dispatcher.schedule('c', self.now + 1)
+        self.assertEqual(0, self.dispatcher.schedule('c', 0))
+        self.assertNotIn('c', self.dispatcher)
+
+    def test_rebuild(self) -> None:
+        self.dispatcher.schedule('a', self.now + 1)
+        self.assertEqual(2, self.dispatcher.rebuild([('b', self.now + 3), ('c', self.now + 2), ('d', 0)]))
+        self.assertNotIn('a', self.dispatcher)
+        self.assertEqual(
+            [(self.now + 2, ['c']), (self.now + 3, ['b'])],
+            self.dispatcher.pop_due(self.now + 3)
+        )
+
+    def test_dispatching_thread(self) -> None:
+        done = threading.Event()
+        dispatcher = EMailDispatcher(lambda second, oids: done.set())
+        dispatcher.start()
+        try:
+            dispatcher.schedule('a', int(time.time()) + 1)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(0, len(dispatcher))
+        finally:
+            dispatcher.shutdown()
+
+
+    def test_rebuild_in_flight(self) -> None:
+        sending, sent = threading.Event(), threading.Event()
+
+        def send_bucket(second: int, oids: list) -> None:
+            sending.set()
+            sent.wait(5)
+
+        dispatcher = EMailDispatcher(send_bucket)
+        dispatcher.start()
+        try:
+            send_at = int(time.time())
+            dispatcher.schedule('a', send_at)
+            self.assertTrue(sending.wait(5))
+            # the email being sent is still pending in the database: a rebuild does not schedule it again
+            self.assertEqual(1, dispatcher.rebuild([('a', send_at), ('b', send_at + 100)]))
+            self.assertNotIn('a', dispatcher)
+            self.assertIn('b', dispatcher)
+            sent.set()
+        finally:
+            dispatcher.shutdown()
+        self.assertEqual(1, dispatcher.rebuild([('a', send_at)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from bson import ObjectId
+from schedbill import config, db
+from fixtures.col import drop_collections
+from pymongo.errors import ConnectionFailure
+from pytz import utc
+from scheduler import setup_scheduler
+from sharding import PartitionLeases, ShardedScheduling, partition_of
+import mongoengine
+
+
+class PartitionTestCase(unittest.TestCase):
+
+    def test_partition_of(self) -> None:
+        oids = [ObjectId() for _ in range(1000)]
+        partitions = [partition_of(oid, 8) for oid in oids]
+        self.assertTrue(all(0 <= partition < 8 for partition in partitions))
+        # the hash is stable and does not depend on the id type
+        self.assertEqual(partitions, [partition_of(str(oid), 8) for oid in oids])
+        # the ids spread over every partition
+        self.assertEqual(set(range(8)), set(partitions))
+
+
+class PartitionLeasesTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.conn = db.connect_db(config.TestingConfiguration)
+        cls.raw_db = mongoengine.connection.get_db()
+
+    def setUp(self) -> None:
+        drop_collections(PartitionLeasesTestCase.raw_db)
+        self.now = 1654099800.0
+        self.leases = [
+            PartitionLeases(self.raw_db['scheduler_leases'], self.raw_db['scheduler_members'], 8, ttl=30,
+                            owner=owner, clock=lambda: self.now)
+            for owner in ('node-a', 'node-b')
+        ]
+
+    def test_fair_share(self) -> None:
+        node_a, node_b = self.leases
+        acquired, lost = node_a.renew()
+        self.assertEqual(set(range(8)), acquired)
+        # a second instance joins: the first one gives half of the partitions back
+        node_b.renew()
+        self.assertEqual(frozenset(), node_b.owned)
+        node_a.renew()
+        node_b.renew()
+        self.assertEqual(4, len(node_a.owned))
+        self.assertEqual(4, len(node_b.owned))
+        self.assertEqual(frozenset(), node_a.owned & node_b.owned)
+
+    def test_takeover(self) -> None:
+        node_a, node_b = self.leases
+        node_a.renew()
+        node_b.renew()
+        node_a.renew()
+        node_b.renew()
+        # the first instance dies: its partitions are taken over once its leases expire
+        self.now += 31
+        self.assertEqual(frozenset(), node_a.owned)
+        node_b.renew()
+        self.assertEqual(frozenset(range(8)), node_b.owned)
+
+    def test_release(self) -> None:
+        node_a, node_b = self.leases
+        node_a.renew()
+        node_a.release()
+        node_b.renew()
+        self.assertEqual(frozenset(range(8)), node_b.owned)
+
+
+class ShardedSchedulingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.conn = db.connect_db(config.TestingConfiguration)
+        cls.raw_db = mongoengine.connection.get_db()
+
+    def setUp(self) -> None:
+        drop_collections(ShardedSchedulingTestCase.raw_db)
+        self.now = 1654099800.0
+        self.leases = [
+            PartitionLeases(self.raw_db['scheduler_leases'], self.raw_db['scheduler_members'], 4, ttl=30,
+                            owner=owner, clock=lambda: self.now)
+            for owner in ('node-a', 'node-b')
+        ]
+        self.scheduler = setup_scheduler(timezone=utc)
+        self.scheduler.start(paused=True)
+        self.sharding = ShardedScheduling(self.scheduler, self.leases[0])
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown(wait=False)
+
+    def attached(self) -> set:
+        return {alias for alias in self.scheduler._jobstores if alias != 'default'}
+
+    def test_failed_renewal(self) -> None:
+        self.sharding.renew()
+        self.assertEqual({'p0', 'p1', 'p2', 'p3'}, self.attached())
+        # a failed renewal loses every partition, whose leases may lapse before the next one
+        def unreachable():
+            raise ConnectionFailure('not reachable')
+
+        renew = self.leases[0].renew
+        self.leases[0].renew = unreachable
+        self.assertRaises(ConnectionFailure, self.sharding.renew)
+        self.assertEqual(set(), self.attached())
+        self.assertFalse(self.sharding.owns('0' * 24))
+        # the leases still held are attached again by the next renewal
+        self.leases[0].renew = renew
+        self.sharding.renew()
+        self.assertEqual({'p0', 'p1', 'p2', 'p3'}, self.attached())
+
+    def test_lapsed_leases(self) -> None:
+        self.sharding.renew()
+        # the leases lapse without renewal and are taken over by another instance
+        self.now += 31
+        self.leases[1].renew()
+        self.sharding.renew()
+        self.assertEqual(set(), self.attached())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+from pytz import utc
+from schedbill import config, db
+from fixtures.col import drop_collections
+from intents import IntentRecorder, IntentConsumer
+from scheduler import EMailDispatcher, setup_scheduler
+from helpers import is_float
+import mongoengine
+
+
+class IntentsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.conn = db.connect_db(config.TestingConfiguration)
+        cls.raw_db = mongoengine.connection.get_db()
+
+    def setUp(self) -> None:
+        drop_collections(IntentsTestCase.raw_db)
+        self.recorder = IntentRecorder(self.raw_db['schedule_intents'], self.raw_db['scheduled_jobs'])
+        self.scheduler = setup_scheduler(timezone=utc)
+        self.scheduler.start()
+        self.dispatcher = EMailDispatcher(lambda second, oids: None)
+        self.consumer = IntentConsumer(self.raw_db['schedule_intents'], self.scheduler, dispatcher=self.dispatcher,
+                                       scheduled=self.raw_db['scheduled_jobs'])
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown()
+
+    def test_intents_index(self) -> None:
+        self.assertIn('version_1', self.raw_db['schedule_intents'].index_information())
+
+    def test_job_intents(self) -> None:
+        run_date = datetime.now(utc) + timedelta(seconds=60)
+        self.recorder.add_job(is_float, 'date', run_date=run_date, args=['1'], id='job1', replace_existing=True)
+        self.recorder.add_job(is_float, 'date', run_date=run_date, args=['2'], id='job2', replace_existing=True)
+        self.recorder.remove_job('job2')
+        self.assertIsNotNone(self.recorder.get_job('job1'))
+        self.assertIsNone(self.recorder.get_job('job2'))
+        # the latest intent of each job is applied, then deleted
+        self.assertEqual(2, self.consumer.consume())
+        self.assertEqual(0, self.raw_db['schedule_intents'].count_documents({}))
+        self.assertEqual(['job1'], [job.id for job in self.scheduler.get_jobs()])
+        self.assertEqual(int(run_date.timestamp()), int(self.scheduler.get_job('job1').next_run_time.timestamp()))
+        self.assertEqual(0, self.consumer.consume())
+        # a consumed date job is not known by the recorder
+        self.assertIsNone(self.recorder.get_job('job1'))
+
+    def test_interval_job_intents(self) -> None:
+        start_date = datetime.now(utc).replace(microsecond=0) + timedelta(seconds=60)
+        self.recorder.add_job(is_float, 'interval', seconds=60, start_date=start_date, args=['1'], id='job1')
+        self.assertEqual(1, self.consumer.consume())
+        # the long-lived jobs stay known once consumed, until removed from the scheduler
+        self.assertEqual(start_date, self.recorder.get_job('job1').next_run_time)
+        self.scheduler.remove_job('job1')
+        self.assertIsNone(self.recorder.get_job('job1'))
+
+    def test_dispatch_intents(self) -> None:
+        send_at = int(time.time()) + 60
+        self.recorder.schedule_many([('email1', send_at), ('email2', send_at)])
+        self.recorder.cancel('email2')
+        self.assertEqual(2, self.consumer.consume())
+        self.assertIn('email1', self.dispatcher)
+        self.assertNotIn('email2', self.dispatcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
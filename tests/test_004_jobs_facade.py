@@ -0,0 +1,86 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from pytz import utc
+from apscheduler.jobstores.memory import MemoryJobStore
+from scheduler import JobsFacade, setup_scheduler
+from helpers import is_float
+
+
+class CountingJobStore(MemoryJobStore):
+    """A memory job store counting its lookups and removals"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.queries = 0
+
+    def lookup_job(self, job_id):
+        self.queries += 1
+        return super().lookup_job(job_id)
+
+    def remove_job(self, job_id):
+        self.queries += 1
+        return super().remove_job(job_id)
+
+
+class JobsFacadeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.store = CountingJobStore()
+        self.scheduler = setup_scheduler(timezone=utc)
+        self.scheduler.add_jobstore(self.store, 'default')
+        self.scheduler.start(paused=True)
+        self.facade = JobsFacade(self.scheduler)
+        self.job = {'func': is_float, 'trigger': 'date', 'run_date': datetime.now(utc) + timedelta(seconds=60),
+                    'args': ['1']}
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown(wait=False)
+
+    def test_upsert_or_cancel(self) -> None:
+        self.assertEqual(1, self.facade.upsert_or_cancel('job1', self.job))
+        self.assertEqual(1, self.facade.upsert_or_cancel('job1', dict(self.job, args=['2'])))
+        self.assertEqual(['2'], list(self.scheduler.get_job('job1').args))
+        self.assertIn('job1', self.facade)
+        self.assertEqual(-1, self.facade.upsert_or_cancel('job1'))
+        self.assertNotIn('job1', self.facade)
+        self.assertIsNone(self.scheduler.get_job('job1'))
+
+    def test_unknown_jobs_cost_no_query(self) -> None:
+        self.store.queries = 0
+        self.assertEqual(0, self.facade.cancel('job1'))
+        self.assertIsNone(self.facade.get_job('job1'))
+        self.assertEqual(0, self.store.queries)
+
+    def test_bulk_upsert_or_cancel(self) -> None:
+        self.facade.bulk_upsert_or_cancel([('job1', self.job), ('job2', self.job)])
+        self.assertEqual(
+            (1, 2),
+            self.facade.bulk_upsert_or_cancel([('job1', None), ('job2', None), ('job3', self.job)])
+        )
+        self.assertEqual(['job3'], [job.id for job in self.scheduler.get_jobs()])
+
+    def test_tracks_scheduler_events(self) -> None:
+        # jobs added or removed without the facade are tracked as well
+        self.scheduler.add_job(is_float, 'date', run_date=self.job['run_date'], args=['1'], id='job1')
+        self.assertIn('job1', self.facade)
+        self.scheduler.remove_all_jobs()
+        self.assertNotIn('job1', self.facade)
+        # the jobs already stored are known once the facade is set up
+        self.scheduler.add_job(is_float, 'date', run_date=self.job['run_date'], args=['1'], id='job2')
+        self.assertIn('job2', JobsFacade(self.scheduler))
+
+
+    def test_upsert_waits_for_the_scheduler(self) -> None:
+        # the jobs are written while the scheduler thread does not process its job stores
+        upsert = threading.Thread(target=self.facade.upsert_or_cancel, args=('job1', self.job))
+        with self.scheduler._jobstores_lock:
+            upsert.start()
+            upsert.join(0.2)
+            self.assertTrue(upsert.is_alive())
+            self.assertIsNone(self.store.lookup_job('job1'))
+        upsert.join()
+        self.assertIsNotNone(self.scheduler.get_job('job1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import logging
+import threading
+import unittest
+from datetime import datetime, timedelta
+from pytz import utc
+from apscheduler.events import EVENT_JOB_EXECUTED
+from pymongo import monitoring
+import pickle
+import metrics
+from types import SimpleNamespace
+from schedbill import create_app
+from config import TestingConfiguration
+from db import CommandProfiler, PoolStats
+from scheduler import setup_scheduler, worker_config
+from helpers import is_float
+
+
+class MetricsRenderingTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.registry = metrics.Registry()
+
+    def test_counter_and_gauge(self) -> None:
+        counter = self.registry.counter('test_total', 'A counter', ('kind',))
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('say "hi"')
+        gauge = self.registry.gauge('test_depth', 'A gauge')
+        gauge.set(value=1.5)
+        self.assertEqual(
+            '# HELP test_total A counter\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a"} 3\n'
+            'test_total{kind="say \\"hi\\""} 1\n'
+            '# HELP test_depth A gauge\n'
+            '# TYPE test_depth gauge\n'
+            'test_depth 1.5\n',
+            self.registry.render()
+        )
+
+    def test_histogram(self) -> None:
+        histogram = self.registry.histogram('test_seconds', 'A histogram', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value=value)
+        self.assertEqual(
+            '# HELP test_seconds A histogram\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.1"} 2\n'
+            'test_seconds_bucket{le="1"} 3\n'
+            'test_seconds_bucket{le="+Inf"} 4\n'
+            'test_seconds_sum 3.65\n'
+            'test_seconds_count 4\n',
+            self.registry.render()
+        )
+
+
+class SchedulerMetricsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        metrics.REGISTRY.clear()
+        self.scheduler = setup_scheduler(timezone=utc)
+        self.scheduler.start()
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown()
+
+    def test_job_metrics(self) -> None:
+        executed = threading.Event()
+        self.scheduler.add_listener(lambda event: executed.set(), EVENT_JOB_EXECUTED)
+        self.scheduler.add_job(is_float, 'date', run_date=datetime.now(utc) - timedelta(seconds=1), args=['1'],
+                               id='job1')
+        self.assertTrue(executed.wait(5))
+        self.assertEqual(1, metrics.JOB_RUNS.value('is_float', 'executed'))
+        self.assertEqual(1, metrics.JOB_DISPATCH_LAG.count('is_float'))
+        self.assertEqual(1, metrics.JOB_DURATION.count('is_float'))
+        self.assertEqual(0, metrics.EXECUTOR_IN_FLIGHT.value('default'))
+        self.assertGreater(metrics.JOBSTORE_LATENCY.count('default', 'add_job'), 0)
+        self.assertIn('schedbill_job_runs_total{job="is_float",outcome="executed"} 1', metrics.REGISTRY.render())
+
+    def test_process_pool_job(self) -> None:
+        # the configuration of a connected application (holding the MongoDB event listeners) is passed to the workers
+        app_config = create_app(TestingConfiguration, role='web').config
+        process_config = worker_config(app_config)
+        self.assertIn('MONGODB_SETTINGS', app_config)
+        self.assertNotIn('MONGODB_SETTINGS', process_config)
+        pickle.dumps(process_config)
+        scheduler = setup_scheduler(timezone=utc, max_processes=1, process_config=process_config)
+        executed = threading.Event()
+        scheduler.add_listener(lambda event: executed.set(), EVENT_JOB_EXECUTED)
+        scheduler.start()
+        try:
+            scheduler.add_job(is_float, 'date', run_date=datetime.now(utc) - timedelta(seconds=1), args=['1'],
+                              id='job1', executor='processpool')
+            self.assertTrue(executed.wait(60))
+            self.assertEqual(1, metrics.JOB_RUNS.value('is_float', 'executed'))
+        finally:
+            scheduler.shutdown()
+
+
+class PoolStatsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        metrics.REGISTRY.clear()
+        self.stats = PoolStats()
+        self.address = ('localhost', 27017)
+
+    def test_pool_stats(self) -> None:
+        self.stats.connection_created(monitoring.ConnectionCreatedEvent(self.address, 1))
+        self.stats.connection_created(monitoring.ConnectionCreatedEvent(self.address, 2))
+        self.stats.connection_checked_out(monitoring.ConnectionCheckedOutEvent(self.address, 1, 0.02))
+        self.stats.connection_checked_out(monitoring.ConnectionCheckedOutEvent(self.address, 2, 0.5))
+        self.stats.connection_checked_in(monitoring.ConnectionCheckedInEvent(self.address, 1))
+        self.stats.connection_closed(monitoring.ConnectionClosedEvent(self.address, 1, 'stale'))
+        self.stats.connection_check_out_failed(
+            monitoring.ConnectionCheckOutFailedEvent(self.address, 'timeout', 1.0)
+        )
+        self.assertEqual({'localhost:27017': {'open': 1, 'in_use': 1}}, self.stats.stats())
+        self.assertEqual(1, metrics.DB_POOL_CONNECTIONS.value('localhost:27017', 'in_use'))
+        self.assertEqual(2, metrics.DB_POOL_CHECKOUT_WAIT.count('localhost:27017'))
+        self.assertEqual(1, metrics.DB_POOL_CHECKOUT_FAILED.value('localhost:27017', 'timeout'))
+
+
+class CommandProfilerTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.profiler = CommandProfiler(slow_ms=50)
+
+    def run_command(self, name: str, duration_ms: int) -> None:
+        self.profiler.started(SimpleNamespace(command={name: 'emails'}))
+        self.profiler.succeeded(SimpleNamespace(command_name=name, duration_micros=duration_ms * 1000,
+                                                database_name='intiaTestDB'))
+
+    def test_profile(self) -> None:
+        self.run_command('find', 1)  # not profiled
+        with self.profiler.profile() as profile:
+            self.run_command('find', 2)
+            with self.assertLogs(level=logging.WARNING) as logs:
+                self.run_command('update', 60)
+            self.run_command('find', 3)
+        self.assertEqual(3, profile.commands)
+        self.assertEqual(65000, profile.duration_micros)
+        self.assertIn("Slow MongoDB command update succeeded in 60.0 ms on intiaTestDB : {'update': 'emails'}",
+                      logs.output[0])
+        self.assertEqual('db;desc="3 MongoDB commands";dur=65.000, db-slowest;desc="update";dur=60.000',
+                         profile.server_timing())
+        self.assertIsNone(self.profiler.stop())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from simulation import Load, Simulation, SimulationConfig, VirtualClock, VirtualWorkers, synthetic_load
+
+
+class SimulationTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.load = synthetic_load(2000, invoices=10, duration=3600, seed=1)
+
+    def simulate(self, **config):
+        config.setdefault('processing_time', False)  # keeps the virtual time independent of the host
+        return Simulation(self.load, SimulationConfig(**config)).run(until=3600, trace_memory=False)
+
+    def test_virtual_workers(self) -> None:
+        clock = VirtualClock(100)
+        workers = VirtualWorkers(2, clock)
+        self.assertEqual([100, 100, 101], [workers.run(1), workers.run(1), workers.run(1)])
+
+    def test_every_email_is_dispatched(self) -> None:
+        for dispatch in ('jobstore', 'bucket', 'dispatcher'):
+            report = self.simulate(dispatch=dispatch)
+            self.assertEqual(2000, report.emails, dispatch)
+            self.assertEqual(0, report.missed, dispatch)
+            self.assertGreater(report.invoices, 0, dispatch)
+            self.assertGreater(report.email_lag['p50'], 0, dispatch)
+
+    def test_deterministic(self) -> None:
+        self.assertEqual(self.simulate().email_lag, self.simulate().email_lag)
+
+    def test_overload(self) -> None:
+        # every email due at once on a single thread: they queue up, then miss the grace time
+        self.load = Load([10] * 100, [])
+        report = self.simulate(max_threads=1, job_cost=0.1, email_cost=0)
+        self.assertAlmostEqual(10, report.email_lag['max'], places=3)
+        report = self.simulate(max_threads=1, job_cost=0.1, email_cost=0, misfire_grace_time=5)
+        self.assertEqual(49, report.missed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from bson import ObjectId
+from cache import DocumentCache, TTLCache, connect_cache, serve_cache
+from models import User
+
+
+class TTLCacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_lru_eviction(self) -> None:
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(1, self.cache.get('a'))
+        self.cache.set('c', 3)  # evicts b, the least recently used
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual([1, 3], [self.cache.get('a'), self.cache.get('c')])
+        self.assertEqual({'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}, self.cache.stats())
+
+    def test_ttl(self) -> None:
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertEqual(1, self.cache.get('a'))
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+
+class DocumentCacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.user = User(id=ObjectId(), emailAddress='john.doe@example.com', lastName='Doe')
+
+    def test_document_cache(self) -> None:
+        cache = DocumentCache(User, TTLCache(), keys=('emailAddress',))
+        cache.add(self.user)
+        self.assertEqual('Doe', cache.get('id', self.user.id).lastName)
+        self.assertEqual(self.user.id, cache.get('emailAddress', 'john.doe@example.com').id)
+        cache.invalidate(self.user)
+        self.assertIsNone(cache.get('id', self.user.id))
+        self.assertIsNone(cache.get('emailAddress', 'john.doe@example.com'))
+
+    def test_shared_cache(self) -> None:
+        store = TTLCache()
+        server = serve_cache(store, ('127.0.0.1', 0), b'secret')
+        proxy = connect_cache(server.address, b'secret')
+        DocumentCache(User, proxy, keys=('emailAddress',)).add(self.user)
+        self.assertEqual('Doe', DocumentCache(User, store).get('id', self.user.id).lastName)
+        proxy.delete(('id', str(self.user.id)))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 0, 'evictions': 0}, store.stats())
+        server.stop_event.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import json
+import unittest
+from datetime import datetime
+from unittest import mock
+from bson import ObjectId, json_util
+import encoding
+from models import EMail
+
+
+class EncodingTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.email = EMail(id=ObjectId(), sender=ObjectId(), recipient='foo@example.com', content='Foo', sendAt=1,
+                           sentAt=0)
+        self.raw = {'_id': ObjectId(), 'at': datetime(2024, 1, 2, 3, 4, 5), 'big': 2 ** 70, 'items': [{'id': ObjectId()}]}
+
+    def test_same_as_json_util(self) -> None:
+        # a Document or a raw document encodes as flask-mongoengine did, with orjson if installed or json
+        for orjson in {encoding.orjson, None}:
+            with mock.patch.object(encoding, 'orjson', orjson):
+                for document in (self.email.to_mongo(), self.raw):
+                    self.assertEqual(json_util._json_convert(document), json.loads(encoding.dumps(document)))
+                self.assertEqual(json.loads(encoding.dumps(self.email.to_mongo())),
+                                 json.loads(encoding.dumps({'data': self.email}))['data'])
+
+    def test_options(self) -> None:
+        encoded = encoding.dumps({'b': 1, 'a': [1]}, sort_keys=True, indent=2).decode()
+        self.assertEqual('{\n  "a": [\n    1\n  ],\n  "b": 1\n}', encoded)
+        self.assertEqual(b'{"b":1,"a":[1]}', encoding.dumps({'b': 1, 'a': [1]}))
+        with self.assertRaises(TypeError):
+            encoding.dumps({'a': object()})
@@ -0,0 +1,42 @@
+import unittest
+from datetime import datetime
+import billing
+from timing import TimeCalc
+
+
+class BillingRuleTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.after = TimeCalc.day_midnight(datetime(2024, 1, 15).date(), 'Europe/Paris')
+
+    def run_days(self, rule: str, count: int = 4) -> list:
+        return [TimeCalc.timestamp_to_datetime(run_at, 'Europe/Paris').strftime('%Y-%m-%d %H:%M')
+                for run_at in billing.next_runs(rule, 'Europe/Paris', self.after, count)]
+
+    def test_calendar_rules(self) -> None:
+        # the days are clamped to the last day of the shorter months, the runs are due after (not at) the time given
+        self.assertEqual(['2024-01-31 00:00', '2024-02-29 00:00', '2024-03-31 00:00', '2024-04-30 00:00'],
+                         self.run_days('monthly:31'))
+        self.assertEqual(self.run_days('monthly:31'), self.run_days('monthly:last'))
+        self.assertEqual(['2024-04-15 00:00', '2024-07-15 00:00', '2024-10-15 00:00', '2025-01-15 00:00'],
+                         self.run_days('quarterly:15'))
+        self.assertEqual(['2024-02-01 00:00', '2024-03-01 00:00', '2024-04-01 00:00'], self.run_days('business:1', 3))
+        self.assertEqual(['2024-01-31 00:00', '2024-02-29 00:00', '2024-03-29 00:00'],
+                         self.run_days('business:last', 3))
+
+    def test_cron_rules(self) -> None:
+        self.assertEqual(['2024-01-15 09:00', '2024-01-16 09:00'], self.run_days('cron:0 9 * * mon-fri', 2))
+        self.assertEqual(['2024-02-29 00:00', '2028-02-29 00:00'], self.run_days('cron:0 0 29 2 *', 2))
+
+    def test_invalid_rules(self) -> None:
+        for rule in ('weekly:1', 'monthly:32', 'monthly:', 'business:0', 'cron:61 * * * *'):
+            with self.assertRaises(ValueError):
+                billing.parse_rule(rule)
+
+    def test_next_runs_cache(self) -> None:
+        runs = billing.next_runs('monthly:last', 'Europe/Paris', self.after, 3)
+        # the runs are the same, and computed once, until the first of them is due
+        self.assertIs(runs, billing.next_runs('monthly:last', 'Europe/Paris', self.after + 86400, 3))
+        self.assertIs(runs, billing.next_runs('monthly:last', 'Europe/Paris', runs[0] - 1, 3))
+        self.assertEqual(runs[1:], billing.next_runs('monthly:last', 'Europe/Paris', runs[0], 3)[:2])
+        self.assertEqual(runs, billing.next_runs('monthly:last', 'Europe/Paris', self.after, 3))
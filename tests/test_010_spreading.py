@@ -0,0 +1,57 @@
+import unittest
+from collections import Counter
+import spreading
+from spreading import LoadSpreader
+
+PLANNED = 1700000000
+
+
+class LoadSpreaderTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.oids = [f"{number:024x}" for number in range(2000)]
+
+    def test_jitter(self) -> None:
+        # the delay of a job only depends on its id, within the window
+        delays = [spreading.jitter(oid, 300) for oid in self.oids]
+        self.assertEqual(delays, [spreading.jitter(oid, 300) for oid in self.oids])
+        self.assertTrue(all(0 <= delay < 300 for delay in delays))
+        self.assertGreater(len(set(delays)), 250)
+        self.assertEqual(0, spreading.jitter(self.oids[0], 0))
+
+    def test_spread_off(self) -> None:
+        spreader = LoadSpreader()
+        self.assertEqual(PLANNED, spreader.spread(self.oids[0], PLANNED))
+        self.assertEqual(0, spreader.report()['jobs'])
+
+    def test_spread_jitter(self) -> None:
+        spreader = LoadSpreader(300)
+        due = [spreader.spread(oid, PLANNED) for oid in self.oids]
+        self.assertEqual(due, [PLANNED + spreading.jitter(oid, 300) for oid in self.oids])
+        report = spreader.report()
+        self.assertEqual(2000, report['jobs'])
+        self.assertEqual(2000, report['peak_planned'])
+        self.assertLess(report['peak_spread'], 20)
+        self.assertEqual(0, report['over_rate'])
+        self.assertLess(report['delay']['max'], 300)
+
+    def test_spread_capacity(self) -> None:
+        # 4 emails already due on each second: 10 jobs per second leaves room for 6 more
+        spreader = LoadSpreader(400, 10, lambda start, end: dict.fromkeys(range(start, end), 4))
+        due = Counter(spreader.spread(oid, PLANNED) for oid in self.oids)
+        self.assertTrue(all(PLANNED <= second < PLANNED + 400 for second in due))
+        self.assertTrue(all(count <= 6 for count in due.values()))
+        report = spreader.report()
+        self.assertEqual({'jobs': 2000, 'peak_planned': 2000, 'peak_spread': 10, 'over_rate': 0},
+                         {key: report[key] for key in ('jobs', 'peak_planned', 'peak_spread', 'over_rate')})
+        self.assertEqual(len(due), report['seconds'])
+        # the window is too short for the rate: the least loaded seconds take the jobs left
+        spreader = LoadSpreader(100, 10)
+        due = Counter(spreader.spread(oid, PLANNED) for oid in self.oids)
+        self.assertEqual(100, len(due))
+        self.assertEqual(20, max(due.values()))
+        self.assertEqual(100, spreader.report()['over_rate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import json
 import flask_unittest
 from fixtures.users import create_users
 from fixtures.col import drop_collections
@@ -5,6 +6,7 @@ from schedbill import create_app, config, db
 from flask.testing import FlaskClient
 from flask import Flask
 import mongoengine
+from schedbill.models import User
 
 
 class TestFlaskApp(flask_unittest.AppClientTestCase):
@@ -73,6 +75,13 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
             json=self.user_in_test_json
         )
         self.assertStatus(resp, 200)
+        # a new email address, the user being cached under the previous one
+        address = self.user_in_test_json['emailAddress']
+        self.assertStatus(client.get(f"/users/emailAddress/{address}"), 200)
+        resp = client.put(f"/users/{str(self.user1_json['_id']['$oid'])}", json={"emailAddress": "new.foo@bar.baz"})
+        self.assertStatus(resp, 200)
+        self.assertStatus(client.get(f"/users/emailAddress/{address}"), 404)
+        self.assertStatus(client.get("/users/emailAddress/new.foo@bar.baz"), 200)
         # attempt to update a not existing user
         resp = client.put(
             f"/users/{self.id_404}",
@@ -87,9 +96,11 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         self.assertStatus(resp, 500)
 
     def test_delete_user(self, app: Flask, client: FlaskClient) -> None:
-        # delete an existing user
+        # delete an existing user, read (and cached) before
+        self.assertStatus(client.get(f"/users/{str(self.user1_json['_id']['$oid'])}"), 200)
         resp = client.delete(f"/users/{str(self.user1_json['_id']['$oid'])}")
         self.assertStatus(resp, 204)
+        self.assertStatus(client.get(f"/users/{str(self.user1_json['_id']['$oid'])}"), 404)
         # attempt to delete a not existing user
         resp = client.delete(f"/users/{str(self.user1_json['_id']['$oid'])}")
         self.assertStatus(resp, 404)
@@ -97,3 +108,29 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         resp = client.delete(f"/users/123")
         self.assertStatus(resp, 400)
         assert "Invalid ObjectId" in resp.json['error']
+
+    def test_import_users(self, app: Flask, client: FlaskClient) -> None:
+        # import users by chunks of 2, one line invalid, one user invalid, one user already existing
+        app.config['API_IMPORT_CHUNK_SIZE'] = 2
+        User.ensure_indexes()  # the unique index on emailAddress, dropped with the collection by setUp()
+        lines = [
+            json.dumps({"emailAddress": "import.1@example.com", "firstName": "Import"}),
+            '{"emailAddress": ',
+            '',
+            json.dumps({"emailAddress": self.user1_json['emailAddress']}),
+            json.dumps({"emailAddress": "import.2@example"}),
+            json.dumps({"emailAddress": "import.3@example.com"}),
+        ]
+        resp = client.post('/users/import', data='\n'.join(lines), content_type='application/x-ndjson')
+        self.assertStatus(resp, 200)
+        reports = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([(2, 1, 1), (5, 1, 3), (6, 2, 3)],
+                         [(report['lines'], report['inserted'], report['failed']) for report in reports])
+        self.assertTrue(reports[-1]['done'])
+        self.assertEqual([2, 4, 5], [error['line'] for report in reports for error in report['errors']])
+        assert "emailAddress" in reports[1]['errors'][0]['error']
+        resp = client.get('/users/emailAddress/import.3@example.com')
+        self.assertStatus(resp, 200)
+        # attempt to import users not sent as NDJSON
+        resp = client.post('/users/import', json=[{"emailAddress": "import.4@example.com"}])
+        self.assertStatus(resp, 400)
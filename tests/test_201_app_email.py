@@ -4,7 +4,9 @@ from flask.testing import FlaskClient
 from fixtures.col import drop_collections
 from fixtures.emails import create_emails
 from flask import Flask, g
+import json
 import mongoengine
+from bson import ObjectId
 
 
 class TestFlaskApp(flask_unittest.AppClientTestCase):
@@ -38,6 +40,55 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         self.assertStatus(resp, 400)
         assert "Invalid ObjectId" in resp.json['error']
 
+    def test_read_email_raw(self, app: Flask, client: FlaskClient) -> None:
+        # the raw read mode responds with the same document, as stored by the application (the fixtures store the
+        # sender id as a string, the application as an ObjectId)
+        for email in self.raw_db.emails.find():
+            self.raw_db.emails.update_one({'_id': email['_id']}, {'$set': {'sender': ObjectId(email['sender'])}})
+        app.config['API_RAW_READS'] = ('get_email',)
+        resp = client.get(f"/emails/{self.email1_json['_id']['$oid']}")
+        self.assertStatus(resp, 200)
+        self.assertEqual(self.email1_json, resp.json["data"])
+        # with a projection
+        resp = client.get(f"/emails/{self.email1_json['_id']['$oid']}?fields=title")
+        self.assertEqual({'_id': self.email1_json['_id'], 'title': self.email1_json['title']}, resp.json["data"])
+        # attempt to retrieve an email with a not existent id
+        resp = client.get(f"/emails/{self.id_404}")
+        self.assertStatus(resp, 404)
+        assert "EMail matching query does not exist" in resp.json['error']
+
+    def test_list_emails(self, app: Flask, client: FlaskClient) -> None:
+        # page through the emails in the order of their ids
+        oids, cursor = [], None
+        while True:
+            resp = client.get('/emails', query_string=dict(limit=2, **({'cursor': cursor} if cursor else {})))
+            self.assertStatus(resp, 200)
+            self.assertLessEqual(len(resp.json['data']), 2)
+            oids += [email['_id']['$oid'] for email in resp.json['data']]
+            cursor = resp.json['next']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(str(email['_id']) for email in self.raw_db.emails.find()), oids)
+        # filter on the sending time
+        resp = client.get('/emails', query_string={'since': 1, 'sort': 'sendAt'})
+        self.assertEqual(self.raw_db.emails.count_documents({'sendAt': {'$gte': 1}}), len(resp.json['data']))
+        # attempt to list with an invalid cursor
+        resp = client.get('/emails', query_string={'cursor': 'foo'})
+        self.assertStatus(resp, 400)
+
+    def test_export_emails(self, app: Flask, client: FlaskClient) -> None:
+        # export every email as NDJSON
+        resp = client.get('/emails/export')
+        self.assertStatus(resp, 200)
+        self.assertEqual('application/x-ndjson', resp.mimetype)
+        emails = [json.loads(line) for line in resp.data.decode().splitlines()]
+        self.assertEqual(self.raw_db.emails.count_documents({}), len(emails))
+        # resume the export after the cursor of a listing page, with a projection
+        cursor = client.get('/emails', query_string={'limit': 1}).json['next']
+        resp = client.get('/emails/export', query_string={'cursor': cursor, 'fields': 'title'})
+        self.assertEqual([{'_id': email['_id'], 'title': email['title']} for email in emails[1:]],
+                         [json.loads(line) for line in resp.data.decode().splitlines()])
+
     def test_create_email(self, app: Flask, client: FlaskClient) -> None:
         # create an email
         resp = client.post('/emails', json=self.email_in_test_json)
@@ -55,6 +106,28 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         resp = client.post('/users', json={"recipient": "foo.bar@baz", "firstName": "Foo", "lastName": "Bar"})
         self.assertStatus(resp, 500)
 
+    def test_create_emails_batch(self, app: Flask, client: FlaskClient) -> None:
+        # create a batch of emails sent as a JSON array
+        batch = [self.email_in_test_json, {"recipient": "foo.bar.baz", "content": "foobar"}, self.email_in_test_json]
+        resp = client.post('/emails/batch', json=batch)
+        self.assertStatus(resp, 207)
+        results = resp.json["data"]
+        self.assertEqual([0, 1, 2], [result['index'] for result in results])
+        self.assertIsNotNone(results[0].get('_id', None))
+        self.assertIsNotNone(results[1].get('error', None))
+        self.assertNotEqual(results[0]['_id'], results[2]['_id'])
+        # create a batch of emails sent as NDJSON
+        resp = client.post(
+            '/emails/batch',
+            data='{"recipient": "foo@bar.baz", "content": "foobar"}\n{"recipient": "bar@foo.baz", "content": "foo"}\n',
+            content_type='application/x-ndjson'
+        )
+        self.assertStatus(resp, 201)
+        self.assertEqual(2, len(resp.json["data"]))
+        # attempt to create a batch which is not an array
+        resp = client.post('/emails/batch', json=self.email_in_test_json)
+        self.assertStatus(resp, 400)
+
     def test_update_email(self, app: Flask, client: FlaskClient) -> None:
         # update an existing email
         #
@@ -69,6 +142,14 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
             json=self.email_in_test_json
         )
         self.assertStatus(resp, 404)
+        # update an existing email, returning some fields only
+        resp = client.put(
+            f"/emails/{str(self.email1_json['_id']['$oid'])}?fields=title",
+            json={'title': 'Updated title'}
+        )
+        self.assertStatus(resp, 200)
+        self.assertEqual('Updated title', resp.json['data']['title'])
+        self.assertNotIn('content', resp.json['data'])
 
     def test_delete_email(self, app: Flask, client: FlaskClient) -> None:
         # delete an existing email
@@ -5,6 +5,7 @@ from fixtures.col import drop_collections
 from fixtures.invoices import create_invoices
 from flask import Flask
 import mongoengine
+from bson import ObjectId
 
 
 class TestFlaskApp(flask_unittest.AppClientTestCase):
@@ -45,6 +46,10 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         # attempt to create another invoice without valid JSON in payload
         resp = client.post('/invoices')
         self.assertStatus(resp, 400)
+        # attempt to create another invoice notified in an unknown timezone should return 500
+        resp = client.post('/invoices', json=dict(self.invoice_in_test_json, reference='TZ-1', timezone='Mars/Olympus'))
+        self.assertStatus(resp, 500)
+        assert "Unknown timezone" in resp.json['error']
         # attempt to create another user without a reference should return 500
         self.invoice_in_test_json.pop('reference')
         resp = client.post('/users', json=self.invoice_in_test_json)
@@ -79,4 +84,15 @@ class TestFlaskApp(flask_unittest.AppClientTestCase):
         # attempt to delete a invoice using an invalid ObjectId
         resp = client.delete(f"/invoices/123")
         self.assertStatus(resp, 400)
-        assert "Invalid ObjectId" in resp.json['error']
\ No newline at end of file
+        assert "Invalid ObjectId" in resp.json['error']
+
+    def test_list_billing_runs(self, app: Flask, client: FlaskClient) -> None:
+        # list the runs planned in a window, by pages in the order of their times
+        invoice_id = ObjectId(self.invoice1_json['_id']['$oid'])
+        self.raw_db['billing_runs'].insert_many([{'invoice': invoice_id, 'runAt': run_at} for run_at in (30, 10, 20, 40)])
+        resp = client.get('/invoices/runs?since=10&until=40&limit=2')
+        self.assertStatus(resp, 200)
+        self.assertEqual([10, 20], [run['runAt'] for run in resp.json['data']])
+        resp = client.get(f"/invoices/runs?since=10&until=40&limit=2&cursor={resp.json['next']}")
+        self.assertEqual([30], [run['runAt'] for run in resp.json['data']])
+        self.assertIsNone(resp.json['next'])
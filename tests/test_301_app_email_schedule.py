@@ -4,6 +4,7 @@ from flask import Flask
 from fixtures.col import drop_collections
 from schedbill import create_app, config, db, scheduler, timing
 from schedbill.controllers import UserController, EMailController
+from schedbill.models import EMail
 import mongoengine
 from apscheduler.events import (
     SchedulerEvent,
@@ -92,6 +93,22 @@ class EMailSchedulingTestApp(flask_unittest.AppTestCase):
         except Exception as exc:
             self.fail(f"exception when retrieving job id {email.id} : {exc}")
 
+    def test_email_update_unchanged_schedule(self, app: Flask):
+        send_at = int(datetime.now().timestamp()) + 300
+        self.create_email(send_at)
+        # the email is sent, its job is done
+        EMail.objects(id=self.email.id).update(set__sentAt=send_at)
+        self.scheduler.remove_job(str(self.email.id))
+        # an update keeping the sending time does not send the email again
+        email = EMailController.update_email(str(self.email.id), {'sendAt': send_at, 'title': 'Test email again'})
+        self.assertEqual(send_at, email.sentAt)
+        self.assertIsNone(self.scheduler.get_job(str(email.id)))
+        # a new sending time does
+        email = EMailController.update_email(str(self.email.id), {'sendAt': send_at + 60})
+        self.assertEqual(0, email.sentAt)
+        self.assertEqual(0, EMailController.find(str(email.id)).sentAt)
+        self.assertEqual(send_at + 60, int(self.scheduler.get_job(str(email.id)).next_run_time.timestamp()))
+
     def test_email_delete_schedule(self, app: Flask):
         self.create_email(datetime.now().timestamp() + 10)
         try:
@@ -104,4 +121,58 @@ class EMailSchedulingTestApp(flask_unittest.AppTestCase):
             sched_job = self.scheduler.get_job(str(self.email.id))
             self.assertIsNone(sched_job)
         except Exception as exc:
-            self.fail(f"exception when retrieving job id {self.email.id} : {exc}")
\ No newline at end of file
+            self.fail(f"exception when retrieving job id {self.email.id} : {exc}")
+
+    def test_email_bucket_schedule(self, app: Flask):
+        app.config['SCHEDULER_EMAIL_DISPATCH'] = 'bucket'
+        try:
+            send_at = int(datetime.now().timestamp()) + 60
+            self.create_email(send_at)
+            other = EMailController.create_email({
+                'recipient': 'other@foobar.baz',
+                'content': 'Test content',
+                'sendAt': send_at
+            })
+            self.assertIsNone(self.scheduler.get_job(str(self.email.id)))
+            sched_job = self.scheduler.get_job(f"emails@{send_at}")
+            self.assertEqual(timing.TimeCalc.arg_to_timestamp(sched_job.next_run_time), send_at)
+            # one range query sends the whole bucket
+            self.assertEqual(2, EMailController.send_due_emails(send_at, send_at + 1))
+            self.assertIsNotNone(EMailController.find(str(other.id)).sentAt)
+            self.assertEqual(0, EMailController.send_due_emails(send_at, send_at + 1))
+        finally:
+            app.config['SCHEDULER_EMAIL_DISPATCH'] = 'jobstore'
+
+    def test_send_emails_claim(self, app: Flask):
+        send_at = int(datetime.now().timestamp()) + 60
+        self.create_email(send_at)
+        other = EMailController.create_email({'recipient': 'other@foobar.baz', 'content': 'Test content',
+                                              'sendAt': send_at})
+        emails = [EMailController.find(str(self.email.id)), EMailController.find(str(other.id))]
+        # another sender sends the first email meanwhile: only the one claimed is sent
+        EMail.objects(id=self.email.id).update(set__sentAt=send_at - 1)
+        self.assertEqual(1, EMailController.send_emails(emails))
+        self.assertEqual(send_at - 1, EMailController.find(str(self.email.id)).sentAt)
+        self.assertGreater(EMailController.find(str(other.id)).sentAt, 0)
+        self.assertEqual(0, EMailController.send_emails(emails))
+
+    def test_email_backfill_sent_at(self, app: Flask):
+        # an email saved before the sentAt field existed is never pending until backfilled
+        send_at = int(datetime.now().timestamp()) + 60
+        oid = self.raw_db.emails.insert_one({
+            'recipient': 'legacy@foobar.baz',
+            'content': 'Test content',
+            'sendAt': send_at
+        }).inserted_id
+        self.assertNotIn((str(oid), send_at), EMailController.pending_schedules())
+        self.assertEqual(1, EMailController.backfill_sent_at())
+        self.assertIn((str(oid), send_at), EMailController.pending_schedules())
+        self.assertEqual(0, EMailController.backfill_sent_at())
+
+    def test_pending_query_index_only(self, app: Flask):
+        # the emails due in [t0, t1) are listed from the pending_emails index, without fetching the documents
+        EMail.ensure_indexes()
+        send_at = int(datetime.now().timestamp()) + 60
+        self.create_email(send_at)
+        self.assertEqual([(str(self.email.id), send_at)], EMailController.pending_schedules(send_at + 1, send_at))
+        self.assertTrue(db.index_only(EMailController.pending_query(send_at, send_at + 1)))
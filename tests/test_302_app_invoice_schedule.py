@@ -4,6 +4,10 @@ from flask import Flask
 from fixtures.col import drop_collections
 from schedbill import create_app, config, db, scheduler, timing
 from schedbill.controllers import UserController, EMailController, InvoiceController
+from schedbill.models import BillingRun, EMail
+from intents import IntentConsumer
+from pytz import utc
+import threading
 import mongoengine
 from apscheduler.events import (
     SchedulerEvent,
@@ -16,7 +20,7 @@ from apscheduler.events import (
     EVENT_JOB_ERROR,
     EVENT_JOB_MISSED
 )
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class InvoiceSchedulingTestApp(flask_unittest.AppTestCase):
@@ -78,4 +82,158 @@ class InvoiceSchedulingTestApp(flask_unittest.AppTestCase):
         #     self.assertEqual(timing.TimeCalc.arg_to_timestamp(sched_job.next_run_time), self.email.sendAt)
         # except Exception as exc:
         #     self.fail(f"exception when retrieving job id {self.email.id} : {exc}")
-        pass
\ No newline at end of file
+        pass
+
+    def test_invoice_periodic_schedule(self, app: Flask) -> None:
+        self.create_invoice()
+        InvoiceController.generate_invoice(str(self.invoice.id))
+        sched_job = self.scheduler.get_job(str(self.invoice.id))
+        self.assertEqual(10, sched_job.trigger.interval.total_seconds())
+        next_run_time = sched_job.next_run_time
+        # a manual generation keeps the planned schedule
+        InvoiceController.generate_invoice(str(self.invoice.id))
+        self.assertEqual(next_run_time, self.scheduler.get_job(str(self.invoice.id)).next_run_time)
+        # a new periodicity reschedules the job in place, counted from the last planned run
+        invoice = InvoiceController.update_invoice(str(self.invoice.id), {'inc__periodicity': 50})
+        self.assertEqual(60, invoice.periodicity)
+        sched_job = self.scheduler.get_job(str(self.invoice.id))
+        self.assertEqual(60, sched_job.trigger.interval.total_seconds())
+        self.assertEqual(next_run_time + timedelta(seconds=50), sched_job.next_run_time)
+        # a null periodicity unschedules the job
+        InvoiceController.update_invoice(str(self.invoice.id), {'periodicity': 0})
+        self.assertIsNone(self.scheduler.get_job(str(self.invoice.id)))
+
+    def test_invoice_billing_rule_schedule(self, app: Flask) -> None:
+        self.create_invoice()
+        InvoiceController.update_invoice(str(self.invoice.id), {'billingRule': 'monthly:last', 'timezone': 'Europe/Paris'})
+        # the invoice is not scheduled until its first generation
+        self.assertEqual(0, len(InvoiceController.find_billing_runs()))
+        InvoiceController.generate_invoice(str(self.invoice.id))
+        # the job runs once on the next run, the next runs are planned
+        now = int(datetime.now().timestamp())
+        runs = InvoiceController.find_billing_runs()
+        self.assertEqual(app.config['BILLING_RUNS_AHEAD'], len(runs))
+        run_at = [run['runAt'] for run in runs]
+        self.assertEqual(sorted(run_at), run_at)
+        self.assertEqual(timing.TimeCalc.midnight_timestamp(run_at[0] - 1, 'Europe/Paris') + 86400, run_at[0])
+        sched_job = self.scheduler.get_job(str(self.invoice.id))
+        self.assertEqual(run_at[0], int(sched_job.next_run_time.timestamp()))
+        # the runs due in a window are found with a single range query, from the (runAt, id, invoice) index only
+        due = InvoiceController.find_billing_runs(since=now, until=run_at[1] + 1)
+        self.assertEqual(run_at[:2], [run['runAt'] for run in due])
+        self.assertEqual(self.invoice.id, due[0]['invoice'])
+        BillingRun.ensure_indexes()
+        self.assertTrue(db.index_only(InvoiceController.billing_runs_query(since=now, until=run_at[1] + 1)))
+        # each run schedules the next one
+        InvoiceController.plan_billing_runs(now=run_at[0])
+        self.assertEqual(run_at[1], InvoiceController.find_billing_runs()[0]['runAt'])
+        # without billing rule, the invoice is billed periodically again
+        InvoiceController.update_invoice(str(self.invoice.id), {'billingRule': None})
+        self.assertEqual(10, self.scheduler.get_job(str(self.invoice.id)).trigger.interval.total_seconds())
+        self.assertEqual(0, len(InvoiceController.find_billing_runs()))
+
+
+    def test_billing_plan_schedule(self, app: Flask) -> None:
+        # the runs of every invoice with a billing rule are planned daily, by the scheduler of the application
+        plan_job = app.extensions['schedbill']['scheduler'].get_job('billing-plan')
+        self.assertEqual('2', str(plan_job.trigger.fields[5]))
+        self.create_invoice()
+        InvoiceController.update_invoice(str(self.invoice.id), {'billingRule': 'monthly:1'})
+        self.assertEqual(app.config['BILLING_RUNS_AHEAD'], plan_job.func(*plan_job.args, **plan_job.kwargs))
+        self.assertEqual(app.config['BILLING_RUNS_AHEAD'], len(InvoiceController.find_billing_runs()))
+
+class InvoiceWebSchedulingTestApp(flask_unittest.AppTestCase):
+
+    def create_app(self) -> None:
+        app = create_app(config.TestingConfiguration, role='web')
+        with app.app_context():
+            self.raw_db = mongoengine.connection.get_db()
+            yield app
+
+    def setUp(self, app: Flask) -> None:
+        drop_collections(self.raw_db)
+        # the scheduler daemon, applying the schedule intents recorded by the web role
+        self.scheduler = scheduler.setup_scheduler(timezone=utc)
+        self.scheduler.start(paused=True)
+        self.consumer = IntentConsumer(self.raw_db['schedule_intents'], self.scheduler,
+                                       scheduled=self.raw_db['scheduled_jobs'])
+
+    def tearDown(self, app: Flask) -> None:
+        self.scheduler.shutdown(wait=False)
+
+    def test_generate_invoice_web_role(self, app: Flask) -> None:
+        sender = UserController.create_user({'emailAddress': 'foobar@foo.bar', 'firstName': 'Foo', 'lastName': 'Bar'})
+        recipient = UserController.create_user({'emailAddress': 'barfoo@bar.bar', 'firstName': 'Bar', 'lastName': 'Bar'})
+        invoice = InvoiceController.create_invoice({
+            'sender': sender.id,
+            'recipient': recipient.id,
+            'reference': 'Invoice IX',
+            'periodicity': 10,
+            'notify': False
+        })
+        intents = self.raw_db['schedule_intents']
+        # the first generation starts the periodic job
+        InvoiceController.generate_invoice(str(invoice.id))
+        self.assertEqual('interval', intents.find_one({'_id': str(invoice.id)})['trigger'])
+        self.assertEqual(1, self.consumer.consume())
+        self.assertEqual(10, self.scheduler.get_job(str(invoice.id)).trigger.interval.total_seconds())
+        # once the intent is consumed, the job is still known: a manual generation keeps the planned schedule
+        InvoiceController.generate_invoice(str(invoice.id))
+        self.assertEqual(0, intents.count_documents({}))
+        # and a new periodicity reschedules it
+        InvoiceController.update_invoice(str(invoice.id), {'periodicity': 60})
+        self.assertEqual(1, self.consumer.consume())
+        self.assertEqual(60, self.scheduler.get_job(str(invoice.id)).trigger.interval.total_seconds())
+        # the job removed from the scheduler is not known anymore: the next generation starts it again
+        self.scheduler.remove_job(str(invoice.id))
+        self.assertEqual(0, self.raw_db['scheduled_jobs'].count_documents({}))
+        InvoiceController.generate_invoice(str(invoice.id))
+        self.assertEqual(1, intents.count_documents({'_id': str(invoice.id), 'op': 'add'}))
+
+
+class ProcessPoolConfiguration(config.TestingConfiguration):
+    """Configuration running the invoice jobs in a process pool"""
+    SCHEDULER_MAX_PROCESSES = 1
+
+
+class InvoiceProcessSchedulingTestApp(flask_unittest.AppTestCase):
+
+    def create_app(self) -> None:
+        app = create_app(ProcessPoolConfiguration)
+        with app.app_context():
+            self.raw_db = mongoengine.connection.get_db()
+            self.scheduler = scheduler.get_scheduler()
+            yield app
+            self.scheduler.shutdown(wait=False)
+
+    def setUp(self, app: Flask) -> None:
+        drop_collections(self.raw_db)
+
+    def test_generate_invoice_process_pool(self, app: Flask) -> None:
+        def job_listener(event: SchedulerEvent) -> None:
+            if event.job_id == str(invoice.id):
+                if event.code == EVENT_JOB_ERROR:
+                    errors.append(event.exception)
+                executed.set()
+
+        executed = threading.Event()
+        errors = []
+        self.scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        sender = UserController.create_user({'emailAddress': 'foobar@foo.bar', 'firstName': 'Foo', 'lastName': 'Bar'})
+        recipient = UserController.create_user({'emailAddress': 'barfoo@bar.bar', 'firstName': 'Bar', 'lastName': 'Bar'})
+        invoice = InvoiceController.create_invoice({
+            'sender': sender.id,
+            'recipient': recipient.id,
+            'reference': 'Invoice IX',
+            'periodicity': 1,
+            'notify': True,
+            'notifyAt': 0
+        })
+        # the first generation starts the periodic job, routed to the process pool
+        InvoiceController.generate_invoice(str(invoice.id))
+        self.assertEqual('processpool', self.scheduler.get_job(str(invoice.id)).executor)
+        self.assertEqual(1, EMail.objects(recipient='barfoo@bar.bar').count())
+        # the next generation runs in a worker, which notifies the recipient as well
+        self.assertTrue(executed.wait(60))
+        self.assertEqual([], errors)
+        self.assertGreaterEqual(EMail.objects(recipient='barfoo@bar.bar').count(), 2)